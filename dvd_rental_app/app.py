@@ -1,8 +1,23 @@
-from flask import Flask, render_template, request, redirect, url_for, flash
+from flask import (Flask, render_template, request, redirect, url_for, flash, jsonify, session, g, Response,
+                   has_request_context, before_render_template, template_rendered)
 import sqlite3
 import datetime
 import os
-from vector_search import VectorSearch
+import time
+import functools
+from vector_search import VectorSearch, QueryEmbeddingCache
+from embedding_server import EmbeddingClient
+from dvd_search import keyword_search, hybrid_search, suggest_dvds
+from stats import DashboardStats, DEFAULT_TTL
+from db import ConnectionPool
+from rentals import checkout, return_rental, checkout_many, return_many, RentalError
+from pagination import list_users, list_active_rentals, list_overdue_rentals, keyset_page, decode_cursor, page_size
+from embed_worker import queue_status
+from members import lookup_members, LOOKUP_FIELDS, LOOKUP_LIMIT, MAX_LOOKUP_LIMIT, MEMBER_FIELDS
+from page_cache import PageCache, page_key, make_etag, DEFAULT_MAX_ENTRIES
+from export_rentals import build_filters, generate, export_filename, FORMATS, MIMETYPES
+from dvd_import import import_catalog, decode_csv, MAX_IMPORT_BYTES
+import metrics
 
 # Flaskアプリケーションの初期化
 app = Flask(__name__)
@@ -13,180 +28,268 @@ app.secret_key = os.environ.get('SECRET_KEY', 'supersecretkey')
 DATABASE = os.path.join(os.path.dirname(__file__), 'dvd_rental.db')
 VECTOR_DB_PATH = os.path.join(os.path.dirname(__file__), 'dvd_vector.db')
 
+# 接続プール（WALモード、busy_timeoutなどの設定済み）
+# 取得した結果を辞書形式（conn.execute(...).fetchone()['column_name']）で扱えるようにする
+db_pool = ConnectionPool(DATABASE, row_factory=sqlite3.Row)
+
+# 検索クエリのベクトルキャッシュ（QUERY_CACHE_DB を空にするとディスクキャッシュを無効化）
+QUERY_CACHE_DB = os.environ.get('QUERY_CACHE_DB', os.path.join(os.path.dirname(__file__), 'dvd_query_cache.db'))
+query_cache = QueryEmbeddingCache(max_entries=int(os.environ.get('QUERY_CACHE_SIZE', 1024)),
+                                  db_path=QUERY_CACHE_DB or None)
+
+# 共有Embeddingサーバー（embedding_server.py）のアドレス。指定した場合、このプロセスではモデルをロードしません
+EMBEDDING_SERVER = os.environ.get('EMBEDDING_SERVER')
+
 # VectorSearchの初期化
-vector_search = VectorSearch(VECTOR_DB_PATH)
+# VECTOR_INDEX=ivf を指定すると近似最近傍インデックスを使用します（VECTOR_NPROBEで再現率と速度を調整）
+# ベクトルの保存形式と行列ファイルの共有は VECTOR_STORAGE / VECTOR_RERANK / VECTOR_MMAP で指定します（vector_search.py を参照）
+vector_search = VectorSearch(VECTOR_DB_PATH,
+                             index=os.environ.get('VECTOR_INDEX') or None,
+                             nprobe=int(os.environ.get('VECTOR_NPROBE') or 0) or None,
+                             query_cache=query_cache,
+                             encoder=EmbeddingClient(EMBEDDING_SERVER) if EMBEDDING_SERVER else None)
 
-@app.template_filter('is_overdue')
-def is_overdue(rental_date_str):
-    """
-    HTMLテンプレート内で使用するカスタムフィルタ。
-    貸出日から7日以上経過しているかを判定し、期限切れならTrueを返します。
-    """
-    if not rental_date_str:
-        return False
-    try:
-        # 文字列形式の時刻をPythonのdatetimeオブジェクトに変換
-        rental_date = datetime.datetime.strptime(rental_date_str, '%Y-%m-%d %H:%M:%S')
-        # 貸出期限を7日後に設定
-        due_date = rental_date + datetime.timedelta(days=7)
-        # 現在時刻が期限を過ぎているかチェック
-        return datetime.datetime.now() > due_date
-    except ValueError:
-        return False
+# ダッシュボードの統計情報のキャッシュ（STATS_CACHE_TTL秒。0で無効）
+dashboard_stats = DashboardStats(ttl=float(os.environ.get('STATS_CACHE_TTL', DEFAULT_TTL)))
+
+# 計測値（metrics.py）を全ワーカーで合算するディレクトリ。gunicorn.conf.py が設定します（未設定の場合はこのプロセスの値だけ）
+metrics.registry.set_directory(os.environ.get('METRICS_DIR'))
+
+# 一覧画面のキャッシュと ETag / 304（PAGE_CACHE=0 で無効、PAGE_CACHE_SIZE=0 で ETag / 304 のみ）
+PAGE_CACHE_ENABLED = os.environ.get('PAGE_CACHE', '1') != '0'
+page_cache = PageCache(max_entries=int(os.environ.get('PAGE_CACHE_SIZE', DEFAULT_MAX_ENTRIES)))
+
+# 起動モード
+# lazy（既定）: モデルのライブラリは最初のAI検索まで読み込みません（キーワード検索のみの運用ではロードされません）
+# preload: 起動時にモデルをロードして試験的にベクトル化します（gunicorn.conf.py の preload_app と組み合わせて使用）
+MODEL_STARTUP = os.environ.get('MODEL_STARTUP', 'lazy')
+if MODEL_STARTUP == 'preload':
+    vector_search.warm_up()
 
 def get_db_connection():
     """
     データベースへの接続を確立し、列名でデータにアクセスできるように設定します。
+    接続はワーカーごとのプールから取り出し、conn.close() でプールに戻ります（db.py）。
+    リクエスト中は、実行したクエリの件数と時間をリクエストのトレーサーで数えます（metrics.py）。
     """
-    conn = sqlite3.connect(DATABASE)
-    # 取得した結果を辞書形式（conn.execute(...).fetchone()['column_name']）で扱えるようにする
-    conn.row_factory = sqlite3.Row
+    conn = db_pool.connect()
+    if has_request_context():
+        conn.tracer = g.get('query_tracer')
     return conn
 
+def data_generation():
+    """
+    データの世代番号（users / dvds / genres / rentals への書き込みのたびにトリガーで進みます）を返します。
+    """
+    conn = get_db_connection()
+    try:
+        row = conn.execute("SELECT value FROM stats_counters WHERE name = 'data_generation'").fetchone()
+        return row[0] if row else 0
+    finally:
+        conn.close()
+
+def current_minute():
+    """
+    時刻の表示や延滞の判定を含む画面の版。1分ごとに描画し直します。
+    """
+    return datetime.datetime.now().strftime('%Y-%m-%d %H:%M')
+
+def vector_version():
+    """
+    AI検索を含むDVD一覧の版。ベクトル化がDVDの更新より後に反映されるため、ベクトルDBのversionも含めます。
+    """
+    if request.args.get('search_type') == 'semantic' and request.args.get('query'):
+        return vector_search.get_meta('version', 0)
+    return None
+
+def cached_page(vary=None):
+    """
+    GETで表示する画面を、データの世代番号とルート・クエリパラメータをキーにキャッシュするデコレータ（page_cache.py）。
+    If-None-Match が現在の ETag と一致すれば 304 を返し、同じ ETag の描画結果があればそれを返します。
+    通知（flash）の表示を含む画面はキャッシュしません。
+    :param vary: 世代番号のほかに内容を決める値を返す関数（時刻・ベクトルDBのversionなど）
+    """
+    def decorator(view):
+        @functools.wraps(view)
+        def wrapper(*args, **kwargs):
+            # 表示待ちの通知がある場合は、通知を含めて毎回描画します
+            if not PAGE_CACHE_ENABLED or request.method not in ('GET', 'HEAD') or session.get('_flashes'):
+                page_cache.record_bypass()
+                return view(*args, **kwargs)
+
+            g.data_generation = data_generation()
+            key = page_key(request.path, request.args)
+            etag = make_etag(key, (g.data_generation, vary() if vary else None))
+            if request.if_none_match.contains(etag):
+                page_cache.record_not_modified()
+                response = app.response_class(status=304)
+            else:
+                cached = page_cache.get(key, etag)
+                if cached is not None:
+                    response = app.response_class(cached[0], mimetype=cached[1])
+                else:
+                    response = app.make_response(view(*args, **kwargs))
+                    # 描画中に通知を追加した（不正なカーソルなど）場合や、リダイレクトなどは保存しません
+                    if response.status_code != 200 or session.modified:
+                        return response
+                    page_cache.put(key, etag, response.get_data(), response.mimetype)
+            response.set_etag(etag)
+            # ブラウザ・nginx には毎回 ETag で確認させます（変わっていなければ 304 で本文を送りません）
+            response.headers['Cache-Control'] = 'no-cache'
+            return response
+        return wrapper
+    return decorator
+
+def route_name():
+    """
+    計測に使うルート名（/dvds/<int:dvd_id>/edit など。どのルートにも一致しない場合は unmatched）。
+    """
+    return request.url_rule.rule if request.url_rule else 'unmatched'
+
+@app.before_request
+def start_request_metrics():
+    """
+    リクエストの開始時刻と、クエリを数えるトレーサーを用意します。
+    """
+    g.request_started = time.perf_counter()
+    g.query_tracer = metrics.QueryTracer(route_name())
+
+@app.after_request
+def record_request_metrics(response):
+    """
+    ルートごとのレイテンシ・ステータスと、リクエスト中に実行したクエリの件数・時間を記録します。
+    ストリーミング応答（/export/rentals）は、本文を送り終わるまでではなく応答を返すまでの時間です。
+    """
+    started = g.get('request_started')
+    if started is None:
+        return response
+    route = route_name()
+    metrics.inc('dvd_http_requests_total', {'route': route, 'method': request.method, 'status': response.status_code})
+    metrics.observe('dvd_http_request_duration_seconds', time.perf_counter() - started, {'route': route})
+    tracer = g.query_tracer
+    metrics.observe('dvd_db_queries_per_request', tracer.count, {'route': route})
+    metrics.observe('dvd_db_query_seconds_per_request', tracer.seconds, {'route': route})
+    return response
+
+def start_template_timer(sender, template, context, **extra):
+    g.template_started = time.perf_counter()
+
+def record_template_time(sender, template, context, **extra):
+    started = g.pop('template_started', None)
+    if started is not None and has_request_context():
+        metrics.observe('dvd_template_render_seconds', time.perf_counter() - started, {'route': route_name()})
+
+# テンプレートの描画時間（Flask のシグナルで描画の前後を受け取ります）
+before_render_template.connect(start_template_timer, app)
+template_rendered.connect(record_template_time, app)
+
+@app.route('/metrics')
+def metrics_endpoint():
+    """
+    リクエスト・SQL・AI検索の計測値を Prometheus のテキスト形式で返します（metrics.py）。
+    値は全ワーカーの合計です（METRICS_DIR が設定されていない場合は、応答したプロセスの値だけ）。
+    """
+    return Response(metrics.render(), mimetype='text/plain; version=0.0.4')
+
 @app.route('/')
+@cached_page(vary=current_minute)
 def index():
     """
     ダッシュボード画面（ホームページ）を表示します。
-    #5 JOIN: 複数のテーブルを結合して必要な情報を取得します。
+    件数などの統計情報はトリガーで更新される集計テーブルから読み取り、短時間キャッシュします（stats.py）。
     """
-    conn = get_db_connection()
-    
-    # --- 統計情報の取得 (#5 SubQuery的利用) ---
-    # 各テーブルのレコード数をカウントして概要を把握します
-    user_count = conn.execute('SELECT COUNT(*) FROM users').fetchone()[0]
-    dvd_count = conn.execute('SELECT COUNT(*) FROM dvds').fetchone()[0]
-    # return_date IS NULL は「まだ返却されていない」ことを意味します
-    active_rentals = conn.execute('SELECT COUNT(*) FROM rentals WHERE return_date IS NULL').fetchone()[0]
-    
-    # 本日の貸出数を取得（SQLiteのdate関数で日付部分のみ比較）
-    today = datetime.date.today().strftime('%Y-%m-%d')
-    today_rentals = conn.execute('SELECT COUNT(*) FROM rentals WHERE date(rental_date) = ?', (today,)).fetchone()[0]
-
-    # 期限切れの貸出数（julianday関数で日数の差分が7日を超えるものを抽出）
-    overdue_rentals = conn.execute('''
-        SELECT COUNT(*) FROM rentals 
-        WHERE return_date IS NULL 
-        AND julianday('now') - julianday(rental_date) > 7
-    ''').fetchone()[0]
-
-    # ジャンルごとの在庫統計（LEFT JOINでDVDが0件のジャンルも表示）
-    genre_stats = conn.execute('''
-        SELECT g.name, COUNT(d.dvd_id) as count, SUM(d.stock_count) as total_stock
-        FROM genres g
-        LEFT JOIN dvds d ON g.genre_id = d.genre_id
-        GROUP BY g.genre_id
-    ''').fetchall()
-
-    # 最近のレンタル情報5件 (#5 JOIN)
-    # rentalsテーブルにusers(名前)とdvds(タイトル)を紐付けて取得
-    recent_rentals = conn.execute('''
-        SELECT r.*, u.name as user_name, d.title as dvd_title 
-        FROM rentals r
-        JOIN users u ON r.user_id = u.user_id
-        JOIN dvds d ON r.dvd_id = d.dvd_id
-        ORDER BY r.rental_date DESC LIMIT 5
-    ''').fetchall()
-    
-    conn.close()
+    # --- 統計情報の取得 (#8 Tuning) ---
+    # 登録者数・DVD数・貸出中・本日の貸出数・延滞数・ジャンル別在庫・最近のレンタル5件 (#5 JOIN)
+    stats = dashboard_stats.get(get_db_connection, version=g.get('data_generation'))
+
     # 現在時刻をフォーマットして表示用に準備
     now = datetime.datetime.now().strftime('%Y年%m月%d日 %H:%M')
-    return render_template('index.html', 
-                         user_count=user_count, 
-                         dvd_count=dvd_count, 
-                         active_rentals=active_rentals, 
-                         today_rentals=today_rentals,
-                         overdue_rentals=overdue_rentals,
-                         genre_stats=genre_stats,
-                         recent_rentals=recent_rentals,
-                         now=now)
+    return render_template('index.html', now=now, **stats)
 
 @app.route('/dvds')
+@cached_page(vary=vector_version)
 def dvds():
     """
     DVD一覧を表示し、検索機能を提供します。
     """
     # 検索キーワードとジャンルIDをURLパラメータから取得
+    # ジャンルIDは数値に変換し（不正な値は絞り込みなし）、キーワード検索とベクトル検索に同じ値を渡します
     query = request.args.get('query', '')
-    genre_id = request.args.get('genre_id', '')
+    genre_id = request.args.get('genre_id', type=int)
     search_type = request.args.get('search_type', 'keyword')
+    in_stock_only = request.args.get('in_stock') == '1'
     
     conn = get_db_connection()
     dvds = []
+    pagination = None
+    next_cursor = None
     
     if query and search_type == 'semantic':
-        # AI (ベクトル) 検索 + キーワード補正 (Hybrid Search)
-        results = vector_search.search(query, limit=20) # 多めに取得
-        
-        if results:
-            dvd_ids = [r['dvd_id'] for r in results]
-            placeholders = ','.join('?' * len(dvd_ids))
-            
-            sql = f'''
-                SELECT d.*, g.name as genre_name 
-                FROM dvds d 
-                LEFT JOIN genres g ON d.genre_id = g.genre_id
-                WHERE d.dvd_id IN ({placeholders})
-            '''
-            params = list(dvd_ids)
-            if genre_id:
-                sql += ' AND d.genre_id = ?'
-                params.append(genre_id)
-                
-            rows = conn.execute(sql, params).fetchall()
-            
-            # ハイブリッドスコアの計算
-            # ベクトルスコアに、キーワードが含まれている場合のボーナスを加算
-            scored_dvds = []
-            vector_scores = {r['dvd_id']: r['score'] for r in results}
-            
-            for row in rows:
-                did = row['dvd_id']
-                score = vector_scores.get(did, 0)
-                
-                # キーワードが含まれている場合は大幅に加点（ブースト）
-                # タイトル一致は特に高く
-                title = row['title']
-                desc = row['description'] or ""
-                
-                if query in title:
-                    score += 2.0 # 強力なブースト
-                elif query in desc:
-                    score += 1.0 # 中程度のブースト
-                
-                scored_dvds.append({'row': row, 'score': score})
-            
-            # 最終的なスコアでソート
-            scored_dvds.sort(key=lambda x: x['score'], reverse=True)
-            dvds = [item['row'] for item in scored_dvds[:10]]
-        else:
-            dvds = []
+        # AI (ベクトル) 検索 + キーワード検索のハイブリッド検索
+        # 両方の検索結果をRRF（順位の逆数の和）で統合し、ページ単位で表示します
+        page = request.args.get('page', 1, type=int)
+        pagination = hybrid_search(conn, vector_search, query, genre_id, page=page,
+                                   in_stock_only=in_stock_only)
+        dvds = pagination['dvds']
     else:
-        # 通常のキーワード検索（タイトル一致）
-        sql = '''
-            SELECT d.*, g.name as genre_name 
-            FROM dvds d 
-            LEFT JOIN genres g ON d.genre_id = g.genre_id
-            WHERE d.title LIKE ?
-        '''
-        params = [f'%{query}%']
-        
-        if genre_id:
-            sql += ' AND d.genre_id = ?'
-            params.append(genre_id)
-            
-        dvds = conn.execute(sql, params).fetchall()
+        # 通常のキーワード検索（タイトル・説明文の全文検索、BM25順）
+        # キーセット方式で1ページ分だけ取得します（cursor は前のページの最後の [search_rank, dvd_id]）
+        limit = page_size(request.args.get('per_page'))
+        try:
+            after = decode_cursor(request.args.get('cursor'), 2)
+        except ValueError as e:
+            flash(str(e), 'error')
+            after = None
+        rows = keyword_search(conn, query, genre_id, limit=limit + 1, in_stock_only=in_stock_only, after=after)
+        page = keyset_page(rows, limit, lambda row: [row['search_rank'], row['dvd_id']])
+        dvds = page['items']
+        next_cursor = page['next_cursor']
 
     # ジャンル選択プルダウン用のデータを取得
     genres = conn.execute('SELECT * FROM genres').fetchall()
     conn.close()
     
-    return render_template('dvds.html', dvds=dvds, genres=genres, query=query, genre_id=genre_id, search_type=search_type)
+    return render_template('dvds.html', dvds=dvds, genres=genres, query=query, genre_id=genre_id, search_type=search_type,
+                           in_stock_only=in_stock_only, pagination=pagination, next_cursor=next_cursor,
+                           cursor=request.args.get('cursor'))
+
+@app.route('/api/query_cache')
+def query_cache_stats():
+    """
+    検索クエリのベクトルキャッシュのヒット・ミス回数をJSONで返します（キャッシュサイズの調整用）。
+    値はこのワーカープロセスでの集計です。
+    """
+    return jsonify(query_cache.stats())
+
+@app.route('/api/page_cache')
+def page_cache_stats():
+    """
+    画面のキャッシュのヒット（キャッシュからの応答・304）・ミス回数をJSONで返します。
+    値はこのワーカープロセスでの集計です。
+    """
+    return jsonify(page_cache.stats())
+
+@app.route('/api/vector_index/status')
+def vector_index_status():
+    """
+    AI検索のインデックスが編集にどれだけ遅れているか（ベクトル化待ちのジョブ数と最も古いジョブの経過秒数）をJSONで返します。
+    """
+    conn = get_db_connection()
+    try:
+        status = queue_status(conn)
+    finally:
+        conn.close()
+    status['vector_version'] = vector_search.get_meta('version', 0)
+    status['vector_storage'] = vector_search.storage
+    return jsonify(status)
 
 @app.route('/add_dvd', methods=['GET', 'POST'])
 def add_dvd():
     """
     新規DVDを登録します。
     POSTリクエスト時はフォームの内容をDBに保存します。
+    AI検索用のベクトル化は、INSERTと同じトランザクションでトリガーが embedding_jobs に登録し、
+    embed_worker.py がバックグラウンドで行います（保存処理はベクトル化を待ちません）。
     """
     conn = get_db_connection()
     if request.method == 'POST':
@@ -197,6 +300,8 @@ def add_dvd():
         stock_count = request.form['stock_count']
         storage_location = request.form['storage_location']
         description = request.form['description']
+        # 貸出日数（空欄の場合はジャンルの設定、それもなければ既定の日数で返却期限を計算します）
+        loan_days = request.form.get('loan_days') or None
         
         # 初期登録時は、現在在庫と総在庫を同じにする
         total_stock = stock_count
@@ -206,29 +311,14 @@ def add_dvd():
             if not genre_id: genre_id = None
             if not release_date: release_date = None
 
-            cursor = conn.execute('''
-                INSERT INTO dvds (title, genre_id, release_date, stock_count, total_stock, storage_location, description)
-                VALUES (?, ?, ?, ?, ?, ?, ?)
-            ''', (title, genre_id, release_date, stock_count, total_stock, storage_location, description))
-            new_dvd_id = cursor.lastrowid
+            conn.execute('''
+                INSERT INTO dvds (title, genre_id, release_date, stock_count, total_stock, storage_location, description,
+                                  loan_days)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?)
+            ''', (title, genre_id, release_date, stock_count, total_stock, storage_location, description, loan_days))
             conn.commit()
-            
-            # Vector DBにも追加
-            if description:
-                try:
-                    # ジャンル名を取得
-                    genre_name = ""
-                    if genre_id:
-                        genre_row = conn.execute('SELECT name FROM genres WHERE genre_id = ?', (genre_id,)).fetchone()
-                        if genre_row:
-                            genre_name = genre_row['name']
-                    
-                    enriched_text = f"{title}。ジャンルは{genre_name}。{description}"
-                    vector_search.add_dvd(new_dvd_id, enriched_text)
-                except Exception as ve:
-                    print(f"Vector DB Error: {ve}")
-
-            flash('新規商品を登録しました。', 'success')
+
+            flash('新規商品を登録しました。AI検索には数秒後に反映されます。', 'success')
             return redirect(url_for('dvds'))
         except Exception as e:
             # エラー時はロールバック（SQLiteは自動ですが明示的に例外処理）して通知
@@ -239,10 +329,52 @@ def add_dvd():
     conn.close()
     return render_template('add_dvd.html', genres=genres)
 
+@app.route('/import_dvds', methods=['GET', 'POST'])
+def import_dvds():
+    """
+    仕入れ先のCSVからDVDをまとめて登録します（dvd_import.py）。
+    ジャンルはファイル全体で1回だけ解決し、チャンクごとに executemany で登録・在庫追加します。
+    入力に誤りのある行は行番号とともに表示し、それ以外の行は登録します。ベクトル化は embed_worker.py が行います。
+    """
+    if request.method == 'GET':
+        return render_template('import_dvds.html', result=None)
+
+    upload = request.files.get('file')
+    if not upload or not upload.filename:
+        flash('CSVファイルを選択してください。', 'error')
+        return render_template('import_dvds.html', result=None)
+    data = upload.read(MAX_IMPORT_BYTES + 1)
+    if len(data) > MAX_IMPORT_BYTES:
+        flash(f'ファイルが大きすぎます（{MAX_IMPORT_BYTES // (1024 * 1024)}MBまで）。', 'error')
+        return render_template('import_dvds.html', result=None)
+
+    conn = get_db_connection()
+    try:
+        result = import_catalog(conn, decode_csv(data), create_genres=request.form.get('create_genres') == '1',
+                                dry_run=request.form.get('dry_run') == '1')
+    except (ValueError, UnicodeDecodeError) as e:
+        flash(f'CSVを読み込めません: {str(e)}', 'error')
+        return render_template('import_dvds.html', result=None)
+    finally:
+        conn.close()
+
+    if result['inserted'] or result['updated']:
+        dashboard_stats.invalidate()
+        # 在庫の有無が変わった既存のDVDを、AI検索の「在庫ありのみ」の絞り込みにも反映
+        try:
+            vector_search.set_attributes(result['attributes'])
+        except Exception as ve:
+            print(f"Vector DB Error: {ve}")
+    flash(f"{result['rows']}行を処理しました（追加 {result['inserted']}件・更新 {result['updated']}件・"
+          f"エラー {len(result['errors'])}件、{result['rows_per_sec']:.0f}行/秒）。",
+          'error' if result['errors'] else 'success')
+    return render_template('import_dvds.html', result=result, dry_run=request.form.get('dry_run') == '1')
+
 @app.route('/edit_dvd/<int:dvd_id>', methods=['GET', 'POST'])
 def edit_dvd(dvd_id):
     """
     既存DVDの情報を編集します。
+    タイトル・説明文・ジャンルが変わった場合の再ベクトル化は embed_worker.py がバックグラウンドで行います。
     """
     conn = get_db_connection()
     if request.method == 'POST':
@@ -253,33 +385,26 @@ def edit_dvd(dvd_id):
         stock_count = request.form['stock_count']
         storage_location = request.form['storage_location']
         description = request.form['description']
+        loan_days = request.form.get('loan_days') or None
         
         try:
             if not genre_id: genre_id = None
             if not release_date: release_date = None
 
-            # 指定されたdvd_idのレコードを更新
+            # 指定されたdvd_idのレコードを更新（貸出日数の変更は、これから貸し出す分の返却期限にだけ反映されます）
             conn.execute('''
                 UPDATE dvds 
-                SET title = ?, genre_id = ?, release_date = ?, stock_count = ?, storage_location = ?, description = ?
+                SET title = ?, genre_id = ?, release_date = ?, stock_count = ?, storage_location = ?, description = ?,
+                    loan_days = ?
                 WHERE dvd_id = ?
-            ''', (title, genre_id, release_date, stock_count, storage_location, description, dvd_id))
+            ''', (title, genre_id, release_date, stock_count, storage_location, description, loan_days, dvd_id))
             conn.commit()
-            
-            # Vector DBも更新
-            if description:
-                try:
-                    # ジャンル名を取得
-                    genre_name = ""
-                    if genre_id:
-                        genre_row = conn.execute('SELECT name FROM genres WHERE genre_id = ?', (genre_id,)).fetchone()
-                        if genre_row:
-                            genre_name = genre_row['name']
-                            
-                    enriched_text = f"{title}。ジャンルは{genre_name}。{description}"
-                    vector_search.add_dvd(dvd_id, enriched_text)
-                except Exception as ve:
-                    print(f"Vector DB Error: {ve}")
+
+            # 絞り込み用の属性（ジャンル・在庫の有無）はベクトル化を伴わないため、すぐに反映します
+            try:
+                vector_search.set_attributes({dvd_id: (int(genre_id) if genre_id else None, int(stock_count) > 0)})
+            except Exception as ve:
+                print(f"Vector DB Error: {ve}")
 
             flash('DVD情報を更新しました。', 'success')
             return redirect(url_for('dvds'))
@@ -311,6 +436,11 @@ def delete_dvd(dvd_id):
         else:
             conn.execute('DELETE FROM dvds WHERE dvd_id = ?', (dvd_id,))
             conn.commit()
+            # AI検索のベクトルもすぐに削除します（失敗した場合もトリガーで登録したジョブで embed_worker.py が削除します）
+            try:
+                vector_search.remove_dvd(dvd_id)
+            except Exception as ve:
+                print(f"Vector DB Error: {ve}")
             flash('DVDを削除しました。', 'success')
     except Exception as e:
         flash(f'削除エラー: {str(e)}', 'error')
@@ -319,6 +449,7 @@ def delete_dvd(dvd_id):
     return redirect(url_for('dvds'))
 
 @app.route('/users', methods=['GET', 'POST'])
+@cached_page()
 def users():
     """
     ユーザー一覧表示と新規登録。
@@ -341,10 +472,22 @@ def users():
             flash(f'登録エラー: {str(e)}', 'error')
         return redirect(url_for('users'))
 
-    # 最新順にユーザーを表示
-    users = conn.execute('SELECT * FROM users ORDER BY created_at DESC').fetchall()
+    # 会員番号・電話番号・名前での検索（前方一致、最大 MAX_LOOKUP_LIMIT 件）
+    query = request.args.get('q', '').strip()
+    if query:
+        users = lookup_members(conn, query, limit=MAX_LOOKUP_LIMIT)
+        conn.close()
+        return render_template('users.html', users=users, query=query, next_cursor=None, cursor=None)
+
+    # 最新順にユーザーを表示（キーセット方式で1ページ分だけ取得します）
+    try:
+        page = list_users(conn, request.args.get('cursor'), page_size(request.args.get('per_page')))
+    except ValueError as e:
+        flash(str(e), 'error')
+        page = list_users(conn)
     conn.close()
-    return render_template('users.html', users=users)
+    return render_template('users.html', users=page['items'], next_cursor=page['next_cursor'],
+                           cursor=request.args.get('cursor'))
 
 @app.route('/edit_user/<int:user_id>', methods=['GET', 'POST'])
 def edit_user(user_id):
@@ -402,29 +545,130 @@ def delete_user(user_id):
     return redirect(url_for('users'))
 
 @app.route('/rental')
+@cached_page(vary=current_minute)
 def rental_page():
     """
     貸出処理と貸出状況の確認ページ。
     """
     conn = get_db_connection()
-    # プルダウン選択用のデータを取得
-    users = conn.execute('SELECT user_id, name, member_code FROM users').fetchall()
-    # 在庫があるDVDのみを表示対象とする
-    dvds = conn.execute('SELECT dvd_id, title FROM dvds WHERE stock_count > 0').fetchall()
-    
-    # 現在貸出中（未返却）のレコードを最新順に取得
-    active_rentals = conn.execute('''
-        SELECT r.*, u.name as user_name, d.title as dvd_title 
-        FROM rentals r
-        JOIN users u ON r.user_id = u.user_id
-        JOIN dvds d ON r.dvd_id = d.dvd_id
-        WHERE r.return_date IS NULL
-        ORDER BY r.rental_date DESC
-    ''').fetchall()
+    # ユーザーとDVDは入力に合わせて /api/users/suggest, /api/dvds/suggest から候補を取得するため、
+    # ここでは全件を読み込みません。DVD一覧から来た場合のみ、そのDVDを初期値として渡します
+    dvd = None
+    if request.args.get('dvd_id', type=int):
+        dvd = conn.execute('SELECT dvd_id, title FROM dvds WHERE dvd_id = ? AND stock_count > 0',
+                           (request.args.get('dvd_id', type=int),)).fetchone()
+
+    # 現在貸出中（未返却）のレコードを最新順に1ページ分取得
+    try:
+        page = list_active_rentals(conn, request.args.get('cursor'), page_size(request.args.get('per_page')))
+    except ValueError as e:
+        flash(str(e), 'error')
+        page = list_active_rentals(conn)
+    active_count = conn.execute("SELECT value FROM stats_counters WHERE name = 'active_rentals'").fetchone()
     conn.close()
-    return render_template('rental.html', users=users, dvds=dvds, active_rentals=active_rentals)
+    return render_template('rental.html', dvd=dvd, active_rentals=page['items'], next_cursor=page['next_cursor'],
+                           cursor=request.args.get('cursor'), active_count=active_count[0] if active_count else 0)
+
+@app.route('/api/rentals/overdue')
+def api_overdue_rentals():
+    """
+    現在延滞している（期限を過ぎて未返却の）レンタルを、期限の古い順にJSONで返します（延滞レポート）。
+    期限は貸出時に rentals.due_date に保存しているため、部分インデックスの範囲検索だけで求められます。
+    例: /api/rentals/overdue?per_page=100 , 続きは next_cursor を cursor に指定します
+    """
+    conn = get_db_connection()
+    try:
+        try:
+            page = list_overdue_rentals(conn, request.args.get('cursor'), page_size(request.args.get('per_page')))
+        except ValueError as e:
+            return jsonify({'error': str(e)}), 400
+        total = conn.execute("SELECT COUNT(*) FROM rentals WHERE return_date IS NULL AND due_date < datetime('now')"
+                             ).fetchone()[0]
+    finally:
+        conn.close()
+    return jsonify({
+        'overdue_count': total,
+        'rentals': [dict(row) for row in page['items']],
+        'next_cursor': page['next_cursor'],
+    })
+
+@app.route('/export/rentals')
+def export_rentals():
+    """
+    貸出履歴を会員・DVDの情報と結合して CSV / NDJSON でダウンロードします（会計処理用）。
+    チャンクごとに読み込んで書き出すストリーミング応答なので、履歴の件数に関係なくメモリ使用量は一定です（export_rentals.py）。
+    例: /export/rentals?format=csv&from=2024-01-01&to=2024-12-31&status=returned
+    """
+    fmt = request.args.get('format', 'csv')
+    date_from, date_to = request.args.get('from'), request.args.get('to')
+    status = request.args.get('status', 'all')
+    if fmt not in FORMATS:
+        return jsonify({'error': f"format は {', '.join(FORMATS)} のいずれかを指定してください。"}), 400
+    try:
+        conditions, params = build_filters(date_from, date_to, status)
+    except ValueError as e:
+        return jsonify({'error': str(e)}), 400
+    # チャンクごとに接続をプールから取り出して返すため、ダウンロード中も読み取りトランザクションを持ち続けません
+    body = generate(get_db_connection, fmt, conditions, params)
+    return Response(body, mimetype=MIMETYPES[fmt], headers={
+        'Content-Disposition': f'attachment; filename={export_filename(fmt, date_from, date_to, status)}',
+        # nginx にバッファさせず、読み込んだチャンクから順に送ります
+        'X-Accel-Buffering': 'no',
+    })
+
+@app.route('/api/users/suggest')
+def api_suggest_users():
+    """
+    貸出画面のユーザー入力欄の候補（会員番号・電話番号・名前の前方一致）をJSONで返します。
+    """
+    conn = get_db_connection()
+    try:
+        rows = lookup_members(conn, request.args.get('q', ''))
+    finally:
+        conn.close()
+    return jsonify({'users': [{key: row[key] for key in MEMBER_FIELDS} for row in rows]})
+
+@app.route('/api/members/lookup')
+def api_member_lookup():
+    """
+    会員番号・電話番号・名前の前方一致で会員を検索し、JSONで返します（カウンターでの会員の特定用）。
+    field を省略した場合は、数字だけの入力を電話番号、それ以外を会員番号と名前として検索します。
+    例: /api/members/lookup?q=090-12 , /api/members/lookup?q=M0001&field=member_code
+    """
+    query = request.args.get('q', '')
+    field = request.args.get('field')
+    if field and field not in LOOKUP_FIELDS:
+        return jsonify({'error': f"field は {', '.join(LOOKUP_FIELDS)} のいずれかを指定してください。"}), 400
+    limit = min(max(1, request.args.get('limit', LOOKUP_LIMIT, type=int)), MAX_LOOKUP_LIMIT)
+
+    start = time.perf_counter()
+    conn = get_db_connection()
+    try:
+        rows = lookup_members(conn, query, [field] if field else None, limit)
+    finally:
+        conn.close()
+    return jsonify({
+        'query': query,
+        'members': [{key: row[key] for key in MEMBER_FIELDS} for row in rows],
+        'elapsed_ms': round((time.perf_counter() - start) * 1000, 3),
+    })
+
+@app.route('/api/dvds/suggest')
+def api_suggest_dvds():
+    """
+    貸出画面のDVD入力欄の候補（dvd_id・タイトルの前方一致・全文検索）をJSONで返します。
+    既定では在庫のあるDVDだけを返します（in_stock=0 で在庫なしも含めます）。
+    """
+    conn = get_db_connection()
+    try:
+        rows = suggest_dvds(conn, request.args.get('q', ''), in_stock_only=request.args.get('in_stock') != '0')
+    finally:
+        conn.close()
+    return jsonify({'dvds': [{'dvd_id': row['dvd_id'], 'title': row['title'], 'stock_count': row['stock_count']}
+                             for row in rows]})
 
 @app.route('/genres', methods=['GET', 'POST'])
+@cached_page()
 def genres():
     """
     ジャンルの管理（追加と一覧）。
@@ -432,8 +676,10 @@ def genres():
     conn = get_db_connection()
     if request.method == 'POST':
         name = request.form['name']
+        # ジャンルの貸出日数（空欄の場合は既定の日数）。DVDごとの設定がある場合はそちらが優先されます
+        loan_days = request.form.get('loan_days') or None
         try:
-            conn.execute('INSERT INTO genres (name) VALUES (?)', (name,))
+            conn.execute('INSERT INTO genres (name, loan_days) VALUES (?, ?)', (name, loan_days))
             conn.commit()
             flash('ジャンルを追加しました。', 'success')
         except Exception as e:
@@ -465,50 +711,39 @@ def delete_genre(genre_id):
         conn.close()
     return redirect(url_for('genres'))
 
+def update_vector_stock(dvd_id, in_stock):
+    """
+    在庫の有無が変わったDVDを、AI検索の「在庫ありのみ」の絞り込みにも反映します。
+    """
+    try:
+        vector_search.set_in_stock(int(dvd_id), in_stock)
+    except Exception as ve:
+        print(f"Vector DB Error: {ve}")
+
 @app.route('/rent', methods=['POST'])
 def rent_dvd():
     """
     DVDの貸出処理を実行します。
     #4 Transaction: 複数のDB更新を一つの単位として実行し、整合性を保ます。
+    在庫の確認と減算、重複チェック、履歴の追加は rentals.checkout で1つのトランザクションとして行います。
     """
     user_id = request.form['user_id']
     dvd_id = request.form['dvd_id']
     
     conn = get_db_connection()
     try:
-        # トランザクション開始 (#4 Transaction)
-        conn.execute('BEGIN TRANSACTION')
-        
-        # 在庫チェック（同時に他者が借りて在庫切れになるのを防ぐため、処理内でも確認）
-        dvd = conn.execute('SELECT stock_count FROM dvds WHERE dvd_id = ?', (dvd_id,)).fetchone()
-        if not dvd or dvd['stock_count'] <= 0:
-            flash('在庫がありません。', 'error')
-            conn.rollback()
-            return redirect(url_for('index'))
-
-        # 重複貸出チェック（同じ人が同じものを現在借りていないか）
-        existing_rental = conn.execute('''
-            SELECT * FROM rentals 
-            WHERE user_id = ? AND dvd_id = ? AND return_date IS NULL
-        ''', (user_id, dvd_id)).fetchone()
-        
-        if existing_rental:
-            flash('このユーザーは既にこのDVDをレンタル中です。', 'error')
-            conn.rollback()
-            return redirect(url_for('index'))
-        
-        # rentalsテーブルに履歴を挿入
-        conn.execute('INSERT INTO rentals (user_id, dvd_id) VALUES (?, ?)', (user_id, dvd_id))
-        
-        # dvdsテーブルの在庫数を1つ減らす
-        conn.execute('UPDATE dvds SET stock_count = stock_count - 1 WHERE dvd_id = ?', (dvd_id,))
-        
-        # すべて成功したらコミット（確定）
-        conn.commit()
+        # 書き込みロックを先に取得してから処理し、競合時は再試行します (#4 Transaction)
+        _, stock_count = checkout(conn, user_id, dvd_id)
+        dashboard_stats.invalidate()
         flash('レンタル処理が完了しました。', 'success')
+
+        # 在庫が0になった場合は、AI検索の「在庫ありのみ」の絞り込みにも反映
+        if stock_count == 0:
+            update_vector_stock(dvd_id, False)
+    except RentalError as e:
+        flash(str(e), 'error')
     except Exception as e:
-        # 途中で失敗した場合はロールバック（最初からなかったことにする）
-        conn.rollback()
+        # 途中で失敗した場合はロールバック済み（最初からなかったことになります）
         flash(f'エラーが発生しました: {str(e)}', 'error')
     finally:
         conn.close()
@@ -522,27 +757,116 @@ def return_dvd(rental_id):
     """
     conn = get_db_connection()
     try:
-        conn.execute('BEGIN TRANSACTION')
-        
-        # 対象のレンタル情報を特定
-        rental = conn.execute('SELECT dvd_id FROM rentals WHERE rental_id = ?', (rental_id,)).fetchone()
-        if rental:
-            dvd_id = rental['dvd_id']
-            # 返却日を現在時刻に更新し、ステータスを変更
-            conn.execute('UPDATE rentals SET return_date = CURRENT_TIMESTAMP, status = "returned" WHERE rental_id = ?', (rental_id,))
-            # DVDの在庫数を1つ戻す
-            conn.execute('UPDATE dvds SET stock_count = stock_count + 1 WHERE dvd_id = ?', (dvd_id,))
-            
-            conn.commit()
-            flash('返却処理が完了しました。', 'success')
+        dvd_id, stock_count = return_rental(conn, rental_id)
+        dashboard_stats.invalidate()
+        flash('返却処理が完了しました。', 'success')
+
+        # 在庫が0から戻った場合は、AI検索の絞り込みにも反映
+        if stock_count == 1:
+            update_vector_stock(dvd_id, True)
+    except RentalError as e:
+        flash(str(e), 'error')
     except Exception as e:
-        conn.rollback()
         flash(f'エラーが発生しました: {str(e)}', 'error')
     finally:
         conn.close()
         
     return redirect(url_for('index'))
 
+def bulk_ids(name):
+    """
+    フォーム（同名の複数フィールド、またはカンマ区切り）かJSONから、IDのリストを取得します。
+    """
+    if request.is_json:
+        values = (request.get_json(silent=True) or {}).get(name) or []
+    else:
+        values = []
+        for value in request.form.getlist(name):
+            values.extend(v for v in value.split(',') if v.strip())
+    try:
+        return [int(value) for value in values]
+    except (TypeError, ValueError):
+        raise RentalError('IDは整数で指定してください。') from None
+
+def bulk_user_id(data):
+    """
+    一括処理の user_id を取得します（指定されていない場合はNone）。
+    """
+    value = data.get('user_id')
+    if value in (None, ''):
+        return None
+    try:
+        return int(value)
+    except (TypeError, ValueError):
+        raise RentalError('ユーザーIDは整数で指定してください。') from None
+
+def run_bulk(operation, ids_name, action):
+    """
+    一括貸出・返却の共通処理。
+    フォームからの場合は結果を通知して貸出画面に戻り、JSONの場合は項目ごとの結果を返します。
+    :param operation: operation(conn, user_id, ids) の形で呼び出す一括処理（checkout_many など）
+    :param ids_name: IDのリストを受け取るパラメータ名
+    :param action: 通知に使う処理名（'貸出' または '返却'）
+    """
+    data = (request.get_json(silent=True) or {}) if request.is_json else request.form
+    conn = get_db_connection()
+    try:
+        results = operation(conn, bulk_user_id(data), bulk_ids(ids_name))
+    except RentalError as e:
+        # 入力の誤りや業務上のエラー（メッセージはそのまま表示できるもの）
+        if request.is_json:
+            return jsonify({'error': str(e)}), 400
+        flash(str(e), 'error')
+        return redirect(url_for('rental_page'))
+    except Exception as e:
+        # 想定外のエラーの内容はログにだけ出し、画面・APIには返しません
+        print(f"Bulk {action} failed: {e!r}")
+        if request.is_json:
+            return jsonify({'error': f'{action}処理中にエラーが発生しました。'}), 500
+        flash(f'{action}処理中にエラーが発生しました。', 'error')
+        return redirect(url_for('rental_page'))
+    finally:
+        conn.close()
+
+    succeeded = [r for r in results if r['ok']]
+    if succeeded:
+        dashboard_stats.invalidate()
+    # 在庫の有無が変わったDVD（貸出で0になった、返却で0から戻った）をAI検索の絞り込みに反映
+    changes = {}
+    for r in succeeded:
+        changes[r['dvd_id']] = (r['stock_count'], changes.get(r['dvd_id'], (0, 0))[1] + 1)
+    for dvd_id, (stock_count, count) in changes.items():
+        if action == '貸出' and stock_count == 0:
+            update_vector_stock(dvd_id, False)
+        elif action == '返却' and stock_count == count:
+            update_vector_stock(dvd_id, True)
+
+    if request.is_json:
+        return jsonify({'results': results})
+    if succeeded:
+        flash(f'{len(succeeded)}件の{action}処理が完了しました。', 'success')
+    for r in results:
+        if not r['ok']:
+            flash(f"{r['title'] or 'ID:' + str(r['dvd_id'] or r.get('rental_id'))}: {r['error']}", 'error')
+    return redirect(url_for('rental_page'))
+
+@app.route('/rent/bulk', methods=['POST'])
+def rent_bulk():
+    """
+    1人のユーザーに複数のDVDをまとめて貸し出します（カウンターでの複数枚の貸出用）。
+    在庫と重複の確認はまとめて行い、貸出は1つのトランザクションで確定します。
+    パラメータ: user_id, dvd_ids（フォームの複数フィールド・カンマ区切り、またはJSONの配列）
+    """
+    return run_bulk(checkout_many, 'dvd_ids', '貸出')
+
+@app.route('/return/bulk', methods=['POST'])
+def return_bulk():
+    """
+    複数のレンタルをまとめて返却します（1つのトランザクション）。
+    パラメータ: rental_ids、user_id（任意。指定した場合はそのユーザーのレンタルだけを返却します）
+    """
+    return run_bulk(lambda conn, user_id, ids: return_many(conn, ids, user_id), 'rental_ids', '返却')
+
 if __name__ == '__main__':
     # Flaskアプリの起動
     # host='0.0.0.0' にすることで、同じWi-Fi内のスマホなどからもアクセス可能になります
@@ -0,0 +1,141 @@
+import sqlite3
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from init_db import init_db
+from db import ConnectionPool, is_busy_error
+from rentals import checkout, return_rental, RentalError
+
+# 貸出処理の同時実行ストレステスト
+# 複数プロセスから、在庫の少ないDVDに対して貸出と返却を同時に繰り返し、
+# (a) 変更前: BEGIN（DEFERRED）で在庫を読んでから減らす方式 と
+# (b) 変更後: BEGIN IMMEDIATE + 条件付きUPDATE + 再試行（rentals.py）
+# のスループットとエラー件数を比較します。終了後に在庫が負になっていないこと、
+# 「在庫数 + 貸出中の件数 = 総在庫数」が保たれていることを検証します。
+
+N_USERS = 5000
+N_DVDS = 20
+STOCK_PER_DVD = 10
+
+def build_db(path):
+    init_db(path)
+    conn = sqlite3.connect(path)
+    conn.execute('DELETE FROM rentals')
+    conn.execute('DELETE FROM dvds')
+    conn.executemany('INSERT INTO users (name, address, phone, member_code) VALUES (?, ?, ?, ?)',
+                     [(f'会員{i}', '東京都', f'080-{i:08d}', f'S{i:06d}') for i in range(N_USERS)])
+    conn.executemany('INSERT INTO dvds (title, genre_id, stock_count, total_stock) VALUES (?, ?, ?, ?)',
+                     [(f'人気作{i}', 1, STOCK_PER_DVD, STOCK_PER_DVD) for i in range(N_DVDS)])
+    conn.commit()
+    conn.close()
+
+def legacy_checkout(conn, user_id, dvd_id):
+    """
+    変更前の rent_dvd と同じ処理。
+    """
+    try:
+        conn.execute('BEGIN TRANSACTION')
+        dvd = conn.execute('SELECT stock_count FROM dvds WHERE dvd_id = ?', (dvd_id,)).fetchone()
+        if not dvd or dvd[0] <= 0:
+            raise RentalError('在庫がありません。')
+        existing = conn.execute('SELECT * FROM rentals WHERE user_id = ? AND dvd_id = ? AND return_date IS NULL',
+                                (user_id, dvd_id)).fetchone()
+        if existing:
+            raise RentalError('このユーザーは既にこのDVDをレンタル中です。')
+        rental_id = conn.execute('INSERT INTO rentals (user_id, dvd_id) VALUES (?, ?)', (user_id, dvd_id)).lastrowid
+        conn.execute('UPDATE dvds SET stock_count = stock_count - 1 WHERE dvd_id = ?', (dvd_id,))
+        conn.commit()
+        return rental_id, dvd[0] - 1
+    except Exception:
+        conn.rollback()
+        raise
+
+def legacy_return(conn, rental_id):
+    """
+    変更前の return_dvd と同じ処理。
+    """
+    try:
+        conn.execute('BEGIN TRANSACTION')
+        rental = conn.execute('SELECT dvd_id FROM rentals WHERE rental_id = ?', (rental_id,)).fetchone()
+        conn.execute("UPDATE rentals SET return_date = CURRENT_TIMESTAMP, status = 'returned' WHERE rental_id = ?",
+                     (rental_id,))
+        conn.execute('UPDATE dvds SET stock_count = stock_count + 1 WHERE dvd_id = ?', (rental[0],))
+        conn.commit()
+    except Exception:
+        conn.rollback()
+        raise
+
+def worker(mode, path, seconds, seed, results):
+    rng = random.Random(seed)
+    pool = ConnectionPool(path)
+    rent, give_back = (checkout, return_rental) if mode == 'immediate' else (legacy_checkout, legacy_return)
+    rented = []
+    counts = {'checkouts': 0, 'returns': 0, 'rejected': 0, 'busy': 0}
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        conn = pool.connect()
+        try:
+            # 貸出中のものがあれば4割の確率で返却し、それ以外は貸出を試みます（返却に失敗した場合は後で再度返却します）
+            if rented and rng.random() < 0.4:
+                index = rng.randrange(len(rented))
+                give_back(conn, rented[index])
+                rented.pop(index)
+                counts['returns'] += 1
+            else:
+                rental_id, _ = rent(conn, rng.randint(1, N_USERS), rng.randint(1, N_DVDS))
+                rented.append(rental_id)
+                counts['checkouts'] += 1
+        except RentalError:
+            # 在庫切れ・重複貸出による正常な拒否
+            counts['rejected'] += 1
+        except sqlite3.OperationalError as e:
+            if not is_busy_error(e):
+                raise
+            counts['busy'] += 1
+        finally:
+            conn.close()
+    results.put(counts)
+
+def run(mode, workers, seconds):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench_checkout.db')
+        build_db(path)
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(mode, path, seconds, i, results)) for i in range(workers)]
+        for p in procs:
+            p.start()
+        stats = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+        conn = sqlite3.connect(path)
+        min_stock = conn.execute('SELECT MIN(stock_count) FROM dvds').fetchone()[0]
+        mismatched = conn.execute('''
+            SELECT COUNT(*) FROM dvds d
+            WHERE d.stock_count + (SELECT COUNT(*) FROM rentals r WHERE r.dvd_id = d.dvd_id AND r.return_date IS NULL)
+                  != d.total_stock
+        ''').fetchone()[0]
+        conn.close()
+
+    total = {key: sum(s[key] for s in stats) for key in stats[0]}
+    ok = min_stock >= 0 and mismatched == 0
+    print(f"{mode:>9} | {workers:>7} | {total['checkouts'] / seconds:>12.0f} | {total['returns'] / seconds:>10.0f} | "
+          f"{total['rejected']:>12} | {total['busy']:>10} | {min_stock:>9} | {'OK' if ok else 'BROKEN'}")
+    return ok
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='同時貸出のストレステスト（在庫が負にならないことを検証します）。')
+    parser.add_argument('--workers', type=int, default=8)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'mode':>9} | {'workers':>7} | {'checkouts/s':>12} | {'returns/s':>10} | {'rejected':>12} | "
+          f"{'busy fail':>10} | {'min stock':>9} | invariant")
+    print('-' * 100)
+    results = [run(mode, args.workers, args.seconds) for mode in ('legacy', 'immediate')]
+    sys.exit(0 if all(results) else 1)
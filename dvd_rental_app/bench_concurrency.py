@@ -0,0 +1,136 @@
+import sqlite3
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import multiprocessing
+from init_db import init_db
+from db import ConnectionPool
+
+# 同時アクセスの負荷試験
+# gunicornのワーカーを模した複数プロセスから、読み取り（ダッシュボード・DVD一覧相当）と
+# 書き込み（貸出・返却相当のトランザクション）を同時に実行し、
+# (a) 変更前: 既定のジャーナル（rollback journal）で毎回接続する方式 と
+# (b) 変更後: WAL + PRAGMA設定済みの接続プール（db.py）
+# のスループットと「database is locked」エラーの件数（読み取り・書き込み別）を比較します。
+# 書き込みは変更前の rent_dvd と同じく BEGIN（DEFERRED）で開始するため、読み取りから書き込みへの
+# ロックの昇格で失敗する場合は busy_timeout では待たずにエラーになります（WALでも発生します）。
+
+N_USERS = 1000
+N_DVDS = 2000
+
+def build_db(path, journal_mode):
+    init_db(path)
+    conn = sqlite3.connect(path)
+    conn.execute(f'PRAGMA journal_mode = {journal_mode}')
+    conn.executemany('INSERT INTO users (name, address, phone, member_code) VALUES (?, ?, ?, ?)',
+                     [(f'会員{i}', '東京都', f'080-{i:08d}', f'B{i:06d}') for i in range(N_USERS)])
+    conn.executemany('INSERT INTO dvds (title, genre_id, stock_count, total_stock, description) VALUES (?, ?, ?, ?, ?)',
+                     [(f'作品{i}', i % 4 + 1, 1000, 1000, f'説明文{i}') for i in range(N_DVDS)])
+    conn.commit()
+    conn.close()
+
+def legacy_connect(path):
+    """
+    変更前の get_db_connection と同じ、リクエストごとの新規接続。
+    """
+    conn = sqlite3.connect(path)
+    conn.row_factory = sqlite3.Row
+    return conn
+
+def read_op(conn, rng):
+    """
+    読み取り: DVD一覧の検索と貸出中一覧。
+    """
+    conn.execute('SELECT * FROM dvds WHERE genre_id = ? ORDER BY dvd_id LIMIT 50', (rng.randint(1, 4),)).fetchall()
+    conn.execute('''
+        SELECT r.*, d.title FROM rentals r JOIN dvds d ON r.dvd_id = d.dvd_id
+        WHERE r.return_date IS NULL ORDER BY r.rental_date DESC LIMIT 20
+    ''').fetchall()
+
+def write_op(conn, rng):
+    """
+    書き込み: 変更前の rent_dvd と同じ形のトランザクション（在庫の確認 → 貸出の追加 → 在庫の更新）。
+    """
+    dvd_id = rng.randint(1, N_DVDS)
+    conn.execute('BEGIN TRANSACTION')
+    conn.execute('SELECT stock_count FROM dvds WHERE dvd_id = ?', (dvd_id,)).fetchone()
+    conn.execute('INSERT INTO rentals (user_id, dvd_id) VALUES (?, ?)', (rng.randint(1, N_USERS), dvd_id))
+    conn.execute('UPDATE dvds SET stock_count = stock_count - 1 WHERE dvd_id = ?', (dvd_id,))
+    conn.commit()
+
+def worker(mode, path, seconds, write_ratio, seed, results):
+    rng = random.Random(seed)
+    pool = ConnectionPool(path, row_factory=sqlite3.Row) if mode == 'wal+pool' else None
+    reads = writes = read_locked = write_locked = 0
+    latencies = []
+    deadline = time.perf_counter() + seconds
+    while time.perf_counter() < deadline:
+        is_write = rng.random() < write_ratio
+        start = time.perf_counter()
+        conn = pool.connect() if pool else legacy_connect(path)
+        try:
+            if is_write:
+                write_op(conn, rng)
+                writes += 1
+            else:
+                read_op(conn, rng)
+                reads += 1
+        except sqlite3.OperationalError as e:
+            if 'locked' not in str(e) and 'busy' not in str(e):
+                raise
+            if is_write:
+                write_locked += 1
+            else:
+                read_locked += 1
+            conn.rollback()
+        finally:
+            conn.close()
+        latencies.append(time.perf_counter() - start)
+    results.put((reads, writes, read_locked, write_locked, latencies))
+
+def run(mode, workers, seconds, write_ratio):
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench_concurrency.db')
+        build_db(path, 'wal' if mode == 'wal+pool' else 'delete')
+        conn = sqlite3.connect(path)
+        initial_stock = conn.execute('SELECT SUM(stock_count) FROM dvds').fetchone()[0]
+        conn.close()
+        ctx = multiprocessing.get_context('spawn')
+        results = ctx.Queue()
+        procs = [ctx.Process(target=worker, args=(mode, path, seconds, write_ratio, i, results)) for i in range(workers)]
+        for p in procs:
+            p.start()
+        stats = [results.get() for _ in procs]
+        for p in procs:
+            p.join()
+
+        # 在庫数と貸出件数が一致していることを確認します（書き込みが失われていないこと）
+        conn = sqlite3.connect(path)
+        rented = conn.execute('SELECT COUNT(*) FROM rentals').fetchone()[0]
+        stock = initial_stock - conn.execute('SELECT SUM(stock_count) FROM dvds').fetchone()[0]
+        conn.close()
+
+    reads = sum(s[0] for s in stats)
+    writes = sum(s[1] for s in stats)
+    read_locked = sum(s[2] for s in stats)
+    write_locked = sum(s[3] for s in stats)
+    latencies = sorted(l for s in stats for l in s[4])
+    p99 = latencies[int(len(latencies) * 0.99) - 1] * 1000 if latencies else 0.0
+    print(f"{mode:>9} | {workers:>7} | {reads / seconds:>8.0f} | {writes / seconds:>9.0f} | {read_locked:>11} | "
+          f"{write_locked:>12} | {p99:>8.1f} | {'OK' if rented == stock == writes else 'MISMATCH'}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='読み書きの同時実行でジャーナルモードと接続方式を比較します。')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--seconds', type=float, default=5.0)
+    parser.add_argument('--write-ratio', type=float, default=0.2, help='書き込み操作の割合')
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'mode':>9} | {'workers':>7} | {'reads/s':>8} | {'writes/s':>9} | {'read locked':>11} | "
+          f"{'write locked':>12} | {'p99 (ms)':>8} | consistency")
+    print('-' * 94)
+    for mode in ('legacy', 'wal+pool'):
+        run(mode, args.workers, args.seconds, args.write_ratio)
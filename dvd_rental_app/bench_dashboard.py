@@ -0,0 +1,95 @@
+import sqlite3
+import os
+import sys
+import time
+import random
+import datetime
+import tempfile
+from init_db import init_db
+from stats import read_dashboard_stats, DashboardStats
+
+# ダッシュボード（index）の統計情報取得のベンチマーク
+# 貸出履歴の件数を増やしながら、変更前の7つの集計クエリと、集計テーブル（stats.py）からの読み取り、
+# さらにTTLキャッシュを通した場合の1回あたりの時間を比較します。
+
+SIZES = [int(arg) for arg in sys.argv[1:]] or [10000, 100000, 1000000]
+REPEAT = 20
+
+def legacy_dashboard(conn):
+    """
+    変更前の index() と同じ7つのクエリ。
+    """
+    today = datetime.date.today().strftime('%Y-%m-%d')
+    conn.execute('SELECT COUNT(*) FROM users').fetchone()
+    conn.execute('SELECT COUNT(*) FROM dvds').fetchone()
+    conn.execute('SELECT COUNT(*) FROM rentals WHERE return_date IS NULL').fetchone()
+    conn.execute('SELECT COUNT(*) FROM rentals WHERE date(rental_date) = ?', (today,)).fetchone()
+    conn.execute('''
+        SELECT COUNT(*) FROM rentals
+        WHERE return_date IS NULL
+        AND julianday('now') - julianday(rental_date) > 7
+    ''').fetchone()
+    conn.execute('''
+        SELECT g.name, COUNT(d.dvd_id) as count, SUM(d.stock_count) as total_stock
+        FROM genres g
+        LEFT JOIN dvds d ON g.genre_id = d.genre_id
+        GROUP BY g.genre_id
+    ''').fetchall()
+    conn.execute('''
+        SELECT r.*, u.name as user_name, d.title as dvd_title
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        ORDER BY r.rental_date DESC LIMIT 5
+    ''').fetchall()
+
+def build_db(path, n_rentals):
+    """
+    1,000人・5,000作品と、過去3年分に分散した n_rentals 件の貸出履歴（うち約2%が未返却）を登録します。
+    集計テーブルはトリガーで更新されます。
+    """
+    init_db(path)
+    rng = random.Random(0)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (name, address, phone, member_code) VALUES (?, ?, ?, ?)',
+                     [(f'会員{i}', '東京都', f'080-{i:08d}', f'B{i:06d}') for i in range(1000)])
+    conn.executemany('INSERT INTO dvds (title, genre_id, stock_count, total_stock) VALUES (?, ?, ?, ?)',
+                     [(f'作品{i}', rng.randint(1, 4), 3, 3) for i in range(5000)])
+    now = datetime.datetime.now()
+    rows = []
+    for _ in range(n_rentals):
+        rented = now - datetime.timedelta(minutes=rng.randint(0, 3 * 365 * 24 * 60))
+        returned = None if rng.random() < 0.02 else (rented + datetime.timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S')
+        rows.append((rng.randint(1, 1000), rng.randint(1, 5000), rented.strftime('%Y-%m-%d %H:%M:%S'),
+                     (rented + datetime.timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S'), returned))
+    conn.executemany('INSERT INTO rentals (user_id, dvd_id, rental_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)',
+                     rows)
+    conn.commit()
+    conn.close()
+
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        fn()
+    return (time.perf_counter() - start) / REPEAT * 1000
+
+if __name__ == '__main__':
+    print(f"{'rentals':>9} | {'legacy 7 queries (ms)':>21} | {'stats tables (ms)':>17} | {'TTL cache (ms)':>14}")
+    print('-' * 72)
+    for n in SIZES:
+        with tempfile.TemporaryDirectory() as tmp:
+            path = os.path.join(tmp, 'bench_dashboard.db')
+            build_db(path, n)
+
+            def connect():
+                conn = sqlite3.connect(path)
+                conn.row_factory = sqlite3.Row
+                return conn
+
+            conn = connect()
+            legacy_ms = timed(lambda: legacy_dashboard(conn))
+            stats_ms = timed(lambda: read_dashboard_stats(conn))
+            conn.close()
+            cache = DashboardStats(ttl=60)
+            cached_ms = timed(lambda: cache.get(connect))
+            print(f"{n:>9} | {legacy_ms:>21.2f} | {stats_ms:>17.3f} | {cached_ms:>14.4f}")
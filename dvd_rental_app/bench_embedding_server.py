@@ -0,0 +1,103 @@
+import os
+import sys
+import time
+import argparse
+import subprocess
+import multiprocessing
+from embedding_server import EmbeddingClient
+
+# 共有Embeddingサーバーの負荷試験
+# gunicornのワーカーを模した複数プロセスから encode を繰り返し呼び出し、
+# (a) 各プロセスがモデルをロードする従来方式 と (b) 共有サーバー経由 の
+# 合計メモリ使用量（RSS）とスループットを比較します。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+ADDRESS = os.path.join(BASE_DIR, 'bench_embedding.sock')
+QUERIES = ['泣ける名作', '家族で笑える', '宇宙を舞台にしたSF', 'ジブリ', '恋愛映画', 'ミステリー 犯人']
+
+def rss_mb(pid):
+    """
+    /proc から指定プロセスの常駐メモリ（RSS）をMB単位で取得します（Linuxのみ）。
+    """
+    with open(f'/proc/{pid}/status') as f:
+        for line in f:
+            if line.startswith('VmRSS:'):
+                return int(line.split()[1]) / 1024
+    return 0.0
+
+def worker(mode, requests, ready, start_event, results):
+    """
+    1ワーカー分の処理。モデルの準備が終わったら合図を待ち、requests回 encode を呼び出します。
+    """
+    if mode == 'local':
+        from vector_search import get_model
+        encoder = get_model()
+    else:
+        encoder = EmbeddingClient('unix:' + ADDRESS)
+    encoder.encode('warm up')
+    ready.put(os.getpid())
+    start_event.wait()
+
+    start = time.perf_counter()
+    for i in range(requests):
+        # 毎回異なるテキストにして、キャッシュの影響を受けないようにします
+        encoder.encode(f"{QUERIES[i % len(QUERIES)]} {os.getpid()} {i}")
+    elapsed = time.perf_counter() - start
+    results.put((os.getpid(), rss_mb(os.getpid()), elapsed))
+
+def run_mode(mode, workers, requests):
+    ctx = multiprocessing.get_context('spawn')
+    start_event = ctx.Event()
+    results = ctx.Queue()
+
+    server = None
+    if mode == 'server':
+        server = subprocess.Popen([sys.executable, os.path.join(BASE_DIR, 'embedding_server.py'), '--address', 'unix:' + ADDRESS])
+        client = EmbeddingClient('unix:' + ADDRESS)
+        for _ in range(600):
+            try:
+                client.ping()
+                break
+            except OSError:
+                time.sleep(0.1)
+
+    load_start = time.perf_counter()
+    ready = ctx.Queue()
+    procs = [ctx.Process(target=worker, args=(mode, requests, ready, start_event, results)) for _ in range(workers)]
+    for p in procs:
+        p.start()
+    # 全ワーカーの準備（モデルのロード、またはサーバーへの接続）が終わるまで待ちます
+    for _ in procs:
+        ready.get()
+    ready_sec = time.perf_counter() - load_start
+
+    start = time.perf_counter()
+    start_event.set()
+    stats = [results.get() for _ in procs]
+    wall = time.perf_counter() - start
+    for p in procs:
+        p.join()
+
+    total_rss = sum(rss for _, rss, _ in stats)
+    server_rss = 0.0
+    if server is not None:
+        server_rss = rss_mb(server.pid)
+        server.terminate()
+        server.wait()
+        if os.path.exists(ADDRESS):
+            os.unlink(ADDRESS)
+    total = workers * requests
+    print(f"{mode:>8} | {workers:>7} | {ready_sec:>9.1f} | {total_rss:>11.0f} | {server_rss:>10.0f} | "
+          f"{total_rss + server_rss:>9.0f} | {total / wall:>10.1f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='共有Embeddingサーバーの有無でメモリとスループットを比較します。')
+    parser.add_argument('--workers', type=int, default=4)
+    parser.add_argument('--requests', type=int, default=200, help='ワーカーあたりの encode 回数')
+    args = parser.parse_args(sys.argv[1:])
+
+    print(f"{'mode':>8} | {'workers':>7} | {'ready (s)':>9} | {'workers MB':>11} | {'server MB':>10} | "
+          f"{'total MB':>9} | {'encode/s':>10}")
+    print('-' * 82)
+    for mode in ('local', 'server'):
+        run_mode(mode, args.workers, args.requests)
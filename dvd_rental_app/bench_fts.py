@@ -0,0 +1,93 @@
+import sqlite3
+import os
+import sys
+import tempfile
+import time
+import random
+from init_db import init_db
+from dvd_search import keyword_search
+
+# キーワード検索のベンチマーク
+# 100k件のDVDを登録したDBで、変更前の LIKE '%query%' による全件走査と、
+# FTS5（trigram）の全文検索インデックス + BM25 を比較します。
+
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+REPEAT = 20
+WORDS = ['宇宙', '家族', '友情', '冒険', '魔法', '探偵', '戦争', '青春', '恋愛', '復讐', '未来', '時間旅行',
+         '刑務所', '豪華客船', 'ロボット', '王女', '新聞記者', 'ヒーロー', '殺人事件', 'スタジオジブリ',
+         '感動', '名作', '笑える', '泣ける', '少女', '少年', '父と娘', '夢の世界', '地球侵略', '田舎']
+QUERIES = ['スタジオジブリ', '時間旅行', '豪華客船 ロボット', '殺人事件', 'タイトル12345']
+
+def build_db(path, n):
+    """
+    init_db と同じスキーマ（FTSインデックスとトリガーを含む）に、n件のDVDを登録します。
+    """
+    init_db(path)
+    rng = random.Random(0)
+    # 実際のカタログに近づけるため、説明文の大半はランダムなカタカナ語（5000語）で構成し、
+    # 検索対象の語（WORDS）はそれぞれ一部のDVDにだけ含まれるようにします
+    katakana = [chr(c) for c in range(ord('ア'), ord('ン') + 1)]
+    vocabulary = [''.join(rng.choice(katakana) for _ in range(rng.randint(2, 5))) for _ in range(5000)]
+    conn = sqlite3.connect(path)
+    rows = []
+    for i in range(n):
+        title = f"タイトル{i} {rng.choice(vocabulary)}"
+        words = [rng.choice(vocabulary) for _ in range(30)]
+        if rng.random() < 0.3:
+            words[rng.randrange(len(words))] = rng.choice(WORDS)
+        description = '、'.join(words) + '。'
+        rows.append((title, rng.randint(1, 4), 1, 1, 'A-1', description))
+    conn.executemany('''
+        INSERT INTO dvds (title, genre_id, stock_count, total_stock, storage_location, description)
+        VALUES (?, ?, ?, ?, ?, ?)
+    ''', rows)
+    conn.commit()
+    conn.close()
+
+def like_title(conn, query):
+    """
+    変更前のキーワード検索（タイトルのみ、LIKEによる全件走査）。
+    """
+    return conn.execute('''
+        SELECT d.*, g.name as genre_name
+        FROM dvds d
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE d.title LIKE ?
+    ''', (f'%{query}%',)).fetchall()
+
+def like_title_description(conn, query):
+    """
+    FTSと同じくタイトルと説明文を対象にした場合の LIKE による全件走査。
+    """
+    return conn.execute('''
+        SELECT d.*, g.name as genre_name
+        FROM dvds d
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE d.title LIKE ? OR d.description LIKE ?
+    ''', (f'%{query}%', f'%{query}%')).fetchall()
+
+def timed(fn):
+    start = time.perf_counter()
+    for _ in range(REPEAT):
+        rows = fn()
+    return (time.perf_counter() - start) / REPEAT * 1000, len(rows)
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench_fts.db')
+        start = time.perf_counter()
+        build_db(path, N)
+        print(f"Built {N} DVDs (with FTS triggers) in {time.perf_counter() - start:.1f} sec")
+
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        print(f"{'query':>16} | {'LIKE title (ms)':>15} | {'LIKE title+desc (ms)':>20} | {'FTS5 BM25 (ms)':>14} | {'FTS hits':>8}")
+        print('-' * 86)
+        for query in QUERIES:
+            # 複数語のクエリは、LIKEでは先頭の語だけを使います
+            first = query.split()[0]
+            like_ms, _ = timed(lambda: like_title(conn, first))
+            like_all_ms, _ = timed(lambda: like_title_description(conn, first))
+            fts_ms, hits = timed(lambda: keyword_search(conn, query, limit=50))
+            print(f"{query:>16} | {like_ms:>15.2f} | {like_all_ms:>20.2f} | {fts_ms:>14.2f} | {hits:>8}")
+        conn.close()
@@ -0,0 +1,68 @@
+import sqlite3
+import os
+import sys
+import tempfile
+import time
+import numpy as np
+from vector_search import VectorSearch
+from ivf_index import default_nprobe
+
+# IVFインデックスの再現率 (recall@10) と検索レイテンシを、全件走査（exact）と比較します
+# 実際の文章ベクトルのように偏りのある分布を再現するため、クラスタ構造を持つ乱数ベクトルを使います
+DIM = 384
+N = int(sys.argv[1]) if len(sys.argv) > 1 else 100000
+TOPICS = 200
+QUERIES = 200
+K = 10
+NPROBES = [1, 2, 4, 8, 16, 32, 64]
+
+def make_vectors(rng, n):
+    centers = rng.standard_normal((TOPICS, DIM)).astype(np.float32)
+    topic = rng.integers(0, TOPICS, n)
+    return centers[topic] + 0.8 * rng.standard_normal((n, DIM)).astype(np.float32)
+
+def build_db(path, vectors):
+    VectorSearch(path)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO dvd_embeddings (dvd_id, embedding) VALUES (?, ?)',
+                     ((i + 1, v.tobytes()) for i, v in enumerate(vectors)))
+    conn.commit()
+    conn.close()
+
+def measure(fn, queries):
+    """
+    各クエリの結果（dvd_idのリスト）と、レイテンシ（ms）の平均・p99を返します。
+    """
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append([r['dvd_id'] for r in fn(q)])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.mean(latencies), np.percentile(latencies, 99)
+
+def run():
+    rng = np.random.default_rng(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench_ivf.db')
+        build_db(path, make_vectors(rng, N))
+        queries = make_vectors(rng, QUERIES)
+
+        vs = VectorSearch(path, index='ivf')
+        start = time.perf_counter()
+        vs.search_by_vector(queries[0], K)  # 行列の読み込みとインデックスの学習
+        print(f"N={N}, nlist={vs._ivf.nlist}, load + train: {(time.perf_counter() - start) * 1000:.0f} ms")
+
+        truth, exact_mean, exact_p99 = measure(lambda q: vs.search_by_vector(q, K, exact=True), queries)
+        print(f"{'mode':>12} | {'recall@10':>9} | {'mean (ms)':>9} | {'p99 (ms)':>9}")
+        print('-' * 50)
+        print(f"{'exact':>12} | {1.0:>9.3f} | {exact_mean:>9.2f} | {exact_p99:>9.2f}")
+
+        # 既定値（nlist から決めた nprobe）も計測します
+        for nprobe in sorted(set(NPROBES + [default_nprobe(vs._ivf.nlist)])):
+            found, mean, p99 = measure(lambda q: vs.search_by_vector(q, K, nprobe=nprobe), queries)
+            recall = np.mean([len(set(f) & set(t)) / K for f, t in zip(found, truth)])
+            label = 'nprobe=' + str(nprobe) + ('*' if nprobe == default_nprobe(vs._ivf.nlist) else '')
+            print(f"{label:>12} | {recall:>9.3f} | {mean:>9.2f} | {p99:>9.2f}")
+
+if __name__ == '__main__':
+    run()
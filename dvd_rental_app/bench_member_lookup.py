@@ -0,0 +1,89 @@
+import sqlite3
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+from init_db import init_db
+from members import lookup_members
+
+# 会員検索のベンチマーク
+# 大量の会員（既定100万人）を登録し、会員番号・電話番号・名前の前方一致検索について
+# (a) 変更前の方法に相当する LIKE '%...%' による検索 と
+# (b) members.lookup_members（インデックスの範囲検索）
+# の1回あたりの時間（中央値・p99）を比較します。
+
+SURNAMES = ['佐藤', '鈴木', '高橋', '田中', '伊藤', '渡辺', '山本', '中村', '小林', '加藤']
+GIVEN_NAMES = ['太郎', '花子', '一郎', '美咲', '翔太', '健太', '陽菜', '蓮', '結衣', '大輝']
+
+def build_db(path, n_members, rng):
+    init_db(path)
+    conn = sqlite3.connect(path)
+    conn.execute('DELETE FROM users')
+    rows = []
+    for i in range(n_members):
+        name = f'{rng.choice(SURNAMES)} {rng.choice(GIVEN_NAMES)}{i % 1000}'
+        phone = f'0{rng.choice((70, 80, 90))}-{i // 10000:04d}-{i % 10000:04d}'
+        rows.append((f'M{i:07d}', name, '東京都', phone))
+        if len(rows) == 100000:
+            conn.executemany('INSERT INTO users (member_code, name, address, phone) VALUES (?, ?, ?, ?)', rows)
+            rows = []
+    conn.executemany('INSERT INTO users (member_code, name, address, phone) VALUES (?, ?, ?, ?)', rows)
+    conn.commit()
+    conn.execute('ANALYZE')
+    conn.close()
+
+def like_lookup(conn, field, query, limit=10):
+    """
+    LIKE '%...%' による検索（全件走査）。電話番号は数字だけの入力でも見つかるよう記号を除いて比較します。
+    """
+    if field == 'phone':
+        column = "replace(phone, '-', '')"
+    else:
+        column = field
+    return conn.execute(f'SELECT * FROM users WHERE {column} LIKE ? LIMIT ?', (f'%{query}%', limit)).fetchall()
+
+def percentile(values, p):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * p))] * 1000
+
+def timed(fn, queries):
+    durations = []
+    for query in queries:
+        start = time.perf_counter()
+        fn(query)
+        durations.append(time.perf_counter() - start)
+    return percentile(durations, 0.5), percentile(durations, 0.99)
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='会員番号・電話番号・名前の前方一致検索の速度を比較します。')
+    parser.add_argument('--members', type=int, default=1000000)
+    parser.add_argument('--queries', type=int, default=200)
+    args = parser.parse_args(sys.argv[1:])
+
+    rng = random.Random(0)
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench_member_lookup.db')
+        start = time.perf_counter()
+        build_db(path, args.members, rng)
+        print(f"Built {args.members} members in {time.perf_counter() - start:.1f}s\n")
+
+        conn = sqlite3.connect(path)
+        conn.row_factory = sqlite3.Row
+        # 存在する会員の先頭数文字を入力した場合を想定します
+        samples = [rng.randrange(args.members) for _ in range(args.queries)]
+        cases = [
+            ('member_code', [f'M{i:07d}'[:6] for i in samples]),
+            ('phone', [f'0{rng.choice((70, 80, 90))}{i // 10000:04d}'[:7] for i in samples]),
+            ('name', [f'{rng.choice(SURNAMES)} {rng.choice(GIVEN_NAMES)}{i % 1000}' for i in samples]),
+        ]
+
+        print(f"{'field':>11} | {'LIKE p50 (ms)':>13} | {'LIKE p99 (ms)':>13} | {'range p50 (ms)':>14} | {'range p99 (ms)':>14}")
+        print('-' * 78)
+        for field, queries in cases:
+            # LIKEは遅いため、件数を減らして計測します
+            like_p50, like_p99 = timed(lambda q: like_lookup(conn, field, q), queries[:20])
+            range_p50, range_p99 = timed(lambda q: lookup_members(conn, q, [field]), queries)
+            print(f"{field:>11} | {like_p50:>13.2f} | {like_p99:>13.2f} | {range_p50:>14.3f} | {range_p99:>14.3f}")
+        conn.close()
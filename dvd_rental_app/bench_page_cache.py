@@ -0,0 +1,103 @@
+import sqlite3
+import os
+import sys
+import time
+import random
+import argparse
+import tempfile
+import datetime
+
+# 画面のキャッシュ（page_cache.py）の負荷試験
+# 会員・DVD・貸出履歴を登録したデータベースに対して、Flaskのテストクライアントから一覧画面を繰り返し取得し、
+# (a) キャッシュなし（PAGE_CACHE=0 相当。毎回クエリとテンプレートの描画）
+# (b) キャッシュあり（同じ ETag の描画結果を再利用）
+# (c) 条件付きGET（ブラウザ・nginx が If-None-Match を送り、304 で本文を返さない）
+# の1ワーカーあたりの req/s を比較します。--write-every N を指定すると、N回に1回書き込み（世代番号が進む）を行います。
+# 使い方: python bench_page_cache.py [--requests 2000] [--write-every 0]
+
+# app.py の読み込み時にディスクのクエリキャッシュを作らないようにします
+os.environ.setdefault('QUERY_CACHE_DB', '')
+
+from init_db import init_db
+from db import ConnectionPool
+import app as dvd_app
+
+N_USERS = 2000
+N_DVDS = 5000
+N_RENTALS = 50000
+PAGES = ['/', '/dvds', '/dvds?genre_id=2', '/genres', '/users', '/rental']
+
+def build_db(path):
+    """
+    会員・DVDと、過去1年分の貸出履歴（約5%が未返却）を登録します。
+    """
+    init_db(path)
+    rng = random.Random(0)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO users (name, address, phone, member_code) VALUES (?, ?, ?, ?)',
+                     [(f'会員{i}', '東京都', f'080-{i:08d}', f'B{i:06d}') for i in range(N_USERS)])
+    conn.executemany('INSERT INTO dvds (title, genre_id, stock_count, total_stock, description) VALUES (?, ?, ?, ?, ?)',
+                     [(f'作品{i}', i % 4 + 1, 3, 3, f'説明文{i}') for i in range(N_DVDS)])
+    now = datetime.datetime.utcnow()
+    rows = []
+    for _ in range(N_RENTALS):
+        rented = now - datetime.timedelta(minutes=rng.randint(0, 365 * 24 * 60))
+        returned = None if rng.random() < 0.05 else (rented + datetime.timedelta(days=3)).strftime('%Y-%m-%d %H:%M:%S')
+        rows.append((rng.randint(1, N_USERS), rng.randint(1, N_DVDS), rented.strftime('%Y-%m-%d %H:%M:%S'),
+                     (rented + datetime.timedelta(days=7)).strftime('%Y-%m-%d %H:%M:%S'), returned))
+    conn.executemany('INSERT INTO rentals (user_id, dvd_id, rental_date, due_date, return_date) VALUES (?, ?, ?, ?, ?)',
+                     rows)
+    conn.commit()
+    conn.close()
+
+def run(client, requests, conditional, write_every, path):
+    """
+    PAGES を順番に requests 回取得し、req/s とステータスごとの件数を返します。
+    :param conditional: Trueの場合、前回の ETag を If-None-Match で送ります
+    :param write_every: この回数ごとに書き込みを1回行います（0の場合は書き込みなし）
+    """
+    etags = {}
+    statuses = {}
+    writer = sqlite3.connect(path)
+    start = time.perf_counter()
+    for i in range(requests):
+        if write_every and i and i % write_every == 0:
+            writer.execute('UPDATE dvds SET storage_location = ? WHERE dvd_id = 1', (f'B-{i}',))
+            writer.commit()
+        page = PAGES[i % len(PAGES)]
+        headers = {'If-None-Match': etags[page]} if conditional and page in etags else {}
+        response = client.get(page, headers=headers)
+        statuses[response.status_code] = statuses.get(response.status_code, 0) + 1
+        if response.headers.get('ETag'):
+            etags[page] = response.headers['ETag']
+    elapsed = time.perf_counter() - start
+    writer.close()
+    return requests / elapsed, statuses
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='画面のキャッシュと ETag / 304 の有無で一覧画面の req/s を比較します。')
+    parser.add_argument('--requests', type=int, default=2000)
+    parser.add_argument('--write-every', type=int, default=0, help='この回数ごとに書き込みを1回行う（0で書き込みなし）')
+    args = parser.parse_args(sys.argv[1:])
+
+    with tempfile.TemporaryDirectory() as tmp:
+        path = os.path.join(tmp, 'bench_page_cache.db')
+        build_db(path)
+        dvd_app.db_pool = ConnectionPool(path, row_factory=sqlite3.Row)
+        client = dvd_app.app.test_client()
+        print(f"users={N_USERS}, dvds={N_DVDS}, rentals={N_RENTALS}, requests={args.requests}, "
+              f"write every={args.write_every or '-'}\n")
+        print(f"{'mode':>22} | {'req/s':>8} | {'speedup':>7} | {'hit rate':>8} | statuses")
+        print('-' * 72)
+
+        baseline = None
+        for label, enabled, conditional in (('no cache', False, False), ('page cache', True, False),
+                                            ('page cache + 304', True, True)):
+            dvd_app.PAGE_CACHE_ENABLED = enabled
+            dvd_app.page_cache = type(dvd_app.page_cache)(dvd_app.page_cache.max_entries)
+            dvd_app.dashboard_stats.invalidate()
+            client.get('/')  # テンプレートの読み込み
+            rate, statuses = run(client, args.requests, conditional, args.write_every, path)
+            baseline = baseline or rate
+            hit_rate = dvd_app.page_cache.stats()['hit_rate'] if enabled else 0.0
+            print(f"{label:>22} | {rate:>8.1f} | {rate / baseline:>6.1f}x | {hit_rate:>8.2f} | {statuses}")
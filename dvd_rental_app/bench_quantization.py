@@ -0,0 +1,98 @@
+import sqlite3
+import os
+import sys
+import shutil
+import argparse
+import tempfile
+import time
+import numpy as np
+from vector_search import VectorSearch
+
+# ベクトルの保存形式（float32 / float16 / int8）ごとの、メモリ・ディスクの使用量と再現率の比較
+# float32 の全件走査の結果を正解として、各形式の recall@10 と、float32 で re-rank した場合の recall@10、
+# 常駐行列のサイズ、dvd_vector.db のファイルサイズ（VACUUM後）、検索レイテンシを表示します。
+# --catalog に dvd_vector.db を指定すると、実際のカタログのベクトルで計測します（クエリはカタログから選んだベクトルにノイズを加えたもの）。
+# 省略時は bench_ivf.py と同じクラスタ構造を持つ乱数ベクトルを使います。
+
+DIM = 384
+TOPICS = 200
+K = 10
+RERANK = 50
+
+def make_vectors(rng, n, centers):
+    topic = rng.integers(0, len(centers), n)
+    return centers[topic] + 0.8 * rng.standard_normal((n, centers.shape[1])).astype(np.float32)
+
+def load_catalog(path):
+    """
+    既存の dvd_vector.db から float32 のベクトルを読み込みます（量子化済みの行は float32 に戻します）。
+    """
+    vs = VectorSearch(path, storage='float32')
+    vs._ensure_loaded()
+    return vs._ids.copy(), vs._matrix.copy()
+
+def build_db(path, ids, vectors):
+    VectorSearch(path, storage='float32')
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO dvd_embeddings (dvd_id, embedding) VALUES (?, ?)',
+                     ((int(i), v.tobytes()) for i, v in zip(ids, vectors)))
+    conn.commit()
+    conn.close()
+
+def measure(vs, queries):
+    """
+    各クエリの結果（dvd_idのリスト）と、レイテンシ（ms）の平均・p99を返します。
+    """
+    results, latencies = [], []
+    for q in queries:
+        start = time.perf_counter()
+        results.append([r['dvd_id'] for r in vs.search_by_vector(q, K, exact=True)])
+        latencies.append((time.perf_counter() - start) * 1000)
+    return results, np.mean(latencies), np.percentile(latencies, 99)
+
+def recall(found, truth):
+    return np.mean([len(set(f) & set(t)) / K for f, t in zip(found, truth)])
+
+def run(args):
+    rng = np.random.default_rng(0)
+    if args.catalog:
+        ids, vectors = load_catalog(args.catalog)
+        picks = rng.integers(0, len(vectors), args.queries)
+        queries = vectors[picks] + 0.05 * rng.standard_normal((args.queries, vectors.shape[1])).astype(np.float32)
+    else:
+        centers = rng.standard_normal((TOPICS, DIM)).astype(np.float32)
+        vectors = make_vectors(rng, args.vectors, centers)
+        ids = np.arange(1, len(vectors) + 1)
+        queries = make_vectors(rng, args.queries, centers)
+    k_text = f'recall@{K}'
+
+    with tempfile.TemporaryDirectory() as tmp:
+        base = os.path.join(tmp, 'float32.db')
+        build_db(base, ids, vectors)
+        print(f"N={len(vectors)}, dim={vectors.shape[1]}, queries={len(queries)}, rerank={RERANK}\n")
+        print(f"{'storage':>14} | {'RAM (MB)':>8} | {'disk (MB)':>9} | {k_text:>9} | {'mean (ms)':>9} | {'p99 (ms)':>8}")
+        print('-' * 74)
+
+        truth = None
+        for storage in ('float32', 'float16', 'int8'):
+            for rerank in ((0,) if storage == 'float32' else (0, RERANK)):
+                path = os.path.join(tmp, f'{storage}_{rerank}.db')
+                shutil.copy(base, path)
+                vs = VectorSearch(path, storage=storage, rerank=rerank)
+                vs.convert_storage()
+                vs.vacuum()
+                disk = os.path.getsize(path) / 1024 ** 2
+                ram = vs.memory_usage() / 1024 ** 2
+                vs.search_by_vector(queries[0], K)  # 行列の読み込み
+                found, mean, p99 = measure(vs, queries)
+                if truth is None:
+                    truth = found
+                label = storage if not rerank else f'{storage}+rerank'
+                print(f"{label:>14} | {ram:>8.1f} | {disk:>9.1f} | {recall(found, truth):>9.3f} | {mean:>9.2f} | {p99:>8.2f}")
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='ベクトルの保存形式ごとのメモリ・ディスク使用量と再現率を比較します。')
+    parser.add_argument('--vectors', type=int, default=100000, help='乱数ベクトルの件数（--catalog 省略時）')
+    parser.add_argument('--queries', type=int, default=200)
+    parser.add_argument('--catalog', help='計測に使う dvd_vector.db のパス')
+    run(parser.parse_args(sys.argv[1:]))
@@ -0,0 +1,46 @@
+import os
+import sys
+import json
+import subprocess
+
+# 起動モード（MODEL_STARTUP）ごとの起動時間ベンチマーク
+# 各モードで新しいPythonプロセスを起動し、app のimport（=ワーカーの起動）にかかる時間と、
+# 起動直後の最初のキーワード検索・AI検索のレイテンシを計測します。
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+MODES = ['lazy', 'preload']
+
+CHILD = r'''
+import sys, time, json
+start = time.perf_counter()
+import app
+import_sec = time.perf_counter() - start
+heavy_loaded = 'sentence_transformers' in sys.modules
+client = app.app.test_client()
+
+start = time.perf_counter()
+client.get('/dvds', query_string={'query': 'ジブリ', 'search_type': 'keyword'})
+keyword_ms = (time.perf_counter() - start) * 1000
+
+start = time.perf_counter()
+client.get('/dvds', query_string={'query': '家族で笑える', 'search_type': 'semantic'})
+semantic_ms = (time.perf_counter() - start) * 1000
+
+print(json.dumps({'import_sec': import_sec, 'heavy_loaded': heavy_loaded,
+                  'keyword_ms': keyword_ms, 'semantic_ms': semantic_ms}))
+'''
+
+def run(mode):
+    # クエリキャッシュの影響を除くため、ディスクキャッシュは無効にします
+    env = dict(os.environ, MODEL_STARTUP=mode, QUERY_CACHE_DB='')
+    out = subprocess.run([sys.executable, '-c', CHILD], cwd=BASE_DIR, env=env,
+                         capture_output=True, text=True, check=True).stdout
+    return json.loads(out.strip().splitlines()[-1])
+
+if __name__ == '__main__':
+    print(f"{'mode':>8} | {'startup (s)':>11} | {'model imported':>14} | {'1st keyword (ms)':>16} | {'1st semantic (ms)':>17}")
+    print('-' * 80)
+    for mode in MODES:
+        r = run(mode)
+        print(f"{mode:>8} | {r['import_sec']:>11.2f} | {str(r['heavy_loaded']):>14} | "
+              f"{r['keyword_ms']:>16.1f} | {r['semantic_ms']:>17.1f}")
@@ -0,0 +1,82 @@
+import sqlite3
+import os
+import tempfile
+import time
+import numpy as np
+from vector_search import VectorSearch
+
+# ベンチマーク設定
+# 実際のモデル（paraphrase-multilingual-MiniLM-L12-v2）と同じ384次元の乱数ベクトルを使用します
+DIM = 384
+SIZES = [1000, 10000, 100000]
+QUERIES = 20
+LIMIT = 20
+
+def build_db(path, n, rng):
+    """
+    n件のランダムなベクトルを持つdvd_embeddingsテーブルを作成します。
+    """
+    VectorSearch(path)
+    vectors = rng.standard_normal((n, DIM)).astype(np.float32)
+    conn = sqlite3.connect(path)
+    conn.executemany('INSERT INTO dvd_embeddings (dvd_id, embedding) VALUES (?, ?)',
+                     ((i + 1, vectors[i].tobytes()) for i in range(n)))
+    conn.commit()
+    conn.close()
+
+def legacy_search(db_path, query_embedding, limit):
+    """
+    変更前の VectorSearch.search と同じ処理（全件読み込み + Pythonループ）。
+    """
+    conn = sqlite3.connect(db_path)
+    rows = conn.execute('SELECT dvd_id, embedding FROM dvd_embeddings').fetchall()
+    conn.close()
+
+    results = []
+    for dvd_id, blob in rows:
+        doc_embedding = np.frombuffer(blob, dtype=np.float32)
+        norm_q = np.linalg.norm(query_embedding)
+        norm_d = np.linalg.norm(doc_embedding)
+        if norm_q == 0 or norm_d == 0:
+            score = 0
+        else:
+            score = np.dot(query_embedding, doc_embedding) / (norm_q * norm_d)
+        results.append({'dvd_id': dvd_id, 'score': float(score)})
+    results.sort(key=lambda x: x['score'], reverse=True)
+    return results[:limit]
+
+def time_per_query(fn, queries):
+    start = time.perf_counter()
+    for q in queries:
+        fn(q)
+    return (time.perf_counter() - start) / len(queries) * 1000
+
+def run():
+    rng = np.random.default_rng(0)
+    print(f"{'N':>8} | {'legacy (ms)':>12} | {'load (ms)':>10} | {'matrix (ms)':>12} | {'speedup':>8}")
+    print('-' * 62)
+    with tempfile.TemporaryDirectory() as tmp:
+        for n in SIZES:
+            path = os.path.join(tmp, f'bench_{n}.db')
+            build_db(path, n, rng)
+            queries = rng.standard_normal((QUERIES, DIM)).astype(np.float32)
+
+            # 変更前の実装は件数が多いと遅いため、クエリ数を減らして計測します
+            legacy_queries = queries[:max(1, QUERIES // (n // 1000))]
+            legacy_ms = time_per_query(lambda q: legacy_search(path, q, LIMIT), legacy_queries)
+
+            vs = VectorSearch(path)
+            start = time.perf_counter()
+            vs.search_by_vector(queries[0], LIMIT)  # 初回は行列の読み込みを含む
+            load_ms = (time.perf_counter() - start) * 1000
+            matrix_ms = time_per_query(lambda q: vs.search_by_vector(q, LIMIT), queries)
+
+            # 結果が変更前と一致することを確認
+            expected = [r['dvd_id'] for r in legacy_search(path, queries[0], LIMIT)]
+            actual = [r['dvd_id'] for r in vs.search_by_vector(queries[0], LIMIT)]
+            assert expected == actual, f"result mismatch at N={n}"
+
+            print(f"{n:>8} | {legacy_ms:>12.2f} | {load_ms:>10.2f} | {matrix_ms:>12.2f} | {legacy_ms / matrix_ms:>7.1f}x")
+
+if __name__ == '__main__':
+    run()
@@ -0,0 +1,138 @@
+import sqlite3
+import os
+import re
+import sys
+import tempfile
+from init_db import init_db
+from members import PHONE_DIGITS_SQL
+
+# よく実行されるクエリの実行計画チェック (#8 Tuning)
+# app.py の主要なクエリに EXPLAIN QUERY PLAN を実行し、rentals テーブルを全件走査（SCAN）している場合や、
+# 一覧・候補検索で ORDER BY のために全件を並べ替えている（TEMP B-TREE）場合は終了コード1で失敗します。
+# インデックスの削除やクエリの書き換えによる性能の劣化をデプロイ前に検出するためのものです。
+# 使い方: python check_query_plans.py [DBファイルのパス]（省略時は新しく作成した空のデータベースで確認します）
+
+# (名前, SQL, パラメータ)。app.py / stats.py のクエリと同じ形にしてください
+HOT_QUERIES = [
+    ('dashboard: overdue rentals',
+     "SELECT COUNT(*) FROM rentals WHERE return_date IS NULL AND due_date < datetime('now')", ()),
+    ('dashboard: recent rentals', '''
+        SELECT r.*, u.name as user_name, d.title as dvd_title,
+               r.return_date IS NULL AND r.due_date < datetime('now') as overdue
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        ORDER BY r.rental_date DESC LIMIT 5
+     ''', ()),
+    ('rental page: active rentals (keyset page)', '''
+        SELECT r.*, u.name as user_name, d.title as dvd_title, r.due_date < datetime('now') as overdue
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        WHERE r.return_date IS NULL
+        AND (r.rental_date, r.rental_id) < (?, ?)
+        ORDER BY r.rental_date DESC, r.rental_id DESC LIMIT ?
+     ''', ('2024-01-01 00:00:00', 1, 51)),
+    ('overdue report: keyset page', '''
+        SELECT r.rental_id, r.user_id, r.dvd_id, r.rental_date, r.due_date,
+               CAST(julianday('now') - julianday(r.due_date) AS INTEGER) as days_overdue,
+               u.name as user_name, u.phone as user_phone, d.title as dvd_title
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        WHERE r.return_date IS NULL AND r.due_date < datetime('now')
+        AND (r.due_date, r.rental_id) > (?, ?)
+        ORDER BY r.due_date, r.rental_id LIMIT ?
+     ''', ('2024-01-01 00:00:00', 1, 51)),
+    ('export: rental history chunk (date range)', '''
+        SELECT r.rental_id, r.rental_date, r.due_date, r.return_date, r.status,
+               r.user_id, u.member_code, u.name as user_name, r.dvd_id, d.title as dvd_title, g.name as genre_name
+        FROM rentals r
+        LEFT JOIN users u ON r.user_id = u.user_id
+        LEFT JOIN dvds d ON r.dvd_id = d.dvd_id
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE r.rental_date >= ? AND r.rental_date < ? AND (r.rental_date, r.rental_id) > (?, ?)
+        ORDER BY r.rental_date, r.rental_id
+        LIMIT ?
+     ''', ('2024-01-01', '2025-01-01', '2024-03-01 00:00:00', 1, 1000)),
+    ('export: rental history chunk (rented)', '''
+        SELECT r.rental_id, r.rental_date, r.due_date, r.return_date, r.status,
+               r.user_id, u.member_code, u.name as user_name, r.dvd_id, d.title as dvd_title, g.name as genre_name
+        FROM rentals r
+        LEFT JOIN users u ON r.user_id = u.user_id
+        LEFT JOIN dvds d ON r.dvd_id = d.dvd_id
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE r.return_date IS NULL AND (r.rental_date, r.rental_id) > (?, ?)
+        ORDER BY r.rental_date, r.rental_id
+        LIMIT ?
+     ''', ('2024-03-01 00:00:00', 1, 1000)),
+    ('users page: keyset page',
+     'SELECT * FROM users WHERE user_id < ? ORDER BY user_id DESC LIMIT ?', (100, 51)),
+    ('dvds page: genre keyset page', '''
+        SELECT d.*, g.name as genre_name, 0 as search_rank
+        FROM dvds d
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE 1 = 1 AND d.genre_id = ? AND d.dvd_id > ? ORDER BY d.dvd_id LIMIT ?
+     ''', (1, 100, 51)),
+    ('typeahead: dvd title prefix',
+     'SELECT dvd_id, title, stock_count FROM dvds WHERE title >= ? AND title < ? AND stock_count > 0 ORDER BY title LIMIT ?',
+     ('イン', 'イヴ', 10)),
+    ('member lookup: name prefix',
+     'SELECT *, ? as matched FROM users WHERE name >= ? AND name < ? ORDER BY name LIMIT ?', ('name', '山田', '山由', 10)),
+    ('member lookup: member_code prefix',
+     'SELECT *, ? as matched FROM users WHERE member_code >= ? AND member_code < ? ORDER BY member_code LIMIT ?',
+     ('member_code', 'M0001', 'M0002', 10)),
+    ('member lookup: phone digits prefix',
+     f'SELECT *, ? as matched FROM users WHERE {PHONE_DIGITS_SQL} >= ? AND {PHONE_DIGITS_SQL} < ? '
+     f'ORDER BY {PHONE_DIGITS_SQL} LIMIT ?', ('phone', '09012', '09013', 10)),
+    ('rent_dvd: duplicate check',
+     'SELECT * FROM rentals WHERE user_id = ? AND dvd_id = ? AND return_date IS NULL', (1, 1)),
+    ('delete_dvd: rental history',
+     'SELECT COUNT(*) FROM rentals WHERE dvd_id = ?', (1,)),
+    ('delete_user: rental history',
+     'SELECT COUNT(*) FROM rentals WHERE user_id = ?', (1,)),
+]
+
+# 全件走査とみなす実行計画の行（インデックスを使った SCAN ... USING INDEX は対象外）
+# rentals はクエリ内で r という別名でも参照されます
+FULL_SCAN = re.compile(r'^SCAN (rentals|r)$')
+# 並べ替えのために条件に合う行をすべて読む実行計画の行（LIMIT付きのページ分割・候補検索が遅くなります）
+FULL_SORT = re.compile(r'^USE TEMP B-TREE FOR (RIGHT PART OF |LAST TERM OF )?ORDER BY$')
+
+def explain(conn, sql, params):
+    """
+    EXPLAIN QUERY PLAN の各行の説明（detail列）を返します。
+    """
+    return [row[3] for row in conn.execute('EXPLAIN QUERY PLAN ' + sql, params)]
+
+def check_query_plans(conn):
+    """
+    HOT_QUERIES の実行計画を表示し、rentals を全件走査しているクエリ、
+    または ORDER BY のために全件を並べ替えているクエリの名前のリストを返します。
+    """
+    failures = []
+    for name, sql, params in HOT_QUERIES:
+        plan = explain(conn, sql, params)
+        scans = [detail for detail in plan if FULL_SCAN.match(detail) or FULL_SORT.match(detail)]
+        print(f"[{'NG' if scans else 'OK'}] {name}")
+        for detail in plan:
+            print(f"       {detail}")
+        if scans:
+            failures.append(name)
+    return failures
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        if len(sys.argv) > 1:
+            db_path = sys.argv[1]
+        else:
+            db_path = os.path.join(tmp, 'check_query_plans.db')
+            init_db(db_path)
+        conn = sqlite3.connect(db_path)
+        failures = check_query_plans(conn)
+        conn.close()
+
+    if failures:
+        print(f"\n{len(failures)} queries scan the rentals table or sort all rows: {', '.join(failures)}")
+        sys.exit(1)
+    print("\nAll hot queries use indexes.")
@@ -0,0 +1,64 @@
+import os
+import sys
+import sqlite3
+import tempfile
+
+# 画面とAPIのスモークチェック
+# 新しく作成した空のデータベースに対して、Flaskのテストクライアントから主な画面・APIを取得し、
+# 想定したステータスコードが返るかを確認します（不正な入力で500にならないことの確認を含みます）。
+# 1つでも異なる場合は終了コード1で失敗します。AI検索の確認ではモデル（またはEmbeddingサーバー）を使います。
+# 使い方: python check_routes.py
+
+# app.py の読み込み時にディスクのクエリキャッシュを作らないようにします
+os.environ.setdefault('QUERY_CACHE_DB', '')
+
+from init_db import init_db
+from db import ConnectionPool
+from vector_search import VectorSearch
+import app as dvd_app
+
+# (名前, URL, クエリパラメータ, 想定するステータス)
+CHECKS = [
+    ('dashboard', '/', {}, 200),
+    ('dvd list', '/dvds', {}, 200),
+    ('keyword search', '/dvds', {'query': '家族', 'search_type': 'keyword'}, 200),
+    ('semantic search', '/dvds', {'query': '家族で笑える', 'search_type': 'semantic'}, 200),
+    # 数値でないジャンルIDは絞り込みなしとして扱い、どちらの検索でもエラーにしません
+    ('keyword search, bad genre_id', '/dvds', {'query': '家族', 'search_type': 'keyword', 'genre_id': 'abc'}, 200),
+    ('semantic search, bad genre_id', '/dvds',
+     {'query': '家族で笑える', 'search_type': 'semantic', 'genre_id': 'abc'}, 200),
+    ('genres', '/genres', {}, 200),
+    ('users', '/users', {}, 200),
+    ('rental page', '/rental', {}, 200),
+    ('overdue rentals', '/api/rentals/overdue', {}, 200),
+    ('export, bad date', '/export/rentals', {'from': '2024-13-01'}, 400),
+    ('metrics', '/metrics', {}, 200),
+]
+
+def check_routes(client):
+    """
+    CHECKS の各URLを取得し、想定と異なるステータスを返したものの名前のリストを返します。
+    """
+    failures = []
+    for name, url, params, expected in CHECKS:
+        status = client.get(url, query_string=params).status_code
+        ok = status == expected
+        print(f"[{'OK' if ok else 'NG'}] {name}: {status}" + ('' if ok else f" (expected {expected})"))
+        if not ok:
+            failures.append(name)
+    return failures
+
+if __name__ == '__main__':
+    with tempfile.TemporaryDirectory() as tmp:
+        db_path = os.path.join(tmp, 'check_routes.db')
+        init_db(db_path)
+        dvd_app.db_pool = ConnectionPool(db_path, row_factory=sqlite3.Row)
+        dvd_app.vector_search = VectorSearch(os.path.join(tmp, 'check_routes_vector.db'),
+                                             encoder=dvd_app.vector_search.encoder)
+        failures = check_routes(dvd_app.app.test_client())
+        dvd_app.db_pool.close_all()
+
+    if failures:
+        print(f"\n{len(failures)} routes returned an unexpected status: {', '.join(failures)}")
+        sys.exit(1)
+    print("\nAll routes returned the expected status.")
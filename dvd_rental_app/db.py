@@ -0,0 +1,256 @@
+import os
+import queue
+import random
+import sqlite3
+import threading
+import time
+
+# SQLiteの接続管理
+# 接続ごとに WAL モードや busy_timeout などの PRAGMA を設定し、使い終わった接続はプールに戻して再利用します。
+# WAL モードでは読み取りと書き込みが互いをブロックしないため、複数のgunicornワーカーから同時にアクセスしても
+# 「database is locked」が起きにくくなります。プールはワーカー（プロセス）ごとに持ちます。
+
+# 書き込みロックを待つ最大時間 (ms)
+BUSY_TIMEOUT_MS = int(os.environ.get('SQLITE_BUSY_TIMEOUT_MS', 5000))
+# 接続ごとのページキャッシュ (KiB)。負の値はKiB単位の指定を意味します
+CACHE_SIZE_KIB = int(os.environ.get('SQLITE_CACHE_SIZE_KIB', 16384))
+# メモリマップで読み取る最大サイズ (bytes)
+MMAP_SIZE = int(os.environ.get('SQLITE_MMAP_SIZE', 256 * 1024 * 1024))
+# プールに保持する接続の最大数（スレッドごとに1本あれば十分です）
+POOL_SIZE = int(os.environ.get('SQLITE_POOL_SIZE', 8))
+# 書き込みトランザクション（run_write）の再試行の最大回数
+MAX_RETRIES = 5
+# 再試行の待ち時間（秒）。試行ごとに2倍にし、ワーカー同士が同時に再試行しないようランダムな揺らぎを加えます
+BACKOFF_BASE = 0.02
+BACKOFF_MAX = 0.5
+
+def configure(conn):
+    """
+    接続にPRAGMAを設定します。
+    - journal_mode=WAL: 読み取りが書き込みを待たず、書き込みも読み取りを待ちません（設定はDBファイルに保存されます）
+    - synchronous=NORMAL: WALではコミットごとのfsyncを省略しても、電源断以外でデータが壊れることはありません
+    - busy_timeout: 他の接続が書き込み中の場合、すぐにエラーにせず指定時間まで待ちます
+    - cache_size / mmap_size: 読み取りの多いクエリをメモリ上で処理します
+    """
+    conn.execute('PRAGMA journal_mode = WAL')
+    conn.execute('PRAGMA synchronous = NORMAL')
+    conn.execute(f'PRAGMA busy_timeout = {BUSY_TIMEOUT_MS}')
+    conn.execute(f'PRAGMA cache_size = -{CACHE_SIZE_KIB}')
+    conn.execute(f'PRAGMA mmap_size = {MMAP_SIZE}')
+    conn.execute('PRAGMA temp_store = MEMORY')
+    return conn
+
+def connect(db_path, row_factory=None):
+    """
+    PRAGMAを設定した新しい接続を返します（プールを使わないスクリプト用）。
+    """
+    conn = sqlite3.connect(db_path, timeout=BUSY_TIMEOUT_MS / 1000)
+    conn.row_factory = row_factory
+    return configure(conn)
+
+def is_busy_error(error):
+    """
+    ロックの競合（SQLITE_BUSY / SQLITE_LOCKED）によるエラーかどうかを判定します。
+    """
+    message = str(error).lower()
+    return isinstance(error, sqlite3.OperationalError) and ('locked' in message or 'busy' in message)
+
+def run_write(conn, func, retries=MAX_RETRIES):
+    """
+    func(conn) を BEGIN IMMEDIATE のトランザクション内で実行してコミットします。
+    ロックの競合で失敗した場合はロールバックし、指数バックオフで再試行します。
+    それ以外の例外（rentals.RentalError など）はロールバックしてそのまま送出します。
+    :param conn: DBへの接続
+    :param func: トランザクション内で実行する関数。戻り値をそのまま返します
+    :param retries: 再試行の最大回数
+    """
+    for attempt in range(retries + 1):
+        try:
+            conn.execute('BEGIN IMMEDIATE')
+            result = func(conn)
+            conn.commit()
+            return result
+        except Exception as e:
+            if conn.in_transaction:
+                conn.rollback()
+            if not is_busy_error(e) or attempt == retries:
+                raise
+            delay = min(BACKOFF_MAX, BACKOFF_BASE * (2 ** attempt))
+            time.sleep(delay * (0.5 + random.random()))
+
+class TracedCursor(sqlite3.Cursor):
+    """
+    execute と行の読み込みにかかった時間を、接続のトレーサーに知らせるカーソル。
+    sqlite3 の set_trace_callback はSQLの実行開始時に呼ばれるだけで時間が分からず、トリガー内の文でも呼ばれるため、
+    カーソルのメソッドの前後で時間を計ります。SELECTは読み込みの途中でも実行が進むため、読み込みの時間も含めます。
+    """
+    sql = None
+    # このクエリでここまでにかかった秒数と、遅いクエリとしてログに出したかどうか
+    elapsed = 0.0
+    slow_logged = False
+
+    def _report(self, start, first):
+        elapsed = time.perf_counter() - start
+        self.elapsed += elapsed
+        tracer = self.connection.tracer
+        if tracer is not None:
+            tracer(self, elapsed, first)
+
+    def execute(self, sql, *args):
+        self.sql, self.elapsed, self.slow_logged = sql, 0.0, False
+        start = time.perf_counter()
+        try:
+            return super().execute(sql, *args)
+        finally:
+            self._report(start, True)
+
+    def executemany(self, sql, *args):
+        self.sql, self.elapsed, self.slow_logged = sql, 0.0, False
+        start = time.perf_counter()
+        try:
+            return super().executemany(sql, *args)
+        finally:
+            self._report(start, True)
+
+    def fetchone(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchone()
+        finally:
+            self._report(start, False)
+
+    def fetchmany(self, *args):
+        start = time.perf_counter()
+        try:
+            return super().fetchmany(*args)
+        finally:
+            self._report(start, False)
+
+    def fetchall(self):
+        start = time.perf_counter()
+        try:
+            return super().fetchall()
+        finally:
+            self._report(start, False)
+
+    def __next__(self):
+        start = time.perf_counter()
+        try:
+            return super().__next__()
+        finally:
+            self._report(start, False)
+
+class PooledConnection(sqlite3.Connection):
+    """
+    close() を呼ぶと実際には閉じずにプールへ戻る接続。
+    sqlite3.Connection のサブクラスなので、既存の conn.execute / commit / close のコードはそのまま使えます。
+    """
+    pool = None
+    # プール内で待機中かどうか（close() の二重呼び出しで同じ接続を二度プールに戻さないため）
+    idle = False
+    # クエリの計測用。tracer(cursor, elapsed, first) を設定すると TracedCursor で実行します（metrics.QueryTracer）
+    tracer = None
+
+    def cursor(self, factory=None):
+        if factory is None:
+            factory = sqlite3.Cursor if self.tracer is None else TracedCursor
+        return super().cursor(factory)
+
+    def execute(self, sql, *args):
+        if self.tracer is None:
+            return super().execute(sql, *args)
+        return self.cursor(TracedCursor).execute(sql, *args)
+
+    def executemany(self, sql, *args):
+        if self.tracer is None:
+            return super().executemany(sql, *args)
+        return self.cursor(TracedCursor).executemany(sql, *args)
+
+    def close(self):
+        # トレーサーはリクエストごとのものなので、プールに戻す前に外します
+        self.tracer = None
+        if self.pool is None or not self.pool.release(self):
+            super().close()
+
+class ConnectionPool:
+    """
+    1つのDBファイルに対する接続のプール。
+    取り出した接続は取り出したスレッドだけで使い、使い終わったら close() でプールへ戻します。
+    fork後の子プロセス（gunicornのワーカー）では、親プロセスの接続を使わずに新しく接続します。
+    """
+    def __init__(self, db_path, row_factory=None, max_size=POOL_SIZE):
+        """
+        :param db_path: DBファイルのパス
+        :param row_factory: 接続に設定する row_factory（sqlite3.Row など）
+        :param max_size: プールに保持する接続の最大数。これを超えて返却された接続は閉じます
+        """
+        self.db_path = db_path
+        self.row_factory = row_factory
+        self.max_size = max_size
+        self._lock = threading.Lock()
+        self._inherited = []
+        self._reset()
+
+    def _reset(self):
+        # 新しく使った順に取り出す（LIFO）ことで、よく使う接続のキャッシュを温かいまま保ちます
+        self._idle = queue.LifoQueue(self.max_size)
+        self._pid = os.getpid()
+
+    def connect(self):
+        """
+        プールから接続を取り出します。空の場合は新しく接続します。
+        """
+        with self._lock:
+            if self._pid != os.getpid():
+                # fork前の接続は親プロセスと共有されているため使いません。
+                # 子プロセスで閉じると親の接続に影響しうるため、閉じずに参照だけ残します
+                self._inherited.append(self._idle)
+                self._reset()
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                conn = None
+        if conn is not None:
+            conn.idle = False
+        else:
+            # プール内の接続は複数のスレッドで順番に使うため、スレッドのチェックは無効にします
+            conn = sqlite3.connect(self.db_path, timeout=BUSY_TIMEOUT_MS / 1000,
+                                   check_same_thread=False, factory=PooledConnection)
+            configure(conn)
+            conn.pool = self
+        conn.row_factory = self.row_factory
+        return conn
+
+    def release(self, conn):
+        """
+        接続をプールに戻します。戻せなかった場合（プールが満杯、fork後など）はFalseを返します。
+        """
+        if conn.idle:
+            return True
+        if self._pid != os.getpid():
+            return False
+        try:
+            # 未確定のトランザクションが残っていれば取り消してから再利用します
+            if conn.in_transaction:
+                conn.rollback()
+        except sqlite3.Error:
+            return False
+        conn.idle = True
+        try:
+            self._idle.put_nowait(conn)
+        except queue.Full:
+            conn.idle = False
+            return False
+        return True
+
+    def close_all(self):
+        """
+        プール内の接続をすべて閉じます。
+        """
+        while True:
+            try:
+                conn = self._idle.get_nowait()
+            except queue.Empty:
+                return
+            conn.pool = None
+            conn.close()
@@ -0,0 +1,354 @@
+import os
+import io
+import sys
+import csv
+import time
+import sqlite3
+import argparse
+import datetime
+from db import connect, run_write
+
+# DVDカタログのCSV一括登録
+# 仕入れ先の一覧（数百タイトル）を、add_dvd の画面で1件ずつ登録する代わりにまとめて登録します。
+# - ジャンル名はファイル全体で1回だけ genres と突き合わせて genre_id にします（1行ごとの問い合わせはしません）
+# - 既存のDVDは、商品コード（product_code）がある行は商品コードで、ない行はタイトルで探します（find_matches）。
+#   商品コードのない行は、発売日があれば発売日が同じDVD（なければ発売日が空欄のDVD）、発売日が空欄なら
+#   同じタイトルのすべてのDVDが対象です。1件だけ見つかった場合は在庫を数量分追加して空欄でない項目を更新し、
+#   見つからない場合は新しく登録します。複数見つかった場合は、どのDVDか決められないためその行をエラーにします
+# - CHUNK_SIZE 行ごとに1つの書き込みトランザクション（BEGIN IMMEDIATE）で executemany します。
+#   取り込み中も貸出・返却などの書き込みはチャンクの合間に実行できます
+# - 入力の誤りは行番号とともに報告し、その行だけを飛ばして残りは登録します
+# - AI検索用のベクトル化は、dvds のトリガーが embedding_jobs に登録し、embed_worker.py がまとめて行います
+#   （--embed を指定すると、このスクリプトの最後にキューを処理します）
+# 使い方: python dvd_import.py catalog.csv [--create-genres] [--embed] [--dry-run] [--db PATH] [--vector-db PATH]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_DB_PATH = os.path.join(BASE_DIR, 'dvd_rental.db')
+VECTOR_DB_PATH = os.path.join(BASE_DIR, 'dvd_vector.db')
+
+# 1つのトランザクションで登録する行数
+CHUNK_SIZE = 500
+# アップロードできるファイルの最大サイズ（バイト）
+MAX_IMPORT_BYTES = 10 * 1024 * 1024
+FIELDS = ('product_code', 'title', 'genre', 'release_date', 'quantity', 'storage_location', 'description', 'loan_days')
+# 見出し行の別名（Excelで作った日本語の見出しにも対応します）
+HEADER_ALIASES = {
+    '商品コード': 'product_code', 'JANコード': 'product_code', 'jan': 'product_code',
+    'タイトル': 'title',
+    'ジャンル': 'genre', 'genre_name': 'genre',
+    '発売日': 'release_date',
+    '数量': 'quantity', '在庫数': 'quantity', 'stock_count': 'quantity',
+    '保管場所': 'storage_location',
+    '説明': 'description', '説明文': 'description',
+    '貸出日数': 'loan_days',
+}
+
+def decode_csv(data):
+    """
+    アップロードされたCSVのバイト列を文字列にします。UTF-8（BOM付きを含む）で読めない場合は、
+    日本語版のExcelが保存する Shift_JIS（cp932）として読みます。
+    """
+    try:
+        return data.decode('utf-8-sig')
+    except UnicodeDecodeError:
+        return data.decode('cp932')
+
+def read_rows(text):
+    """
+    CSVの各行を (行番号, {項目名: 値}) として返します。見出し行の項目名は FIELDS の名前にそろえます。
+    :raises ValueError: 見出し行に title（タイトル）がない場合
+    """
+    reader = csv.reader(io.StringIO(text))
+    header = next(reader, None)
+    if header is None:
+        return
+    names = [HEADER_ALIASES.get(name.strip(), name.strip().lower()) for name in header]
+    if 'title' not in names:
+        raise ValueError('見出し行に title（タイトル）の列がありません。')
+    for values in reader:
+        if not any(value.strip() for value in values):
+            continue
+        yield reader.line_num, {name: value.strip() for name, value in zip(names, values) if name in FIELDS}
+
+def _int_or_none(value, name, minimum):
+    if not value:
+        return None
+    try:
+        number = int(value)
+    except ValueError:
+        raise ValueError(f'{name}は整数で入力してください: {value}') from None
+    if number < minimum:
+        raise ValueError(f'{name}は{minimum}以上で入力してください: {value}')
+    return number
+
+def validate(raw):
+    """
+    1行分の値を検証し、登録用の値に変換します。
+    :return: product_code, title, genre, release_date, quantity, storage_location, description, loan_days の辞書
+    :raises ValueError: 入力に誤りがある場合（メッセージはそのまま結果に表示します）
+    """
+    title = raw.get('title', '')
+    if not title:
+        raise ValueError('タイトルが空です。')
+    release_date = raw.get('release_date') or None
+    if release_date:
+        try:
+            release_date = datetime.datetime.strptime(release_date.replace('/', '-'), '%Y-%m-%d').strftime('%Y-%m-%d')
+        except ValueError:
+            raise ValueError(f'発売日は YYYY-MM-DD 形式で入力してください: {release_date}') from None
+    return {
+        'product_code': raw.get('product_code') or None,
+        'title': title,
+        'genre': raw.get('genre') or None,
+        'release_date': release_date,
+        # 数量が空欄の場合は在庫を変えません（情報の更新のみ）
+        'quantity': _int_or_none(raw.get('quantity'), '数量', 0) or 0,
+        'storage_location': raw.get('storage_location') or None,
+        'description': raw.get('description') or None,
+        'loan_days': _int_or_none(raw.get('loan_days'), '貸出日数', 1),
+    }
+
+def find_matches(row, codes, titles):
+    """
+    行に対応する既存のDVDの dvd_id を返します。
+    商品コードがある行は商品コードが同じDVDです。ない行はタイトルが同じDVDのうち、
+    発売日がある行は発売日が同じDVD（なければ発売日が空欄のDVD）、発売日が空欄の行はすべてのDVDです。
+    :param codes: {商品コード: [dvd_id, ...]}
+    :param titles: {タイトル: [(dvd_id, 発売日), ...]}
+    :return: dvd_id のリスト（2件以上の場合は、どのDVDか決められません）
+    """
+    if row['product_code']:
+        return codes.get(row['product_code'], [])
+    candidates = titles.get(row['title'], [])
+    if not row['release_date']:
+        return [dvd_id for dvd_id, _ in candidates]
+    same_date = [dvd_id for dvd_id, release_date in candidates if release_date == row['release_date']]
+    return same_date or [dvd_id for dvd_id, release_date in candidates if not release_date]
+
+def duplicate_of(row, seen_codes, seen_titles):
+    """
+    ファイル内で同じ商品を指す前の行の行番号を返します（find_matches と同じ規則で判定します）。
+    :param seen_codes: {商品コード: 行番号}
+    :param seen_titles: {タイトル: {発売日: 行番号}}
+    :return: 行番号（重複がない場合はNone）
+    """
+    if row['product_code']:
+        return seen_codes.get(row['product_code'])
+    dates = seen_titles.get(row['title'], {})
+    if not row['release_date']:
+        return min(dates.values()) if dates else None
+    return dates.get(row['release_date'], dates.get(None))
+
+def resolve_genres(conn, names, create=False):
+    """
+    ジャンル名をまとめて genre_id にします（genres を1回だけ読みます）。
+    :param names: ファイルに出てくるジャンル名の集合
+    :param create: Trueの場合、登録されていないジャンルを追加します
+    :return: ({ジャンル名: genre_id}, 追加したジャンル名のリスト)
+    """
+    genre_ids = {name: genre_id for genre_id, name in conn.execute('SELECT genre_id, name FROM genres')}
+    missing = sorted(name for name in names if name not in genre_ids)
+    if not (create and missing):
+        return genre_ids, []
+
+    def insert(c):
+        c.executemany('INSERT INTO genres (name) VALUES (?)', [(name,) for name in missing])
+        placeholders = ','.join('?' * len(missing))
+        return {name: genre_id for genre_id, name in
+                c.execute(f'SELECT genre_id, name FROM genres WHERE name IN ({placeholders})', missing)}
+
+    genre_ids.update(run_write(conn, insert))
+    return genre_ids, missing
+
+def _find_existing(conn, rows):
+    """
+    チャンク内の行に対応する既存のDVDの候補を、商品コード・タイトルごとに1回の問い合わせで探します。
+    :return: ({商品コード: [dvd_id, ...]}, {タイトル: [(dvd_id, 発売日), ...]})
+    """
+    found_codes, found_titles = {}, {}
+    codes = sorted({row['product_code'] for row in rows if row['product_code']})
+    if codes:
+        for dvd_id, code in conn.execute(
+                f"SELECT dvd_id, product_code FROM dvds WHERE product_code IN ({','.join('?' * len(codes))})", codes):
+            found_codes.setdefault(code, []).append(dvd_id)
+    titles = sorted({row['title'] for row in rows if not row['product_code']})
+    if titles:
+        for dvd_id, title, release_date in conn.execute(
+                f"SELECT dvd_id, title, release_date FROM dvds WHERE title IN ({','.join('?' * len(titles))})", titles):
+            found_titles.setdefault(title, []).append((dvd_id, release_date))
+    return found_codes, found_titles
+
+def _write_chunk(conn, rows):
+    """
+    1チャンク分の行を登録・更新します（run_write のトランザクション内で実行）。
+    :param rows: (行番号, 検証済みの値, genre_id) のリスト
+    :return: (追加件数, 更新件数, エラーのリスト, {更新したdvd_id: (genre_id, 在庫あり)})
+    """
+    codes, titles = _find_existing(conn, [row for _, row, _ in rows])
+    inserts, updates, errors = [], [], []
+    for line, row, genre_id in rows:
+        matches = find_matches(row, codes, titles)
+        if len(matches) > 1:
+            errors.append({'line': line, 'title': row['title'],
+                           'error': f"該当するDVDが複数あります（dvd_id: {', '.join(map(str, matches))}）。"
+                                    '商品コードまたは発売日を指定してください。'})
+        elif matches:
+            # 空欄の項目は既存の値のまま、在庫は数量分を追加します
+            updates.append((row['title'], genre_id, row['release_date'], row['storage_location'], row['description'],
+                            row['loan_days'], row['quantity'], row['quantity'], matches[0]))
+        else:
+            inserts.append((row['product_code'], row['title'], genre_id, row['release_date'], row['quantity'],
+                            row['quantity'], row['storage_location'], row['description'], row['loan_days']))
+
+    if updates:
+        conn.executemany('''
+            UPDATE dvds SET title = ?, genre_id = COALESCE(?, genre_id), release_date = COALESCE(?, release_date),
+                            storage_location = COALESCE(?, storage_location), description = COALESCE(?, description),
+                            loan_days = COALESCE(?, loan_days), stock_count = COALESCE(stock_count, 0) + ?,
+                            total_stock = COALESCE(total_stock, 0) + ?
+            WHERE dvd_id = ?
+        ''', updates)
+    if inserts:
+        conn.executemany('''
+            INSERT INTO dvds (product_code, title, genre_id, release_date, stock_count, total_stock, storage_location,
+                              description, loan_days)
+            VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+        ''', inserts)
+
+    # 在庫の有無・ジャンルが変わった既存のDVDは、AI検索の絞り込み用の属性にも反映します（呼び出し側で実行）
+    attributes = {}
+    updated_ids = [update[-1] for update in updates]
+    if updated_ids:
+        for dvd_id, genre_id, stock_count in conn.execute(
+                f"SELECT dvd_id, genre_id, stock_count FROM dvds WHERE dvd_id IN ({','.join('?' * len(updated_ids))})",
+                updated_ids):
+            attributes[dvd_id] = (genre_id, (stock_count or 0) > 0)
+    return len(inserts), len(updates), errors, attributes
+
+def import_catalog(conn, text, create_genres=False, chunk_size=CHUNK_SIZE, dry_run=False):
+    """
+    CSVの内容をDVDカタログに登録します。
+    :param conn: dvd_rental.db への接続
+    :param text: CSVの内容（1行目は見出し行。title は必須、それ以外の FIELDS は任意）
+    :param create_genres: Trueの場合、登録されていないジャンルを追加します（Falseの場合はその行をエラーにします）
+    :param chunk_size: 1つのトランザクションで登録する行数
+    :param dry_run: Trueの場合は検証だけを行い、登録しません
+    :return: {'rows', 'inserted', 'updated', 'errors': [{'line', 'title', 'error'}], 'created_genres',
+              'elapsed', 'rows_per_sec', 'attributes': {dvd_id: (genre_id, in_stock)}}
+    :raises ValueError: 見出し行が正しくない場合
+    """
+    start = time.perf_counter()
+    result = {'rows': 0, 'inserted': 0, 'updated': 0, 'errors': [], 'created_genres': [], 'attributes': {}}
+
+    # 1回目: 全行を検証し、ファイル内の重複とジャンル名を集めます
+    valid = []
+    seen_codes, seen_titles = {}, {}
+    for line, raw in read_rows(text):
+        result['rows'] += 1
+        try:
+            row = validate(raw)
+        except ValueError as e:
+            result['errors'].append({'line': line, 'title': raw.get('title', ''), 'error': str(e)})
+            continue
+        previous = duplicate_of(row, seen_codes, seen_titles)
+        if previous is not None:
+            result['errors'].append({'line': line, 'title': row['title'],
+                                     'error': f'{previous}行目と同じ商品です（数量は1行にまとめてください）。'})
+            continue
+        if row['product_code']:
+            seen_codes[row['product_code']] = line
+        else:
+            seen_titles.setdefault(row['title'], {})[row['release_date']] = line
+        valid.append((line, row))
+
+    genre_ids, result['created_genres'] = resolve_genres(
+        conn, {row['genre'] for _, row in valid if row['genre']}, create_genres and not dry_run)
+    rows = []
+    for line, row in valid:
+        if row['genre'] and row['genre'] not in genre_ids and not create_genres:
+            result['errors'].append({'line': line, 'title': row['title'],
+                                     'error': f"ジャンル「{row['genre']}」は登録されていません。"})
+            continue
+        rows.append((line, row, genre_ids.get(row['genre'])))
+
+    # 2回目: チャンクごとに1つのトランザクションで登録します
+    if not dry_run:
+        for i in range(0, len(rows), chunk_size):
+            chunk = rows[i:i + chunk_size]
+            try:
+                outcomes = [run_write(conn, lambda c: _write_chunk(c, chunk))]
+            except sqlite3.IntegrityError:
+                # 制約違反の行を特定するため、このチャンクだけ1行ずつ登録し直します
+                outcomes = []
+                for item in chunk:
+                    try:
+                        outcomes.append(run_write(conn, lambda c: _write_chunk(c, [item])))
+                    except sqlite3.IntegrityError as e:
+                        result['errors'].append({'line': item[0], 'title': item[1]['title'], 'error': str(e)})
+            for inserted, updated, errors, attributes in outcomes:
+                result['inserted'] += inserted
+                result['updated'] += updated
+                result['errors'].extend(errors)
+                result['attributes'].update(attributes)
+
+    result['errors'].sort(key=lambda error: error['line'])
+    result['elapsed'] = time.perf_counter() - start
+    result['rows_per_sec'] = result['rows'] / result['elapsed'] if result['elapsed'] else 0.0
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(
+        description='仕入れ先のCSVからDVDをまとめて登録します。',
+        epilog='既存のDVDとの突き合わせ: 商品コードがある行は商品コードで探します。ない行はタイトルで探し、'
+               '発売日がある行は発売日が同じDVD（なければ発売日が空欄のDVD）、発売日が空欄の行は同じタイトルの'
+               'すべてのDVDが対象です。1件なら在庫を追加して更新、0件なら新規登録、'
+               '複数件なら商品コードか発売日の指定を求めるエラーにします。')
+    parser.add_argument('csv_path', help='CSVファイル（UTF-8 または Shift_JIS）')
+    parser.add_argument('--create-genres', action='store_true', help='登録されていないジャンルを追加する')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='1つのトランザクションで登録する行数')
+    parser.add_argument('--dry-run', action='store_true', help='検証だけを行い、登録しない')
+    parser.add_argument('--embed', action='store_true', help='登録後にベクトル化キューをこのプロセスで処理する')
+    parser.add_argument('--db', default=SQLITE_DB_PATH, help='dvd_rental.db のパス')
+    parser.add_argument('--vector-db', help='dvd_vector.db のパス（省略時は --db と同じディレクトリの dvd_vector.db）')
+    args = parser.parse_args(sys.argv[1:])
+    # 別のデータベースに取り込む場合も、ベクトルは既定の dvd_vector.db ではなくそのデータベースの隣に保存します
+    vector_db = args.vector_db or os.path.join(os.path.dirname(os.path.abspath(args.db)),
+                                               os.path.basename(VECTOR_DB_PATH))
+
+    with open(args.csv_path, 'rb') as f:
+        text = decode_csv(f.read())
+    conn = connect(args.db)
+    try:
+        result = import_catalog(conn, text, args.create_genres, args.chunk_size, args.dry_run)
+    except ValueError as e:
+        parser.error(str(e))
+    finally:
+        conn.close()
+
+    for error in result['errors']:
+        print(f"  line {error['line']}: {error['title']}: {error['error']}")
+    if result['created_genres']:
+        print(f"Created genres: {', '.join(result['created_genres'])}")
+    print(f"{'Checked' if args.dry_run else 'Imported'} {result['rows']} rows in {result['elapsed']:.2f}s "
+          f"({result['rows_per_sec']:.0f} rows/sec): {result['inserted']} inserted, {result['updated']} updated, "
+          f"{len(result['errors'])} errors")
+
+    if not args.dry_run and (result['inserted'] or result['updated']):
+        # 重いライブラリ（モデル・numpy）は、ベクトルDBを更新する場合にだけ読み込みます
+        from vector_search import VectorSearch
+        from embedding_server import EmbeddingClient
+        import embed_worker
+        server = os.environ.get('EMBEDDING_SERVER')
+        vs = VectorSearch(vector_db, encoder=EmbeddingClient(server) if server else None)
+        if result['attributes']:
+            vs.set_attributes(result['attributes'])
+        if args.embed:
+            conn = connect(args.db, row_factory=sqlite3.Row)
+            try:
+                while embed_worker.drain_once(conn, vs):
+                    pass
+                print(f"Embedding queue: {embed_worker.queue_status(conn)['pending']} pending")
+            finally:
+                conn.close()
+        else:
+            print("New descriptions will be embedded by embed_worker.py.")
@@ -0,0 +1,202 @@
+import re
+from pagination import prefix_range
+
+# DVD検索のロジック
+# キーワード検索は dvds_fts（FTS5 + trigram）の全文検索インデックスを使い、
+# タイトルと説明文の両方を対象に BM25 スコアで並べ替えます。
+# ハイブリッド検索は、キーワード検索とベクトル検索をそれぞれ独立に実行し、
+# 順位を Reciprocal Rank Fusion (RRF) で統合します。
+
+# trigram トークナイザーは3文字未満の語を索引から検索できません
+MIN_FTS_TERM_LENGTH = 3
+# BM25の列ごとの重み（title, description）。タイトルの一致を説明文より重視します
+BM25_WEIGHTS = (10.0, 1.0)
+
+# RRFの定数 k。大きいほど上位と下位の差が緩やかになります（一般的な既定値は60）
+RRF_K = 60
+# 各検索器から取得する候補数（統合前の深さ）
+LEXICAL_DEPTH = 100
+VECTOR_DEPTH = 100
+PER_PAGE = 10
+# 入力候補（typeahead）の最大件数
+SUGGEST_LIMIT = 10
+
+DVD_COLUMNS = '''
+    SELECT d.*, g.name as genre_name
+    FROM dvds d
+    LEFT JOIN genres g ON d.genre_id = g.genre_id
+'''
+
+def split_terms(query):
+    """
+    検索キーワードを空白（全角スペースを含む）で区切って返します。
+    """
+    return [term for term in re.split(r'\s+', query.strip()) if term]
+
+def fts_match_expression(terms):
+    """
+    FTS5のMATCH式を組み立てます。各語はフレーズとして引用し（記号などを演算子として解釈させない）、
+    すべての語を含むもの（AND）を検索します。
+    """
+    return ' '.join('"{}"'.format(term.replace('"', '""')) for term in terms)
+
+def keyword_search(conn, query, genre_id=None, limit=None, in_stock_only=False, after=None):
+    """
+    タイトルと説明文を対象にキーワード検索します。
+    3文字以上の語は全文検索インデックス（BM25順）を使い、2文字以下の語を含む場合は
+    インデックスで検索できないため LIKE による検索に切り替えます。
+    各行には並べ替えキー search_rank（小さいほど上位）が付き、(search_rank, dvd_id) の順に並びます。
+    :param conn: dvd_rental.db への接続
+    :param query: 検索キーワード（空の場合は全件をdvd_id順）
+    :param genre_id: ジャンルで絞り込む場合のgenre_id
+    :param limit: 取得する最大件数（Noneの場合は全件）
+    :param in_stock_only: Trueの場合は在庫のあるDVDだけを返します
+    :param after: キーセット方式のページ分割で、前のページの最後の行の [search_rank, dvd_id]
+    :return: dvds の行（genre_name, search_rank 付き）のリスト
+    """
+    terms = split_terms(query)
+    rank_params = []
+    params = []
+
+    if not terms:
+        # 全件表示はdvd_id順（ジャンルの絞り込みは idx_dvds_genre を使います）
+        rank = '0'
+        where = ' WHERE 1 = 1'
+    elif all(len(term) >= MIN_FTS_TERM_LENGTH for term in terms):
+        rank = 'bm25(dvds_fts, {}, {})'.format(*BM25_WEIGHTS)
+        where = ' JOIN dvds_fts ON dvds_fts.rowid = d.dvd_id WHERE dvds_fts MATCH ?'
+        params.append(fts_match_expression(terms))
+    else:
+        # 短い語は全件走査になりますが、タイトル一致を先に並べます
+        rank = '(d.title NOT LIKE ?)'
+        rank_params.append(f'%{terms[0]}%')
+        conditions = []
+        for term in terms:
+            conditions.append('(d.title LIKE ? OR d.description LIKE ?)')
+            params.extend([f'%{term}%', f'%{term}%'])
+        where = ' WHERE ' + ' AND '.join(conditions)
+
+    sql = f'''
+    SELECT d.*, g.name as genre_name, {rank} as search_rank
+    FROM dvds d
+    LEFT JOIN genres g ON d.genre_id = g.genre_id
+    ''' + where
+    params = rank_params + params
+
+    if genre_id:
+        sql += ' AND d.genre_id = ?'
+        params.append(genre_id)
+    if in_stock_only:
+        sql += ' AND d.stock_count > 0'
+    if after is not None:
+        if terms:
+            sql += f' AND ({rank}, d.dvd_id) > (?, ?)'
+            params.extend(rank_params + list(after))
+        else:
+            sql += ' AND d.dvd_id > ?'
+            params.append(after[1])
+    sql += ' ORDER BY search_rank, d.dvd_id' if terms else ' ORDER BY d.dvd_id'
+    if limit is not None:
+        sql += ' LIMIT ?'
+        params.append(limit)
+
+    return conn.execute(sql, params).fetchall()
+
+def suggest_dvds(conn, query, limit=SUGGEST_LIMIT, in_stock_only=True):
+    """
+    貸出画面のDVD入力欄の候補を返します。
+    数字だけの入力はdvd_idとして扱い、それ以外はタイトルの前方一致（idx_dvds_title の範囲検索）を先に、
+    3文字以上の場合は全文検索インデックスによる部分一致で残りを補います。
+    :param conn: dvd_rental.db への接続
+    :param query: 入力中の文字列
+    :param limit: 最大件数
+    :param in_stock_only: Trueの場合は在庫のあるDVDだけを返します
+    :return: dvds の行（dvd_id, title, stock_count）のリスト
+    """
+    query = query.strip()
+    if not query:
+        return []
+    stock = ' AND stock_count > 0' if in_stock_only else ''
+    rows = []
+    if query.isdigit():
+        rows += conn.execute('SELECT dvd_id, title, stock_count FROM dvds WHERE dvd_id = ?' + stock,
+                             (int(query),)).fetchall()
+    low, high = prefix_range(query)
+    rows += conn.execute('SELECT dvd_id, title, stock_count FROM dvds WHERE title >= ? AND title < ?' + stock +
+                         ' ORDER BY title LIMIT ?', (low, high, limit)).fetchall()
+    if len(rows) < limit and len(query) >= MIN_FTS_TERM_LENGTH:
+        rows += keyword_search(conn, query, limit=limit, in_stock_only=in_stock_only)
+
+    results = []
+    seen = set()
+    for row in rows:
+        if row['dvd_id'] not in seen:
+            seen.add(row['dvd_id'])
+            results.append(row)
+    return results[:limit]
+
+def reciprocal_rank_fusion(rankings, weights=None, k=RRF_K):
+    """
+    複数の順位リストを Reciprocal Rank Fusion で統合します。
+    各リストでの順位 r（1始まり）に対して weight / (k + r) を合計したスコアの降順で返します。
+    :param rankings: dvd_idのリスト（それぞれ順位順）のリスト
+    :param weights: 各リストの重み（省略時はすべて1.0）
+    :return: (dvd_id, score) のリスト（スコア降順、同点はdvd_id昇順）
+    """
+    weights = weights or [1.0] * len(rankings)
+    scores = {}
+    for ranking, weight in zip(rankings, weights):
+        for rank, dvd_id in enumerate(ranking, start=1):
+            scores[dvd_id] = scores.get(dvd_id, 0.0) + weight / (k + rank)
+    return sorted(scores.items(), key=lambda item: (-item[1], item[0]))
+
+def fetch_dvds(conn, dvd_ids):
+    """
+    指定したdvd_idのDVDを、渡した順序のまま取得します。
+    """
+    if not dvd_ids:
+        return []
+    placeholders = ','.join('?' * len(dvd_ids))
+    rows = conn.execute(DVD_COLUMNS + f' WHERE d.dvd_id IN ({placeholders})', list(dvd_ids)).fetchall()
+    by_id = {row['dvd_id']: row for row in rows}
+    return [by_id[dvd_id] for dvd_id in dvd_ids if dvd_id in by_id]
+
+def hybrid_search(conn, vector_search, query, genre_id=None, page=1, per_page=PER_PAGE,
+                  lexical_depth=LEXICAL_DEPTH, vector_depth=VECTOR_DEPTH, weights=(1.0, 1.0), in_stock_only=False):
+    """
+    キーワード検索（BM25）とベクトル検索をそれぞれ独立に実行し、RRFで統合した結果をページ単位で返します。
+    ジャンルと在庫の絞り込みは両方の検索器の内部で行うため、絞り込み後に結果が足りなくなることはありません。
+    ベクトル検索側は vector DB に保存した属性（genre_id, in_stock）で、上位k件を選ぶ前に絞り込みます。
+    :param conn: dvd_rental.db への接続
+    :param vector_search: VectorSearch のインスタンス
+    :param query: 検索キーワードや文章
+    :param genre_id: ジャンルで絞り込む場合のgenre_id（int。Noneの場合は絞り込みなし）
+    :param page: ページ番号（1始まり）
+    :param per_page: 1ページの件数
+    :param lexical_depth: キーワード検索から取得する候補数
+    :param vector_depth: ベクトル検索から取得する候補数
+    :param weights: (キーワード検索, ベクトル検索) の重み
+    :param in_stock_only: Trueの場合は在庫のあるDVDだけを返します
+    :return: {'dvds': 行のリスト, 'scores': {dvd_id: score}, 'total': 候補の総数, 'page', 'per_page', 'pages'}
+    """
+    lexical_ids = [row['dvd_id'] for row in
+                   keyword_search(conn, query, genre_id, limit=lexical_depth, in_stock_only=in_stock_only)]
+
+    vector_ids = [r['dvd_id'] for r in vector_search.search(query, limit=vector_depth,
+                                                            genre_id=genre_id,
+                                                            in_stock=True if in_stock_only else None)]
+
+    fused = reciprocal_rank_fusion([lexical_ids, vector_ids], weights)
+    total = len(fused)
+    pages = max(1, (total + per_page - 1) // per_page)
+    page = min(max(1, page), pages)
+    page_items = fused[(page - 1) * per_page:page * per_page]
+
+    return {
+        'dvds': fetch_dvds(conn, [dvd_id for dvd_id, _ in page_items]),
+        'scores': dict(page_items),
+        'total': total,
+        'page': page,
+        'per_page': per_page,
+        'pages': pages,
+    }
@@ -0,0 +1,153 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from vector_search import VectorSearch, enriched_text
+from embedding_server import EmbeddingClient
+from db import connect
+
+# ベクトル化キューの処理（バックグラウンドワーカー）
+# DVDの追加・更新時にトリガーで embedding_jobs に登録されたジョブを古い順にまとめて取り出し、
+# VectorSearch.add_many で1回の encode・1回のトランザクションでベクトル化して保存します。
+# 削除されたDVDや説明文が空になったDVDのジョブは、ベクトルを削除します（VectorSearch.remove_many）。
+# Webワーカー（add_dvd / edit_dvd）は保存後すぐに応答を返し、AI検索への反映はこのワーカーが数秒以内に行います。
+# 使い方: python embed_worker.py [--once]（docker-compose.yml の embed_worker サービスとして常駐させます）
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_DB_PATH = os.path.join(BASE_DIR, 'dvd_rental.db')
+VECTOR_DB_PATH = os.path.join(BASE_DIR, 'dvd_vector.db')
+
+# 1回に取り出すジョブの数（= 1回の encode にまとめるテキスト数）
+BATCH_SIZE = int(os.environ.get('EMBED_WORKER_BATCH', 64))
+# キューが空のときの確認間隔（秒）
+POLL_INTERVAL = float(os.environ.get('EMBED_WORKER_INTERVAL', 1.0))
+# この回数失敗したジョブは取り出さずに残します（last_error を確認して再登録してください）
+MAX_ATTEMPTS = 5
+
+def queue_status(conn):
+    """
+    ベクトル化キューの状況（AI検索が編集にどれだけ遅れているか）を返します。
+    :param conn: dvd_rental.db への接続
+    :return: {'pending': 未処理の件数, 'failed': MAX_ATTEMPTS回失敗した件数,
+              'oldest_enqueued_at': 最も古い未処理ジョブの登録時刻（UTC）, 'lag_seconds': その経過秒数}
+    """
+    row = conn.execute('''
+        SELECT COUNT(*), SUM(attempts >= ?), MIN(enqueued_at),
+               (julianday('now') - julianday(MIN(enqueued_at))) * 86400
+        FROM embedding_jobs
+    ''', (MAX_ATTEMPTS,)).fetchone()
+    return {
+        'pending': row[0],
+        'failed': row[1] or 0,
+        'oldest_enqueued_at': row[2],
+        'lag_seconds': round(row[3], 1) if row[3] is not None else 0.0,
+    }
+
+def fetch_jobs(conn, limit):
+    """
+    未処理のジョブを古い順に取り出し、ベクトル化に必要なDVDの情報と一緒に返します。
+    """
+    return conn.execute('''
+        SELECT j.dvd_id, j.version, d.dvd_id IS NOT NULL as found, d.title, d.description, d.genre_id,
+               d.stock_count, g.name as genre_name
+        FROM embedding_jobs j
+        LEFT JOIN dvds d ON j.dvd_id = d.dvd_id
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE j.attempts < ?
+        ORDER BY j.enqueued_at, j.dvd_id
+        LIMIT ?
+    ''', (MAX_ATTEMPTS, limit)).fetchall()
+
+def complete_jobs(conn, jobs):
+    """
+    処理したジョブを削除します。処理中にDVDが再度更新された（version が進んだ）ジョブは残し、次回もう一度処理します。
+    """
+    conn.executemany('DELETE FROM embedding_jobs WHERE dvd_id = ? AND version = ?',
+                     [(job['dvd_id'], job['version']) for job in jobs])
+    conn.commit()
+
+def fail_jobs(conn, jobs, error):
+    """
+    失敗したジョブの試行回数とエラー内容を記録します。
+    """
+    conn.executemany('UPDATE embedding_jobs SET attempts = attempts + 1, last_error = ? WHERE dvd_id = ? AND version = ?',
+                     [(str(error)[:500], job['dvd_id'], job['version']) for job in jobs])
+    conn.commit()
+
+def drain_once(conn, vector_search, batch_size=BATCH_SIZE):
+    """
+    キューから最大 batch_size 件を取り出してベクトル化します。
+    :param conn: dvd_rental.db への接続（row_factory = sqlite3.Row）
+    :param vector_search: VectorSearch のインスタンス
+    :return: 処理したジョブの件数（0の場合はキューが空、またはベクトル化に失敗）
+    """
+    jobs = fetch_jobs(conn, batch_size)
+    if not jobs:
+        return 0
+    targets = [job for job in jobs if job['found'] and job['description']]
+    # 削除済みのDVDや説明文のないDVDは、古いベクトルが検索結果の枠を使わないよう削除します
+    removals = [job['dvd_id'] for job in jobs if not (job['found'] and job['description'])]
+    items = [(job['dvd_id'], enriched_text(job['title'], job['genre_name'], job['description'])) for job in targets]
+    attributes = {job['dvd_id']: (job['genre_id'], (job['stock_count'] or 0) > 0) for job in targets}
+    try:
+        if removals:
+            vector_search.remove_many(removals)
+    except Exception as e:
+        print(f"Removing vectors failed for {len(removals)} DVDs: {e}")
+        fail_jobs(conn, [job for job in jobs if job['dvd_id'] in set(removals)], e)
+        return 0
+    try:
+        if items:
+            vector_search.add_many(items, batch_size=len(items), attributes=attributes)
+    except Exception as e:
+        # 失敗したジョブは試行回数を記録して残し、次の確認間隔の後に再試行します
+        print(f"Embedding failed for {len(items)} DVDs: {e}")
+        fail_jobs(conn, targets, e)
+        target_ids = {job['dvd_id'] for job in targets}
+        complete_jobs(conn, [job for job in jobs if job['dvd_id'] not in target_ids])
+        return 0
+    complete_jobs(conn, jobs)
+    return len(jobs)
+
+def run(vector_search, batch_size=BATCH_SIZE, interval=POLL_INTERVAL, once=False):
+    """
+    キューが空になるまで処理し、その後は interval 秒ごとに新しいジョブを確認します。
+    :param once: Trueの場合はキューが空になった時点で終了します
+    """
+    conn = None
+    while True:
+        try:
+            if conn is None:
+                conn = connect(SQLITE_DB_PATH, row_factory=sqlite3.Row)
+            start = time.perf_counter()
+            count = drain_once(conn, vector_search, batch_size)
+            if count:
+                elapsed = time.perf_counter() - start
+                print(f"Processed {count} embedding jobs in {elapsed:.2f}s "
+                      f"({count / elapsed if elapsed else 0:.1f} docs/sec), {queue_status(conn)['pending']} pending")
+                continue
+        except sqlite3.OperationalError as e:
+            # テーブルがまだない（init_db.py の実行前）場合やロックの競合は、少し待ってから再試行します
+            print(f"Embedding worker: {e}")
+            if conn is not None:
+                conn.close()
+                conn = None
+        if once:
+            break
+        time.sleep(interval)
+    if conn is not None:
+        conn.close()
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='embedding_jobs キューのDVDをまとめてベクトル化します。')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='1回に処理するジョブの数')
+    parser.add_argument('--interval', type=float, default=POLL_INTERVAL, help='キューが空のときの確認間隔（秒）')
+    parser.add_argument('--once', action='store_true', help='キューが空になったら終了する')
+    args = parser.parse_args(sys.argv[1:])
+
+    # EMBEDDING_SERVER が設定されていれば共有Embeddingサーバーを使い、このプロセスではモデルをロードしません
+    server = os.environ.get('EMBEDDING_SERVER')
+    vs = VectorSearch(VECTOR_DB_PATH, encoder=EmbeddingClient(server) if server else None)
+    print(f"Embedding worker started (batch size {args.batch_size}, interval {args.interval}s)")
+    run(vs, args.batch_size, args.interval, args.once)
@@ -0,0 +1,197 @@
+import os
+import sys
+import time
+import queue
+import argparse
+import threading
+import numpy as np
+from multiprocessing.connection import Listener, Client
+
+# 共有Embeddingサーバー
+# gunicornの各ワーカーがそれぞれモデルをロードする代わりに、1つのプロセスがモデルを保持し、
+# 全ワーカーからの encode リクエストをまとめて（マイクロバッチで）処理します。
+# 通信には multiprocessing.connection（Unixソケット または TCP + 認証キー）を使用します。
+
+DEFAULT_ADDRESS = '127.0.0.1:8765'
+DEFAULT_AUTHKEY = os.environ.get('EMBEDDING_SERVER_AUTHKEY', 'dvd-rental-embedding')
+# 1回の model.encode にまとめる最大テキスト数と、リクエストが揃うのを待つ最大時間
+MAX_BATCH = 64
+MAX_WAIT_MS = 5
+
+def parse_address(address):
+    """
+    'host:port' はTCPのアドレス、それ以外（'/tmp/embed.sock' や 'unix:/tmp/embed.sock'）はUnixソケットとして解釈します。
+    """
+    if address.startswith('unix:'):
+        return address[len('unix:'):]
+    host, sep, port = address.rpartition(':')
+    if sep and port.isdigit() and '/' not in address:
+        return (host, int(port))
+    return address
+
+class _Request:
+    """
+    バッチ処理キューに積まれる1件のリクエスト。処理が終わると event がセットされます。
+    """
+    def __init__(self, texts):
+        self.texts = texts
+        self.result = None
+        self.error = None
+        self.event = threading.Event()
+
+class EmbeddingServer:
+    """
+    モデルを1つだけ保持し、複数クライアントからの encode リクエストをマイクロバッチで処理するサーバー。
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY, max_batch=MAX_BATCH, max_wait_ms=MAX_WAIT_MS):
+        self.address = parse_address(address)
+        self.authkey = authkey.encode('utf-8')
+        self.max_batch = max_batch
+        self.max_wait = max_wait_ms / 1000
+        self._queue = queue.Queue()
+        # 処理状況の集計
+        self.batches = 0
+        self.texts = 0
+
+    def serve_forever(self):
+        """
+        モデルをロードしてから接続の受付を開始します。
+        """
+        # クライアント側（Webワーカー）がモデルのライブラリを読み込まないよう、サーバー起動時にimportします
+        from vector_search import get_model
+        self.model = get_model()
+        self.model.encode('warm up')
+
+        threading.Thread(target=self._batch_loop, daemon=True).start()
+        if isinstance(self.address, str) and os.path.exists(self.address):
+            os.unlink(self.address)
+        with Listener(self.address, authkey=self.authkey) as listener:
+            print(f"Embedding server listening on {self.address}")
+            while True:
+                try:
+                    conn = listener.accept()
+                except Exception as e:
+                    # 認証失敗などは接続単位のエラーとして扱い、サーバーは止めません
+                    print(f"Embedding server: rejected connection: {e}")
+                    continue
+                threading.Thread(target=self._handle, args=(conn,), daemon=True).start()
+
+    def _handle(self, conn):
+        """
+        1クライアント接続を処理します。リクエストはバッチキューに積み、結果が出るまで待って返します。
+        """
+        with conn:
+            while True:
+                try:
+                    message = conn.recv()
+                except (EOFError, OSError):
+                    return
+                command = message[0]
+                if command == 'ping':
+                    conn.send(('ok', None))
+                elif command == 'encode':
+                    request = _Request(list(message[1]))
+                    self._queue.put(request)
+                    request.event.wait()
+                    if request.error is not None:
+                        conn.send(('error', request.error))
+                    else:
+                        conn.send(('ok', request.result))
+                elif command == 'stats':
+                    conn.send(('ok', {'batches': self.batches, 'texts': self.texts}))
+                else:
+                    conn.send(('error', f"unknown command: {command}"))
+
+    def _batch_loop(self):
+        """
+        キューからリクエストを取り出し、max_batch件またはmax_wait経過までまとめてから一度に encode します。
+        """
+        while True:
+            pending = [self._queue.get()]
+            count = len(pending[0].texts)
+            deadline = time.monotonic() + self.max_wait
+            while count < self.max_batch:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    request = self._queue.get(timeout=timeout)
+                except queue.Empty:
+                    break
+                pending.append(request)
+                count += len(request.texts)
+
+            texts = [text for request in pending for text in request.texts]
+            try:
+                embeddings = np.asarray(self.model.encode(texts, batch_size=self.max_batch), dtype=np.float32)
+                offset = 0
+                for request in pending:
+                    request.result = embeddings[offset:offset + len(request.texts)]
+                    offset += len(request.texts)
+            except Exception as e:
+                for request in pending:
+                    request.error = str(e)
+            self.batches += 1
+            self.texts += len(texts)
+            for request in pending:
+                request.event.set()
+
+class EmbeddingClient:
+    """
+    EmbeddingServer に接続するクライアント。
+    SentenceTransformer と同じ encode() を持つため、VectorSearch のエンコーダーとしてそのまま使えます。
+    接続はスレッドごとに保持し、切断された場合は1回だけ再接続します。
+    """
+    def __init__(self, address=DEFAULT_ADDRESS, authkey=DEFAULT_AUTHKEY):
+        self.address = parse_address(address)
+        self.authkey = authkey.encode('utf-8')
+        self._local = threading.local()
+
+    def _connection(self):
+        conn = getattr(self._local, 'conn', None)
+        if conn is None:
+            conn = Client(self.address, authkey=self.authkey)
+            self._local.conn = conn
+        return conn
+
+    def _call(self, message):
+        for attempt in range(2):
+            try:
+                conn = self._connection()
+                conn.send(message)
+                status, payload = conn.recv()
+                break
+            except (EOFError, OSError):
+                # サーバーの再起動などで切断された場合は接続し直します
+                self._local.conn = None
+                if attempt == 1:
+                    raise
+        if status != 'ok':
+            raise RuntimeError(f"Embedding server error: {payload}")
+        return payload
+
+    def encode(self, texts, batch_size=None, **kwargs):
+        """
+        テキスト（または文字列のリスト）をベクトル化します。
+        :param texts: 文字列、または文字列のリスト
+        :param batch_size: 互換性のための引数（バッチサイズはサーバー側で決まります）
+        :return: 文字列の場合は1次元、リストの場合は2次元のベクトル
+        """
+        if isinstance(texts, str):
+            return self._call(('encode', [texts]))[0]
+        return self._call(('encode', list(texts)))
+
+    def ping(self):
+        self._call(('ping',))
+
+    def stats(self):
+        return self._call(('stats',))
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Embeddingモデルを共有するサーバーを起動します。')
+    parser.add_argument('--address', default=os.environ.get('EMBEDDING_SERVER', DEFAULT_ADDRESS),
+                        help="'host:port' または Unixソケットのパス")
+    parser.add_argument('--max-batch', type=int, default=MAX_BATCH, help='1回の encode にまとめる最大テキスト数')
+    parser.add_argument('--max-wait-ms', type=float, default=MAX_WAIT_MS, help='バッチが揃うのを待つ最大時間 (ms)')
+    args = parser.parse_args(sys.argv[1:])
+    EmbeddingServer(args.address, max_batch=args.max_batch, max_wait_ms=args.max_wait_ms).serve_forever()
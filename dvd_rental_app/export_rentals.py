@@ -0,0 +1,184 @@
+import os
+import io
+import sys
+import csv
+import json
+import time
+import argparse
+import datetime
+from db import ConnectionPool
+
+# 貸出履歴のエクスポート（CSV / NDJSON）
+# rentals を users・dvds・genres と結合した全履歴を、貸出日順にチャンク単位で読み込みながら書き出します。
+# - 読み込みは (rental_date, rental_id) のキーセット方式で、チャンクごとに接続を取り出して1つのSELECTだけを実行します。
+#   エクスポート全体で1つの読み取りトランザクションを持ち続けないため、WALのチェックポイントや書き込みを妨げません
+#   （そのため、エクスポート中に追加・返却された貸出は、読み込み位置によって含まれる場合と含まれない場合があります）。
+# - 書き出しはチャンクごとの文字列を返すジェネレータなので、履歴が1千件でも1千万件でもメモリ使用量は一定です。
+# app.py の /export/rentals と、このファイルのCLIの両方から使います。
+# 使い方: python export_rentals.py [--format csv|ndjson] [--from YYYY-MM-DD] [--to YYYY-MM-DD] [--status ...] [-o FILE]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_DB_PATH = os.path.join(BASE_DIR, 'dvd_rental.db')
+
+# 1回のSELECTで読み込む件数
+CHUNK_SIZE = 1000
+FORMATS = ('csv', 'ndjson')
+MIMETYPES = {'csv': 'text/csv', 'ndjson': 'application/x-ndjson'}
+# all: すべて / rented: 貸出中 / returned: 返却済み / overdue: 期限を過ぎて未返却
+STATUSES = ('all', 'rented', 'returned', 'overdue')
+COLUMNS = ['rental_id', 'rental_date', 'due_date', 'return_date', 'status', 'user_id', 'member_code', 'user_name',
+           'dvd_id', 'dvd_title', 'genre_name']
+
+def parse_date(value, name):
+    """
+    YYYY-MM-DD 形式の日付を検証して返します。
+    :param name: エラーメッセージに使う項目名
+    :return: datetime.date（空の場合はNone）
+    :raises ValueError: 日付の形式が正しくない場合
+    """
+    if not value:
+        return None
+    try:
+        return datetime.datetime.strptime(value, '%Y-%m-%d').date()
+    except ValueError:
+        raise ValueError(f'{name} は YYYY-MM-DD 形式で指定してください。') from None
+
+def build_filters(date_from=None, date_to=None, status='all'):
+    """
+    エクスポートの絞り込み条件を検証し、SQLの条件とパラメータにします。
+    :param date_from: この日以降に貸し出した履歴（YYYY-MM-DD、省略可）
+    :param date_to: この日までに貸し出した履歴（YYYY-MM-DD、当日を含む。省略可）
+    :param status: STATUSES のいずれか
+    :return: (条件のリスト, パラメータのリスト)
+    :raises ValueError: 日付・状態の指定が正しくない場合
+    """
+    status = status or 'all'
+    if status not in STATUSES:
+        raise ValueError(f"status は {', '.join(STATUSES)} のいずれかを指定してください。")
+    start = parse_date(date_from, 'from')
+    end = parse_date(date_to, 'to')
+    if start and end and start > end:
+        raise ValueError('from には to 以前の日付を指定してください。')
+
+    # rental_date は 'YYYY-MM-DD HH:MM:SS' の文字列なので、日付の範囲は文字列の範囲比較にしてインデックスを使います
+    conditions, params = [], []
+    if start:
+        conditions.append('r.rental_date >= ?')
+        params.append(start.strftime('%Y-%m-%d'))
+    if end:
+        conditions.append('r.rental_date < ?')
+        params.append((end + datetime.timedelta(days=1)).strftime('%Y-%m-%d'))
+    if status == 'rented':
+        conditions.append('r.return_date IS NULL')
+    elif status == 'returned':
+        conditions.append('r.return_date IS NOT NULL')
+    elif status == 'overdue':
+        conditions.append("r.return_date IS NULL AND r.due_date < datetime('now')")
+    return conditions, params
+
+def iter_chunks(connect, conditions=(), params=(), chunk_size=CHUNK_SIZE):
+    """
+    条件に合う貸出履歴を貸出日順に、チャンク（行のリスト）単位で読み込みます。
+    idx_rentals_rental_date（未返却のみの場合は idx_rentals_active_date）を (rental_date, rental_id) の順に
+    途中から読むため、何チャンク目でも一定の時間で読み込めます。
+    :param connect: DB接続を返す関数（チャンクごとに呼び出し、読み込み後すぐに閉じます）
+    """
+    after = None
+    while True:
+        where = list(conditions)
+        args = list(params)
+        if after:
+            where.append('(r.rental_date, r.rental_id) > (?, ?)')
+            args.extend(after)
+        sql = f'''
+            SELECT r.rental_id, r.rental_date, r.due_date, r.return_date, r.status,
+                   r.user_id, u.member_code, u.name as user_name, r.dvd_id, d.title as dvd_title, g.name as genre_name
+            FROM rentals r
+            LEFT JOIN users u ON r.user_id = u.user_id
+            LEFT JOIN dvds d ON r.dvd_id = d.dvd_id
+            LEFT JOIN genres g ON d.genre_id = g.genre_id
+            {'WHERE ' + ' AND '.join(where) if where else ''}
+            ORDER BY r.rental_date, r.rental_id
+            LIMIT ?
+        '''
+        conn = connect()
+        try:
+            rows = conn.execute(sql, args + [chunk_size]).fetchall()
+        finally:
+            conn.close()
+        if not rows:
+            return
+        yield rows
+        if len(rows) < chunk_size:
+            return
+        after = [rows[-1][1], rows[-1][0]]
+
+def format_chunk(rows, fmt):
+    """
+    行のリストを CSV / NDJSON の文字列にします。
+    """
+    if fmt == 'ndjson':
+        return ''.join(json.dumps(dict(zip(COLUMNS, row)), ensure_ascii=False) + '\n' for row in rows)
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\r\n').writerows(tuple(row) for row in rows)
+    return buffer.getvalue()
+
+def header(fmt):
+    """
+    エクスポートの先頭に書き出す文字列を返します。
+    CSVはExcelでそのまま開けるよう、UTF-8のBOMと見出し行を付けます（NDJSONは空文字列）。
+    """
+    if fmt != 'csv':
+        return ''
+    buffer = io.StringIO()
+    csv.writer(buffer, lineterminator='\r\n').writerow(COLUMNS)
+    return '\ufeff' + buffer.getvalue()
+
+def generate(connect, fmt='csv', conditions=(), params=(), chunk_size=CHUNK_SIZE):
+    """
+    エクスポートの内容を、先頭からチャンクごとの文字列として返すジェネレータ（Flaskのストリーミング応答用）。
+    """
+    yield header(fmt)
+    for rows in iter_chunks(connect, conditions, params, chunk_size):
+        yield format_chunk(rows, fmt)
+
+def export_filename(fmt, date_from=None, date_to=None, status='all'):
+    """
+    ダウンロード時のファイル名（例: rentals_2024-01-01_2024-12-31_returned.csv）を返します。
+    """
+    parts = ['rentals'] + [value for value in (date_from, date_to) if value]
+    if status and status != 'all':
+        parts.append(status)
+    return '_'.join(parts) + '.' + fmt
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='貸出履歴を会員・DVDの情報と結合して CSV / NDJSON で書き出します。')
+    parser.add_argument('--format', choices=FORMATS, default='csv')
+    parser.add_argument('--from', dest='date_from', help='この日以降に貸し出した履歴（YYYY-MM-DD）')
+    parser.add_argument('--to', dest='date_to', help='この日までに貸し出した履歴（YYYY-MM-DD、当日を含む）')
+    parser.add_argument('--status', choices=STATUSES, default='all')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='1回に読み込む件数')
+    parser.add_argument('--db', default=SQLITE_DB_PATH, help='dvd_rental.db のパス')
+    parser.add_argument('-o', '--output', help='出力先のファイル（省略時は標準出力）')
+    args = parser.parse_args(sys.argv[1:])
+
+    try:
+        conditions, params = build_filters(args.date_from, args.date_to, args.status)
+    except ValueError as e:
+        parser.error(str(e))
+    pool = ConnectionPool(args.db)
+    out = open(args.output, 'w', encoding='utf-8', newline='') if args.output else sys.stdout
+    start = time.perf_counter()
+    count = 0
+    try:
+        out.write(header(args.format))
+        for rows in iter_chunks(pool.connect, conditions, params, args.chunk_size):
+            out.write(format_chunk(rows, args.format))
+            count += len(rows)
+    finally:
+        if args.output:
+            out.close()
+    # 件数と時間は標準エラーに出し、標準出力に書き出した内容には混ぜません
+    elapsed = time.perf_counter() - start
+    print(f"Exported {count} rentals in {elapsed:.2f}s ({count / elapsed if elapsed else 0:.0f} rows/sec).",
+          file=sys.stderr)
@@ -0,0 +1,28 @@
+import os
+import metrics
+
+# gunicornの設定ファイル
+# MODEL_STARTUP=preload の場合は preload_app を有効にし、マスタープロセスでアプリ（モデルとベクトル行列）を
+# 読み込んでから fork します。各ワーカーはモデルをコピーオンライトで共有するため、
+# ワーカーごとのロード時間がなくなり、デプロイ直後の最初のAI検索も待たされません。
+bind = os.environ.get('GUNICORN_BIND', '0.0.0.0:8000')
+workers = int(os.environ.get('GUNICORN_WORKERS', 4))
+preload_app = os.environ.get('MODEL_STARTUP', 'lazy') == 'preload'
+
+# 計測値（metrics.py）を全ワーカーで合算するディレクトリ。app.py を読み込む前に設定します。
+# 既定はDBのパスから決めた一時ディレクトリで、同じホストの別のデプロイやスクリプトの値とは混ざりません
+os.environ.setdefault('METRICS_DIR', metrics.metrics_dir_for(
+    os.path.join(os.path.dirname(os.path.abspath(__file__)), 'dvd_rental.db')))
+
+def on_starting(server):
+    """
+    マスタープロセスの起動時に、前回の起動で各ワーカーが書き出した計測値（metrics.py）を削除します。
+    """
+    metrics.registry.set_directory(os.environ['METRICS_DIR'])
+    metrics.registry.clear_directory()
+
+def worker_exit(server, worker):
+    """
+    ワーカーの終了時（max_requests での再起動など）に、まだ書き出していない計測値を書き出します。
+    """
+    metrics.registry.flush()
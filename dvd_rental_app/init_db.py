@@ -1,8 +1,9 @@
 import sqlite3
 import os
+from migrations import migrate
 
-def init_db():
-    db_path = os.path.join(os.path.dirname(__file__), 'dvd_rental.db')
+def init_db(db_path=None):
+    db_path = db_path or os.path.join(os.path.dirname(__file__), 'dvd_rental.db')
     print(f"Initializing database at: {db_path}")
     conn = sqlite3.connect(db_path)
     cursor = conn.cursor()
@@ -71,6 +72,11 @@ def init_db():
         cursor.execute("INSERT INTO users (name, address, phone, birth_date, member_code) VALUES ('山田 太郎', '東京都新宿区', '090-1234-5678', '1990-01-01', 'M00001')")
 
     conn.commit()
+
+    # Indexes, triggers and other schema changes (#8 Tuning)
+    # 全文検索インデックス（FTS5 + trigram）や rentals のインデックスなどは、
+    # 既存のデータベースにも適用できるようマイグレーションとして管理しています（migrations.py）。
+    migrate(conn)
     conn.close()
     print("Database initialized successfully.")
 
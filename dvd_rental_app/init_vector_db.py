@@ -1,6 +1,10 @@
 import sqlite3
 import os
-from vector_search import VectorSearch
+import sys
+import time
+import argparse
+from vector_search import VectorSearch, enriched_text
+from db import connect
 
 # Database paths
 # データベースファイルのパス設定
@@ -8,50 +12,93 @@ BASE_DIR = os.path.dirname(os.path.abspath(__file__))
 SQLITE_DB_PATH = os.path.join(BASE_DIR, 'dvd_rental.db')
 VECTOR_DB_PATH = os.path.join(BASE_DIR, 'dvd_vector.db')
 
+# 一度に読み込み・保存するDVDの件数と、model.encode に渡すバッチサイズ
+CHUNK_SIZE = 256
+BATCH_SIZE = 64
+# 中断時に再開するためのチェックポイント（処理済みの最大dvd_id）を vector_meta に保存するキー
+CHECKPOINT_KEY = 'init_checkpoint'
+
 def get_db_connection():
     """
     RDB (dvd_rental.db) への接続を取得します。
     """
-    conn = sqlite3.connect(SQLITE_DB_PATH)
-    conn.row_factory = sqlite3.Row
-    return conn
+    return connect(SQLITE_DB_PATH, row_factory=sqlite3.Row)
+
+def iter_dvd_chunks(after_id, chunk_size):
+    """
+    RDBからDVDデータとジャンルを dvd_id 順にチャンク単位で読み込みます。
+    全件を一度にメモリへ載せないため、dvd_id をキーにしたページングで取得します。
+    """
+    conn = get_db_connection()
+    try:
+        while True:
+            rows = conn.execute('''
+                SELECT d.dvd_id, d.title, d.description, d.genre_id, d.stock_count, g.name as genre_name
+                FROM dvds d
+                LEFT JOIN genres g ON d.genre_id = g.genre_id
+                WHERE d.dvd_id > ?
+                ORDER BY d.dvd_id
+                LIMIT ?
+            ''', (after_id, chunk_size)).fetchall()
+            if not rows:
+                return
+            yield rows
+            after_id = rows[-1]['dvd_id']
+    finally:
+        conn.close()
 
-def init_vector_db():
+def init_vector_db(chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE, restart=False):
     """
     ベクトルデータベースを初期化し、既存のDVDデータを登録します。
-    RDBからDVD情報を取得し、整形したテキストをベクトル化してVector DBに保存します。
+    RDBからDVD情報をチャンク単位で取得し、整形したテキストをまとめてベクトル化してVector DBに保存します。
+    内容が変わっていないDVDはスキップし、中断した場合は前回のチェックポイントから再開します。
     """
     print("Initializing Vector Search DB...")
-    
+
     # 1. Vector Search機能（DB含む）の初期化
     vs = VectorSearch(VECTOR_DB_PATH)
-    
-    # 2. SQLite (RDB) からDVDデータとジャンルを取得
-    conn = get_db_connection()
-    dvds = conn.execute('''
-        SELECT d.dvd_id, d.title, d.description, g.name as genre_name 
-        FROM dvds d
-        LEFT JOIN genres g ON d.genre_id = g.genre_id
-    ''').fetchall()
-    conn.close()
-    
-    print(f"Found {len(dvds)} DVDs in SQLite.")
-    
-    count = 0
-    for dvd in dvds:
+
+    # 2. 前回中断していればチェックポイントから再開
+    after_id = 0 if restart else vs.get_meta(CHECKPOINT_KEY, 0)
+    if after_id:
+        print(f"Resuming from checkpoint: dvd_id > {after_id}")
+
+    # 3. SQLite (RDB) からチャンクごとに読み込み、まとめてベクトル化して保存
+    scanned = 0
+    stored = 0
+    start = time.perf_counter()
+    for rows in iter_dvd_chunks(after_id, chunk_size):
         # 説明文がない場合はスキップ
-        if not dvd['description']:
-            continue
-            
         # 検索精度向上のため、タイトル・ジャンル・説明文を自然言語形式で結合してベクトル化します
-        enriched_text = f"{dvd['title']}。ジャンルは{dvd['genre_name']}。{dvd['description']}"
-            
-        print(f"Vectorizing DVD {dvd['dvd_id']}: {dvd['title']}...")
-        # ベクトル化して保存
-        vs.add_dvd(dvd['dvd_id'], enriched_text)
-        count += 1
-    
-    print(f"Successfully vectorized and stored {count} DVD descriptions.")
+        items = [(dvd['dvd_id'], enriched_text(dvd['title'], dvd['genre_name'], dvd['description']))
+                 for dvd in rows if dvd['description']]
+        # 検索時の絞り込み（ジャンル・在庫あり）に使う属性も一緒に保存します
+        attributes = {dvd['dvd_id']: (dvd['genre_id'], (dvd['stock_count'] or 0) > 0) for dvd in rows if dvd['description']}
+
+        chunk_start = time.perf_counter()
+        # チャンクの保存とチェックポイントの更新は同じトランザクションで行います
+        written = vs.add_many(items, batch_size=batch_size, meta={CHECKPOINT_KEY: rows[-1]['dvd_id']},
+                              attributes=attributes)
+        chunk_elapsed = time.perf_counter() - chunk_start
+
+        scanned += len(rows)
+        stored += written
+        elapsed = time.perf_counter() - start
+        print(f"dvd_id <= {rows[-1]['dvd_id']}: vectorized {written}/{len(items)} "
+              f"({written / chunk_elapsed if chunk_elapsed else 0:.1f} docs/sec), "
+              f"total {stored} ({stored / elapsed if elapsed else 0:.1f} docs/sec)")
+
+    # 最後まで完了したらチェックポイントを消し、次回は先頭から（変更分のみ）処理します
+    vs.delete_meta(CHECKPOINT_KEY)
+    elapsed = time.perf_counter() - start
+    print(f"Scanned {scanned} DVDs in SQLite.")
+    print(f"Successfully vectorized and stored {stored} DVD descriptions "
+          f"in {elapsed:.1f} sec ({stored / elapsed if elapsed else 0:.1f} docs/sec).")
 
 if __name__ == "__main__":
-    init_vector_db()
+    parser = argparse.ArgumentParser(description='dvd_rental.db のDVDをベクトル化して dvd_vector.db に登録します。')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='1トランザクションで保存する件数')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='model.encode のバッチサイズ')
+    parser.add_argument('--restart', action='store_true', help='チェックポイントを無視して先頭から処理する')
+    args = parser.parse_args(sys.argv[1:])
+    init_vector_db(args.chunk_size, args.batch_size, args.restart)
@@ -0,0 +1,175 @@
+import os
+import numpy as np
+
+# IVF (Inverted File) 方式の近似最近傍探索インデックス
+# ベクトルをk-meansでnlist個のクラスタ（リスト）に分け、検索時はクエリに近い
+# nprobe個のクラスタに属するベクトルだけをスコア計算することで、全件走査を避けます。
+
+# 検索時に走査するクラスタ数の既定値は、クラスタ数から決めます（default_nprobe）。
+# nlist は sqrt(N) で増えるため、固定の値では件数が少ないほど走査する割合が小さくなり、再現率が下がります
+# （bench_ivf.py の recall@10 は、nprobe=16 で N=100,000 では 0.945 でしたが、N=5,000 では 0.796 でした）。
+# クラスタの NPROBE_FRACTION を、少なくとも MIN_NPROBE 個走査します。bench_ivf.py での recall@10 は
+# N=2,000: 0.968 / 5,000: 0.940 / 20,000: 0.922 / 100,000: 0.986 です。
+MIN_NPROBE = 32
+NPROBE_FRACTION = 0.05
+KMEANS_ITERATIONS = 10
+# k-meansの学習に使うサンプル数の上限（クラスタあたり）
+TRAIN_SAMPLES_PER_LIST = 64
+
+def default_nlist(n):
+    """
+    ベクトル件数からクラスタ数の目安（sqrt(N)）を返します。
+    """
+    return max(1, int(np.sqrt(n)))
+
+def default_nprobe(nlist):
+    """
+    クラスタ数から、検索時に走査するクラスタ数の既定値を返します。
+    """
+    return min(nlist, max(MIN_NPROBE, int(np.ceil(nlist * NPROBE_FRACTION))))
+
+def index_path_for(db_path):
+    """
+    ベクトルDB (dvd_vector.db) の隣に置くインデックスファイルのパスを返します。
+    """
+    return os.path.splitext(db_path)[0] + '.ivf.npz'
+
+class IVFIndex:
+    """
+    純NumPy実装のIVF-Flatインデックス。
+    ベクトル本体は保持せず、クラスタ中心（centroids）と、各dvd_idがどのクラスタに
+    属するか（ids / lists）だけを管理します。ベクトル本体は VectorSearch の常駐行列を使います。
+    """
+    def __init__(self, centroids, ids=None, lists=None, version=0):
+        """
+        コンストラクタ。
+        :param centroids: 正規化済みのクラスタ中心 (nlist, dim)
+        :param ids: 登録済みのdvd_id配列
+        :param lists: ids と同じ長さの、所属クラスタ番号の配列
+        :param version: このインデックスが対応するベクトルDBの世代番号
+        """
+        self.centroids = np.asarray(centroids, dtype=np.float32)
+        self.ids = np.asarray(ids if ids is not None else [], dtype=np.int64)
+        self.lists = np.asarray(lists if lists is not None else [], dtype=np.int32)
+        self.version = version
+
+    @property
+    def nlist(self):
+        return len(self.centroids)
+
+    @classmethod
+    def train(cls, ids, matrix, nlist=None, iterations=KMEANS_ITERATIONS, seed=0):
+        """
+        正規化済みのベクトル行列から球面k-meansでクラスタ中心を学習し、全件を割り当てます。
+        :param ids: dvd_id配列
+        :param matrix: 行ごとに正規化済みのベクトル行列 (N, dim)。
+                       量子化した行列（float16 / int8）も渡せます（クラスタの割り当てには各行の向きだけを使います）
+        :param nlist: クラスタ数（省略時は sqrt(N)）
+        """
+        n = len(matrix)
+        nlist = min(nlist or default_nlist(n), n)
+        rng = np.random.default_rng(seed)
+
+        # 学習は一部のサンプルで行い、件数が多くても数秒で終わるようにします
+        sample_size = min(n, nlist * TRAIN_SAMPLES_PER_LIST)
+        sample = np.asarray(matrix[rng.choice(n, sample_size, replace=False)], dtype=np.float32)
+        # int8の行は長さがそろっていないため、学習用のサンプルは正規化し直します
+        sample_norms = np.linalg.norm(sample, axis=1, keepdims=True)
+        sample_norms[sample_norms == 0] = 1.0
+        sample = sample / sample_norms
+        centroids = sample[rng.choice(sample_size, nlist, replace=False)].copy()
+
+        for _ in range(iterations):
+            assign = np.argmax(sample @ centroids.T, axis=1)
+            counts = np.bincount(assign, minlength=nlist)
+            # クラスタ番号順に並べ替えてから区間ごとに合計します（np.add.at より高速）
+            order = np.argsort(assign, kind='stable')
+            starts = np.concatenate([[0], np.cumsum(counts)[:-1]])
+            sums = np.zeros_like(centroids)
+            nonempty = counts > 0
+            sums[nonempty] = np.add.reduceat(sample[order], starts[nonempty], axis=0)
+            # 空になったクラスタは、ランダムなサンプルで初期化し直します
+            empty = counts == 0
+            if empty.any():
+                sums[empty] = sample[rng.choice(sample_size, int(empty.sum()), replace=False)]
+            norms = np.linalg.norm(sums, axis=1, keepdims=True)
+            norms[norms == 0] = 1.0
+            centroids = (sums / norms).astype(np.float32)
+
+        index = cls(centroids)
+        index.ids = np.asarray(ids, dtype=np.int64).copy()
+        index.lists = index.assign(matrix)
+        return index
+
+    def assign(self, vectors):
+        """
+        各ベクトルに最も近いクラスタ番号を返します。
+        """
+        vectors = np.asarray(vectors).reshape(-1, self.centroids.shape[1])
+        lists = np.empty(len(vectors), dtype=np.int32)
+        # 大量のベクトルでも一時メモリが膨らまないよう分割して計算します（float16 / int8 の行列も分割ごとに変換します）
+        for start in range(0, len(vectors), 8192):
+            chunk = vectors[start:start + 8192].astype(np.float32)
+            lists[start:start + len(chunk)] = np.argmax(chunk @ self.centroids.T, axis=1)
+        return lists
+
+    def add_many(self, ids, vectors):
+        """
+        複数のベクトルをインデックスに追加（既存のdvd_idは所属クラスタを更新）します。
+        :param ids: 重複のないdvd_id配列
+        :param vectors: 正規化済みのベクトル (len(ids), dim)
+        """
+        ids = np.asarray(ids, dtype=np.int64)
+        lists = self.assign(vectors)
+        if len(self.ids):
+            sorter = np.argsort(self.ids)
+            loc = np.minimum(np.searchsorted(self.ids, ids, sorter=sorter), len(self.ids) - 1)
+            found = self.ids[sorter[loc]] == ids
+            self.lists[sorter[loc[found]]] = lists[found]
+            ids, lists = ids[~found], lists[~found]
+        self.ids = np.concatenate([self.ids, ids])
+        self.lists = np.concatenate([self.lists, lists])
+
+    def remove_many(self, ids):
+        """
+        指定したdvd_idをインデックスから取り除きます（クラスタの中心は変えません）。
+        :return: 取り除いた件数
+        """
+        keep = ~np.isin(self.ids, np.asarray(list(ids), dtype=np.int64))
+        removed = len(self.ids) - int(keep.sum())
+        self.ids, self.lists = self.ids[keep], self.lists[keep]
+        return removed
+
+    def probe(self, query, nprobe=None):
+        """
+        クエリに近い順にnprobe個のクラスタ番号を返します。
+        :param nprobe: 走査するクラスタ数（省略時は default_nprobe）
+        """
+        if nprobe is None:
+            nprobe = default_nprobe(self.nlist)
+        sims = self.centroids @ query
+        nprobe = min(max(1, nprobe), self.nlist)
+        if nprobe == self.nlist:
+            return np.arange(self.nlist)
+        return np.argpartition(-sims, nprobe - 1)[:nprobe]
+
+    def save(self, path):
+        """
+        インデックスをファイルに保存します。
+        一時ファイルに書き出してから置き換えるため、読み込み中の他プロセスが壊れたファイルを見ることはありません。
+        """
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'wb') as f:
+            np.savez(f, centroids=self.centroids, ids=self.ids, lists=self.lists,
+                     version=np.int64(self.version))
+        os.replace(tmp_path, path)
+
+    @classmethod
+    def load(cls, path):
+        """
+        保存済みのインデックスを読み込みます。ファイルがない場合はNoneを返します。
+        """
+        if not os.path.exists(path):
+            return None
+        with np.load(path) as data:
+            return cls(data['centroids'], data['ids'], data['lists'], int(data['version']))
@@ -0,0 +1,79 @@
+import re
+from pagination import prefix_range
+
+# 会員の検索
+# カウンターで会員カードの会員番号・電話番号・名前から会員を探すための処理です。
+# 前方一致はすべてインデックスの範囲検索（col >= ? AND col < ?）で行い、LIKE '%...%' による全件走査はしません。
+# - 会員番号: UNIQUE 制約のインデックス（大文字にそろえて検索します）
+# - 電話番号: ハイフンなどの記号を除いた数字列の式インデックス idx_users_phone_digits
+# - 名前: idx_users_name
+
+LOOKUP_LIMIT = 10
+MAX_LOOKUP_LIMIT = 50
+# APIで返す列
+MEMBER_FIELDS = ('user_id', 'member_code', 'name', 'phone', 'matched')
+
+# 電話番号から記号を除いた数字列の式。idx_users_phone_digits と同じ式でなければインデックスは使われません
+PHONE_DIGITS_SQL = "replace(replace(replace(replace(replace(phone, '-', ''), ' ', ''), '(', ''), ')', ''), '+', '')"
+
+# 検索対象の列ごとの (WHERE句の式, 並べ替えの式)
+LOOKUP_FIELDS = {
+    'member_code': ('member_code', 'member_code'),
+    'phone': (PHONE_DIGITS_SQL, PHONE_DIGITS_SQL),
+    'name': ('name', 'name'),
+}
+
+PHONE_PATTERN = re.compile(r'^[\d\-\s()+]+$')
+
+def normalize(field, query):
+    """
+    検索語を列の保存形式にそろえます（会員番号は大文字、電話番号は数字だけ）。
+    """
+    query = query.strip()
+    if field == 'member_code':
+        return query.upper()
+    if field == 'phone':
+        return re.sub(r'\D', '', query)
+    return query
+
+def detect_fields(query):
+    """
+    入力の形から検索対象の列を決めます。
+    数字と記号だけの入力は電話番号、それ以外は会員番号と名前を検索します。
+    """
+    if PHONE_PATTERN.match(query.strip()):
+        return ['phone']
+    return ['member_code', 'name']
+
+def lookup_members(conn, query, fields=None, limit=LOOKUP_LIMIT):
+    """
+    会員番号・電話番号・名前の前方一致で会員を検索します。
+    列ごとにインデックスの範囲検索を LIMIT 付きで実行するため、会員数に関係なく読む行は最大で 列数 * limit 件です。
+    :param conn: dvd_rental.db への接続
+    :param query: 入力された文字列
+    :param fields: 検索する列のリスト（'member_code', 'phone', 'name'）。省略時は入力の形から決めます
+    :param limit: 最大件数
+    :return: users の行（全列と matched）のリスト。
+             matched は一致した列名で、fields の順（会員番号の一致が先）に並びます
+    """
+    fields = fields or detect_fields(query)
+    results = []
+    seen = set()
+    for field in fields:
+        if len(results) >= limit:
+            break
+        value = normalize(field, query)
+        if not value:
+            continue
+        column, order = LOOKUP_FIELDS[field]
+        low, high = prefix_range(value)
+        rows = conn.execute(f'''
+            SELECT *, ? as matched FROM users
+            WHERE {column} >= ? AND {column} < ?
+            ORDER BY {order} LIMIT ?
+        ''', (field, low, high, limit)).fetchall()
+        for row in rows:
+            if row['user_id'] not in seen:
+                seen.add(row['user_id'])
+                results.append(row)
+    return results[:limit]
@@ -0,0 +1,380 @@
+import os
+import re
+import json
+import contextlib
+import uuid
+import hashlib
+import tempfile
+import threading
+try:
+    import fcntl
+except ImportError:  # Windows（gunicorn を使わないため、ファイルの合算も行いません）
+    fcntl = None
+
+# リクエスト・SQL・モデル推論の計測（/metrics で Prometheus のテキスト形式で公開します）
+# 遅いリクエストが model.encode・ベクトルの走査・SQLite のクエリ・テンプレートの描画のどこで時間を使ったかを、
+# ルートごとのレイテンシのヒストグラムと、リクエストあたりのクエリ数・クエリ時間などから確認できるようにします。
+# - 値はプロセスごとにメモリ上で集計します。既定ではファイルに書き出さず、/metrics は応答したプロセスの値だけを返します
+# - gunicorn では、gunicorn.conf.py が METRICS_DIR（既定はDBのパスから決めた一時ディレクトリ。metrics_dir_for）を設定し、
+#   app.py が set_directory でそこへの書き出しを有効にします。各ワーカーは最大 FLUSH_INTERVAL 秒ごとに
+#   プロセスごとのJSONファイルを書き出し（一時ファイルからの置き換えなので、読み込み中に壊れません）、
+#   /metrics を受けたワーカーは自分の値を書き出してからディレクトリのファイルをすべて合算して返します。
+#   そのため、どのワーカーが応答しても全ワーカーの合計になります
+# - 終了したワーカー（max_requests での再起動など）のファイルは、合算時に retired.json へまとめて削除します。
+#   カウンタは減らず、ファイルも増え続けません（ディレクトリは gunicorn の起動時に gunicorn.conf.py で空にします）
+# - CLIのスクリプト・ベンチマーク・embed_worker.py はディレクトリを設定しないため、書き出しません
+#   （embed_worker.py は別のコンテナで動くことがあり、プロセスが生きているかをpidで判定できないためです）
+# 遅いクエリのログ: SLOW_QUERY_MS（ミリ秒）以上かかったSQLを、ルート名とともに1回ずつ出力します（既定は0で無効）。
+
+FLUSH_INTERVAL = float(os.environ.get('METRICS_FLUSH_INTERVAL', 1.0))
+SLOW_QUERY_MS = float(os.environ.get('SLOW_QUERY_MS') or 0)
+
+# ヒストグラムのバケット（上限値）
+LATENCY_BUCKETS = (0.001, 0.0025, 0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0)
+QUERY_COUNT_BUCKETS = (0, 1, 2, 3, 5, 10, 20, 50, 100, 200)
+CANDIDATE_BUCKETS = (10, 100, 1000, 10000, 100000, 1000000)
+
+# 名前: (種類, 説明, バケット)
+DEFINITIONS = {
+    'dvd_http_requests_total': ('counter', 'HTTP requests by route, method and status.', None),
+    'dvd_http_request_duration_seconds': ('histogram', 'HTTP request latency by route.', LATENCY_BUCKETS),
+    'dvd_template_render_seconds': ('histogram', 'Jinja template rendering time by route.', LATENCY_BUCKETS),
+    'dvd_db_queries_per_request': ('histogram', 'SQLite statements executed per request.', QUERY_COUNT_BUCKETS),
+    'dvd_db_query_seconds_per_request': ('histogram', 'Time spent in SQLite (execute and fetch) per request.',
+                                         LATENCY_BUCKETS),
+    'dvd_slow_queries_total': ('counter', 'SQLite statements slower than SLOW_QUERY_MS.', None),
+    'dvd_vector_encode_seconds': ('histogram', 'Query embedding time (source="cache" or "model").', LATENCY_BUCKETS),
+    'dvd_vector_scan_seconds': ('histogram', 'Vector similarity scan time by mode (ivf, filtered, full).',
+                                LATENCY_BUCKETS),
+    'dvd_vector_candidates_scored': ('histogram', 'Vectors scored per search.', CANDIDATE_BUCKETS),
+    'dvd_vector_add_encode_seconds': ('histogram', 'model.encode time per add_many batch.', LATENCY_BUCKETS),
+    'dvd_vector_added_total': ('counter', 'DVDs embedded and saved by add_many.', None),
+}
+
+def _label_key(labels):
+    """
+    ラベルの辞書を、集計のキーに使えるタプル（名前順）にします。
+    """
+    return tuple(sorted((str(k), str(v)) for k, v in (labels or {}).items()))
+
+def metrics_dir_for(db_path):
+    """
+    DBのパスから、全ワーカーの計測値を書き出すディレクトリを決めます（同じホストの別のデプロイと混ざらないようにします）。
+    """
+    digest = hashlib.sha1(os.path.abspath(db_path).encode('utf-8')).hexdigest()[:12]
+    return os.path.join(tempfile.gettempdir(), f'dvd_rental_metrics-{digest}')
+
+def _pid_alive(pid):
+    try:
+        os.kill(pid, 0)
+    except ProcessLookupError:
+        return False
+    except OSError:
+        # 権限がない場合などは、生きているものとして扱います
+        return True
+    return True
+
+def _merge(target, data):
+    """
+    スナップショット data の値を、集計中の (counters, histograms) に足し込みます。
+    """
+    counters, histograms = target
+    for name, labels, value in data['counters']:
+        key = (name, tuple(map(tuple, labels)))
+        counters[key] = counters.get(key, 0) + value
+    for name, labels, buckets, total, count in data['histograms']:
+        key = (name, tuple(map(tuple, labels)))
+        entry = histograms.get(key)
+        if entry is None or len(entry[0]) != len(buckets):
+            histograms[key] = [list(buckets), total, count]
+        else:
+            entry[0] = [a + b for a, b in zip(entry[0], buckets)]
+            entry[1] += total
+            entry[2] += count
+
+def _to_snapshot(counters, histograms):
+    return {
+        'counters': [[name, list(labels), value] for (name, labels), value in counters.items()],
+        'histograms': [[name, list(labels), list(entry[0]), entry[1], entry[2]]
+                       for (name, labels), entry in histograms.items()],
+    }
+
+def _read_json(path):
+    try:
+        with open(path) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return None
+
+def _write_json(path, data):
+    tmp = f'{path}.{os.getpid()}.tmp'
+    with open(tmp, 'w') as f:
+        json.dump(data, f)
+    os.replace(tmp, path)
+
+class Registry:
+    """
+    プロセス内のカウンタとヒストグラム。
+    fork後の子プロセスでは親の値を引き継がず、空の状態から集計します。
+    """
+    def __init__(self, directory=None, flush_interval=FLUSH_INTERVAL):
+        """
+        :param directory: プロセスごとのファイルを書き出すディレクトリ（Noneの場合は書き出しません）
+        :param flush_interval: 値が変わってから書き出すまでの最大秒数
+        """
+        self.directory = directory
+        self.flush_interval = flush_interval
+        self._lock = threading.Lock()
+        self._reset()
+
+    def set_directory(self, directory):
+        """
+        全ワーカーで合算するためのディレクトリを設定します（Noneの場合はこのプロセスの値だけを使います）。
+        """
+        with self._lock:
+            self.directory = directory or None
+            self._path = self._file_path()
+
+    def _file_path(self):
+        if not self.directory:
+            return None
+        # 再起動で同じpidが使われても、前のプロセスのファイルを上書きしないようにします
+        return os.path.join(self.directory, f'worker-{self._pid}-{uuid.uuid4().hex[:8]}.json')
+
+    def _reset(self):
+        self._pid = os.getpid()
+        self._path = self._file_path()
+        self._counters = {}
+        # (name, labels) -> [バケットごとの件数（最後は+Inf）, 合計, 件数]
+        self._histograms = {}
+        self._scheduled = False
+
+    def _check_pid(self):
+        if self._pid != os.getpid():
+            self._reset()
+
+    def inc(self, name, labels=None, value=1):
+        """
+        カウンタを増やします。
+        """
+        with self._lock:
+            self._check_pid()
+            key = (name, _label_key(labels))
+            self._counters[key] = self._counters.get(key, 0) + value
+            self._schedule()
+
+    def observe(self, name, value, labels=None):
+        """
+        ヒストグラムに値を1件追加します。
+        """
+        buckets = DEFINITIONS[name][2]
+        with self._lock:
+            self._check_pid()
+            key = (name, _label_key(labels))
+            entry = self._histograms.get(key)
+            if entry is None:
+                entry = self._histograms[key] = [[0] * (len(buckets) + 1), 0.0, 0]
+            index = len(buckets)
+            for i, bound in enumerate(buckets):
+                if value <= bound:
+                    index = i
+                    break
+            entry[0][index] += 1
+            entry[1] += value
+            entry[2] += 1
+            self._schedule()
+
+    def _schedule(self):
+        # 値が変わったら一定時間後に1回だけ書き出します（アイドル状態になったワーカーの値も反映されるよう、タイマーで行います）
+        if self._path is None or self._scheduled:
+            return
+        self._scheduled = True
+        timer = threading.Timer(self.flush_interval, self.flush)
+        timer.daemon = True
+        timer.start()
+
+    def snapshot(self):
+        """
+        このプロセスの値を、ファイルに書き出す形式で返します。
+        """
+        with self._lock:
+            self._check_pid()
+            return dict(_to_snapshot(self._counters, self._histograms), pid=self._pid)
+
+    def flush(self):
+        """
+        このプロセスの値をファイルに書き出します。
+        """
+        if self._pid != os.getpid():
+            return
+        with self._lock:
+            self._scheduled = False
+        path = self._path
+        if path is None:
+            return
+        data = self.snapshot()
+        try:
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+            _write_json(path, data)
+        except OSError as e:
+            print(f"Failed to write metrics to {path}: {e}")
+
+    def collect(self):
+        """
+        全プロセスの値を合算して返します（METRICS_DIR を使わない場合はこのプロセスの値だけ）。
+        :return: (counters, histograms, プロセス数)
+        """
+        totals = ({}, {})
+        if self._path is None:
+            _merge(totals, self.snapshot())
+            return totals[0], totals[1], 1
+
+        self.flush()
+        self.retire_dead()
+        processes = 0
+        # retire_dead がファイルをまとめている途中の状態を読まないよう、共有ロックを取って読みます
+        with self._directory_lock(shared=True):
+            for name in sorted(os.listdir(self.directory)):
+                if not (name.startswith('worker-') and name.endswith('.json')) and name != 'retired.json':
+                    continue
+                data = _read_json(os.path.join(self.directory, name))
+                if data is not None:
+                    _merge(totals, data)
+                    processes += name != 'retired.json'
+        return totals[0], totals[1], processes
+
+    @contextlib.contextmanager
+    def _directory_lock(self, shared=False):
+        if fcntl is None:
+            yield
+            return
+        with open(os.path.join(self.directory, '.lock'), 'a') as lock:
+            fcntl.flock(lock, fcntl.LOCK_SH if shared else fcntl.LOCK_EX)
+            yield
+
+    def retire_dead(self):
+        """
+        終了したプロセスのファイルを retired.json に合算して削除します。
+        複数のワーカーが同時に行っても二重に合算しないよう、ディレクトリのロックを取ってから行います。
+        """
+        if self.directory is None or fcntl is None:
+            return
+        try:
+            names = os.listdir(self.directory)
+        except OSError:
+            return
+        dead = []
+        for name in names:
+            match = re.match(r'worker-(\d+)-\w+\.json$', name)
+            if match and not _pid_alive(int(match.group(1))):
+                dead.append(name)
+        if not dead:
+            return
+        with self._directory_lock():
+            retired_path = os.path.join(self.directory, 'retired.json')
+            totals = ({}, {})
+            retired = _read_json(retired_path)
+            if retired is not None:
+                _merge(totals, retired)
+            paths = [os.path.join(self.directory, name) for name in dead]
+            # ロックを待つ間に他のワーカーがまとめたファイルは、もうありません
+            paths = [path for path in paths if os.path.exists(path)]
+            for path in paths:
+                data = _read_json(path)
+                if data is not None:
+                    _merge(totals, data)
+            if not paths:
+                return
+            _write_json(retired_path, _to_snapshot(*totals))
+            for path in paths:
+                os.remove(path)
+
+    def render(self):
+        """
+        全プロセスの値を Prometheus のテキスト形式（text/plain; version=0.0.4）で返します。
+        """
+        counters, histograms, processes = self.collect()
+        lines = ['# HELP dvd_metrics_processes Live processes whose metrics are included (exited workers are summed separately).',
+                 '# TYPE dvd_metrics_processes gauge',
+                 f'dvd_metrics_processes {processes}']
+        for name, (kind, help_text, buckets) in DEFINITIONS.items():
+            lines.append(f'# HELP {name} {help_text}')
+            lines.append(f'# TYPE {name} {kind}')
+            if kind == 'counter':
+                for (metric, labels), value in sorted(counters.items()):
+                    if metric == name:
+                        lines.append(f'{name}{_format_labels(labels)} {_format_value(value)}')
+                continue
+            for (metric, labels), (counts, total, count) in sorted(histograms.items()):
+                if metric != name:
+                    continue
+                cumulative = 0
+                for bound, n in zip(list(buckets) + ['+Inf'], counts):
+                    cumulative += n
+                    le = bound if bound == '+Inf' else _format_value(bound)
+                    lines.append(f'{name}_bucket{_format_labels(labels + (("le", le),))} {cumulative}')
+                lines.append(f'{name}_sum{_format_labels(labels)} {_format_value(total)}')
+                lines.append(f'{name}_count{_format_labels(labels)} {count}')
+        return '\n'.join(lines) + '\n'
+
+    def clear_directory(self):
+        """
+        ディレクトリの全プロセスのファイルを削除します（gunicorn の起動時に、前回の値を持ち越さないため）。
+        """
+        if not self.directory or not os.path.isdir(self.directory):
+            return
+        for name in os.listdir(self.directory):
+            if name.startswith('worker-') or name == 'retired.json':
+                try:
+                    os.remove(os.path.join(self.directory, name))
+                except OSError:
+                    pass
+
+def _format_labels(labels):
+    if not labels:
+        return ''
+    escaped = ('{}="{}"'.format(k, v.replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n'))
+               for k, v in labels)
+    return '{' + ','.join(escaped) + '}'
+
+def _format_value(value):
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return repr(value)
+
+class QueryTracer:
+    """
+    1リクエストで実行したSQLの件数と時間を数えるトレーサー。
+    db.py の PooledConnection.tracer に設定すると、execute と行の読み込みのたびに呼び出されます。
+    """
+    def __init__(self, route=None, slow_query_ms=SLOW_QUERY_MS):
+        """
+        :param route: 遅いクエリのログに出すルート名
+        :param slow_query_ms: これ以上かかったクエリをログに出します（0の場合は出しません）
+        """
+        self.route = route
+        self.slow_query_ms = slow_query_ms
+        self.count = 0
+        self.seconds = 0.0
+
+    def __call__(self, cursor, elapsed, first):
+        """
+        :param cursor: db.TracedCursor（sql と、そのクエリでここまでにかかった時間 elapsed を持ちます）
+        :param elapsed: 今回の execute / 読み込みにかかった秒数
+        :param first: execute の呼び出しの場合はTrue
+        """
+        if first:
+            self.count += 1
+        self.seconds += elapsed
+        if self.slow_query_ms and not cursor.slow_logged and cursor.elapsed * 1000 >= self.slow_query_ms:
+            # 読み込みの途中で閾値を超えた場合も、1つのクエリにつき1回だけ出力します
+            cursor.slow_logged = True
+            registry.inc('dvd_slow_queries_total')
+            sql = re.sub(r'\s+', ' ', cursor.sql).strip()
+            print(f"Slow query ({cursor.elapsed * 1000:.1f}ms, {self.route or '-'}): {sql}")
+
+# このプロセスの集計
+registry = Registry()
+inc = registry.inc
+observe = registry.observe
+render = registry.render
@@ -0,0 +1,380 @@
+import sqlite3
+import os
+import sys
+
+# スキーマのマイグレーション
+# 既存のデータベースに対して、インデックスやトリガーの追加などを順番に適用します。
+# 適用済みのバージョンは SQLite の PRAGMA user_version に記録するため、管理用のテーブルは不要です。
+# 新しい変更は MIGRATIONS の末尾に (バージョン, 説明, 関数) を追加してください（既存の番号は変更しないこと）。
+
+def create_dvds_fts(cursor):
+    """
+    dvdsテーブルの全文検索インデックス（dvds_fts）と、同期用のトリガーを作成します。
+    dvds_fts は dvds を参照する外部コンテンツテーブルなので、本文を二重に保存しません。
+    新規作成した場合は、既存のDVDからインデックスを構築します。
+    """
+    exists = cursor.execute("SELECT 1 FROM sqlite_master WHERE type = 'table' AND name = 'dvds_fts'").fetchone()
+    cursor.execute('''
+    CREATE VIRTUAL TABLE IF NOT EXISTS dvds_fts USING fts5(
+        title,
+        description,
+        content='dvds',
+        content_rowid='dvd_id',
+        tokenize='trigram'
+    )
+    ''')
+
+    # dvdsの追加・削除・更新に合わせてインデックスを更新するトリガー
+    # 在庫数の更新（貸出・返却）ではインデックスを触らないよう、タイトルと説明文の更新時のみ動作します
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS dvds_fts_insert AFTER INSERT ON dvds BEGIN
+        INSERT INTO dvds_fts (rowid, title, description) VALUES (new.dvd_id, new.title, new.description);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS dvds_fts_delete AFTER DELETE ON dvds BEGIN
+        INSERT INTO dvds_fts (dvds_fts, rowid, title, description) VALUES ('delete', old.dvd_id, old.title, old.description);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS dvds_fts_update AFTER UPDATE OF title, description ON dvds BEGIN
+        INSERT INTO dvds_fts (dvds_fts, rowid, title, description) VALUES ('delete', old.dvd_id, old.title, old.description);
+        INSERT INTO dvds_fts (rowid, title, description) VALUES (new.dvd_id, new.title, new.description);
+    END
+    ''')
+
+    if not exists:
+        cursor.execute("INSERT INTO dvds_fts (dvds_fts) VALUES ('rebuild')")
+
+def add_rental_indexes(cursor):
+    """
+    rentalsテーブルの検索でよく使う列にインデックスを作成します（#8 Tuning）。
+    """
+    # 貸出中（未返却）の重複チェック・件数集計用。未返却の行だけを持つ部分インデックスなので小さく保てます
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_rentals_active_user_dvd
+    ON rentals (user_id, dvd_id) WHERE return_date IS NULL
+    ''')
+    # 貸出中一覧（貸出日の新しい順）と延滞件数の集計用
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_rentals_active_date
+    ON rentals (rental_date) WHERE return_date IS NULL
+    ''')
+    # ダッシュボードの本日の貸出数・最近の貸出用
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rentals_rental_date ON rentals (rental_date)')
+    # DVD・会員の削除時の貸出履歴チェック用
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rentals_dvd ON rentals (dvd_id)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_rentals_user ON rentals (user_id)')
+
+def create_dashboard_stats(cursor):
+    """
+    ダッシュボード用の集計テーブルと、それを更新するトリガーを作成し、現在のデータから初期値を計算します。
+    COUNT(*) や GROUP BY をページ表示のたびに実行する代わりに、行の追加・更新・削除のたびに差分だけを反映します。
+    """
+    # 件数のカウンター（users, dvds, active_rentals）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS stats_counters (
+        name TEXT PRIMARY KEY,
+        value INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    # 日ごとの貸出数（日付は rental_date の日付部分）
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS daily_rentals (
+        day TEXT PRIMARY KEY,
+        count INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+    # ジャンルごとの作品数と在庫数の合計
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS genre_stats (
+        genre_id INTEGER PRIMARY KEY,
+        dvd_count INTEGER NOT NULL DEFAULT 0,
+        stock_total INTEGER NOT NULL DEFAULT 0
+    )
+    ''')
+
+    # 初期値（既存のデータから集計）
+    cursor.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'users', COUNT(*) FROM users")
+    cursor.execute("INSERT OR REPLACE INTO stats_counters (name, value) SELECT 'dvds', COUNT(*) FROM dvds")
+    cursor.execute('''
+    INSERT OR REPLACE INTO stats_counters (name, value)
+    SELECT 'active_rentals', COUNT(*) FROM rentals WHERE return_date IS NULL
+    ''')
+    cursor.execute('DELETE FROM daily_rentals')
+    cursor.execute('''
+    INSERT INTO daily_rentals (day, count)
+    SELECT substr(rental_date, 1, 10), COUNT(*) FROM rentals GROUP BY substr(rental_date, 1, 10)
+    ''')
+    cursor.execute('DELETE FROM genre_stats')
+    cursor.execute('''
+    INSERT INTO genre_stats (genre_id, dvd_count, stock_total)
+    SELECT g.genre_id, COUNT(d.dvd_id), COALESCE(SUM(d.stock_count), 0)
+    FROM genres g
+    LEFT JOIN dvds d ON g.genre_id = d.genre_id
+    GROUP BY g.genre_id
+    ''')
+
+    # users / dvds の件数
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_users_insert AFTER INSERT ON users BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'users';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_users_delete AFTER DELETE ON users BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'users';
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_dvds_insert AFTER INSERT ON dvds BEGIN
+        UPDATE stats_counters SET value = value + 1 WHERE name = 'dvds';
+        UPDATE genre_stats SET dvd_count = dvd_count + 1, stock_total = stock_total + COALESCE(new.stock_count, 0)
+        WHERE genre_id = new.genre_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_dvds_delete AFTER DELETE ON dvds BEGIN
+        UPDATE stats_counters SET value = value - 1 WHERE name = 'dvds';
+        UPDATE genre_stats SET dvd_count = dvd_count - 1, stock_total = stock_total - COALESCE(old.stock_count, 0)
+        WHERE genre_id = old.genre_id;
+    END
+    ''')
+    # ジャンルの変更・在庫数の増減（貸出・返却を含む）
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_dvds_update AFTER UPDATE OF genre_id, stock_count ON dvds BEGIN
+        UPDATE genre_stats SET dvd_count = dvd_count - 1, stock_total = stock_total - COALESCE(old.stock_count, 0)
+        WHERE genre_id = old.genre_id;
+        UPDATE genre_stats SET dvd_count = dvd_count + 1, stock_total = stock_total + COALESCE(new.stock_count, 0)
+        WHERE genre_id = new.genre_id;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_genres_insert AFTER INSERT ON genres BEGIN
+        INSERT OR IGNORE INTO genre_stats (genre_id) VALUES (new.genre_id);
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_genres_delete AFTER DELETE ON genres BEGIN
+        DELETE FROM genre_stats WHERE genre_id = old.genre_id;
+    END
+    ''')
+
+    # 貸出中の件数と日ごとの貸出数
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_rentals_insert AFTER INSERT ON rentals BEGIN
+        UPDATE stats_counters SET value = value + (new.return_date IS NULL) WHERE name = 'active_rentals';
+        INSERT INTO daily_rentals (day, count) VALUES (substr(new.rental_date, 1, 10), 1)
+        ON CONFLICT(day) DO UPDATE SET count = count + 1;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_rentals_update AFTER UPDATE OF return_date, rental_date ON rentals BEGIN
+        UPDATE stats_counters SET value = value - (old.return_date IS NULL) + (new.return_date IS NULL)
+        WHERE name = 'active_rentals';
+        UPDATE daily_rentals SET count = count - 1 WHERE day = substr(old.rental_date, 1, 10);
+        INSERT INTO daily_rentals (day, count) VALUES (substr(new.rental_date, 1, 10), 1)
+        ON CONFLICT(day) DO UPDATE SET count = count + 1;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS stats_rentals_delete AFTER DELETE ON rentals BEGIN
+        UPDATE stats_counters SET value = value - (old.return_date IS NULL) WHERE name = 'active_rentals';
+        UPDATE daily_rentals SET count = count - 1 WHERE day = substr(old.rental_date, 1, 10);
+    END
+    ''')
+
+def add_listing_indexes(cursor):
+    """
+    一覧のページ分割（pagination.py）と、貸出画面の入力候補（typeahead）の検索用のインデックスを作成します。
+    """
+    # DVD一覧のジャンル絞り込み。インデックスの各行は dvd_id も持つため、ジャンル内をdvd_id順に読み出せます
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dvds_genre ON dvds (genre_id)')
+    # タイトル・名前の前方一致（title >= ? AND title < ? の範囲検索）
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_dvds_title ON dvds (title)')
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_users_name ON users (name)')
+
+def add_phone_digits_index(cursor):
+    """
+    電話番号をハイフンなどの記号を除いた数字列で前方一致検索するための式インデックスを作成します。
+    「09012345678」と入力しても「090-1234-5678」の会員を見つけられます（members.py の PHONE_DIGITS_SQL と同じ式）。
+    """
+    # 適用済みのマイグレーションの内容が変わらないよう、式は members.py から読み込まずに直接書いています
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_users_phone_digits
+    ON users (replace(replace(replace(replace(replace(phone, '-', ''), ' ', ''), '(', ''), ')', ''), '+', ''))
+    ''')
+
+def create_embedding_jobs(cursor):
+    """
+    AI検索用のベクトル化待ちのキュー（embedding_jobs）と、それに登録するトリガーを作成します。
+    DVDの追加・更新と同じトランザクションでキューに登録されるため、画面の保存処理はベクトル化を待たずに終わり、
+    保存に成功したDVDのジョブが失われることもありません。キューは embed_worker.py がまとめて処理します。
+    """
+    # DVDごとに最大1件のジョブ。処理前に再度更新された場合は version を進めて1件にまとめます
+    cursor.execute('''
+    CREATE TABLE IF NOT EXISTS embedding_jobs (
+        dvd_id INTEGER PRIMARY KEY,
+        version INTEGER NOT NULL DEFAULT 1,
+        enqueued_at DATETIME NOT NULL DEFAULT CURRENT_TIMESTAMP,
+        attempts INTEGER NOT NULL DEFAULT 0,
+        last_error TEXT
+    )
+    ''')
+    # 古い順に取り出すためのインデックス
+    cursor.execute('CREATE INDEX IF NOT EXISTS idx_embedding_jobs_enqueued ON embedding_jobs (enqueued_at)')
+
+    # ベクトル化するテキスト（タイトル・説明文・ジャンル名）に関係する列が変わったときだけ登録します
+    # 在庫数の更新（貸出・返却）では登録しません
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS embedding_jobs_dvd_insert AFTER INSERT ON dvds BEGIN
+        INSERT INTO embedding_jobs (dvd_id) VALUES (new.dvd_id)
+        ON CONFLICT(dvd_id) DO UPDATE SET version = version + 1, enqueued_at = CURRENT_TIMESTAMP,
+                                          attempts = 0, last_error = NULL;
+    END
+    ''')
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS embedding_jobs_dvd_update AFTER UPDATE OF title, description, genre_id ON dvds
+    WHEN old.title IS NOT new.title OR old.description IS NOT new.description OR old.genre_id IS NOT new.genre_id
+    BEGIN
+        INSERT INTO embedding_jobs (dvd_id) VALUES (new.dvd_id)
+        ON CONFLICT(dvd_id) DO UPDATE SET version = version + 1, enqueued_at = CURRENT_TIMESTAMP,
+                                          attempts = 0, last_error = NULL;
+    END
+    ''')
+
+def add_embedding_delete_trigger(cursor):
+    """
+    DVDの削除時にも embedding_jobs に登録するトリガーを作成します。
+    embed_worker.py は、DVDが存在しない・説明文が空のジョブを受け取ると dvd_embeddings からベクトルを削除します。
+    """
+    cursor.execute('''
+    CREATE TRIGGER IF NOT EXISTS embedding_jobs_dvd_delete AFTER DELETE ON dvds BEGIN
+        INSERT INTO embedding_jobs (dvd_id) VALUES (old.dvd_id)
+        ON CONFLICT(dvd_id) DO UPDATE SET version = version + 1, enqueued_at = CURRENT_TIMESTAMP,
+                                          attempts = 0, last_error = NULL;
+    END
+    ''')
+
+def add_rental_due_dates(cursor):
+    """
+    貸出期限（rentals.due_date）と、期限の計算に使う貸出日数（dvds.loan_days, genres.loan_days）の列を追加します。
+    既存の貸出は、貸出日にDVD・ジャンルの貸出日数（どちらもNULLの場合は7日）を足した値で埋めます。
+    延滞の判定は「未返却かつ due_date < 現在時刻」になり、部分インデックスの範囲検索で数えられます。
+    """
+    columns = {
+        table: {row[1] for row in cursor.execute(f'PRAGMA table_info({table})').fetchall()}
+        for table in ('dvds', 'genres', 'rentals')
+    }
+    # 貸出日数はNULLの場合に「DVD → ジャンル → 既定値」の順で決めます
+    if 'loan_days' not in columns['dvds']:
+        cursor.execute('ALTER TABLE dvds ADD COLUMN loan_days INTEGER CHECK(loan_days > 0)')
+    if 'loan_days' not in columns['genres']:
+        cursor.execute('ALTER TABLE genres ADD COLUMN loan_days INTEGER CHECK(loan_days > 0)')
+    if 'due_date' not in columns['rentals']:
+        cursor.execute('ALTER TABLE rentals ADD COLUMN due_date DATETIME')
+
+    # 既存の行の埋め戻し。適用済みのマイグレーションの内容が変わらないよう、既定の7日は rentals.py から読み込まずに直接書いています
+    cursor.execute('''
+    UPDATE rentals SET due_date = datetime(rental_date, '+' || (
+        SELECT COALESCE(d.loan_days, g.loan_days, 7)
+        FROM dvds d LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE d.dvd_id = rentals.dvd_id
+    ) || ' days')
+    WHERE due_date IS NULL
+    ''')
+    # DVDが削除済みの行（通常はありません）は既定の7日で埋めます
+    cursor.execute("UPDATE rentals SET due_date = datetime(rental_date, '+7 days') WHERE due_date IS NULL")
+
+    # 未返却の貸出を期限順に読むための部分インデックス（延滞件数・延滞レポート用）
+    cursor.execute('''
+    CREATE INDEX IF NOT EXISTS idx_rentals_active_due
+    ON rentals (due_date) WHERE return_date IS NULL
+    ''')
+
+def create_data_generation(cursor):
+    """
+    データの世代番号（stats_counters の 'data_generation'）と、それを進めるトリガーを作成します。
+    画面のキャッシュ（page_cache.py）は、この番号が変わっていなければ前回と同じ内容とみなして再利用します。
+    どの書き込み経路（画面・一括処理・スクリプト）でも同じトランザクションで番号が進むため、
+    書き込み後に古い画面が返されることはありません。
+    """
+    cursor.execute("INSERT OR IGNORE INTO stats_counters (name, value) VALUES ('data_generation', 0)")
+    for table in ('users', 'dvds', 'genres', 'rentals'):
+        for event in ('INSERT', 'UPDATE', 'DELETE'):
+            cursor.execute(f'''
+            CREATE TRIGGER IF NOT EXISTS data_generation_{table}_{event.lower()} AFTER {event} ON {table} BEGIN
+                UPDATE stats_counters SET value = value + 1 WHERE name = 'data_generation';
+            END
+            ''')
+
+def add_dvd_product_code(cursor):
+    """
+    仕入れ先の商品コード（JANコード・品番など）の列 dvds.product_code と、その一意インデックスを追加します。
+    CSVの一括登録（dvd_import.py）は、商品コードが同じDVDを同じ商品として在庫の追加・情報の更新を行います。
+    既存のDVDは商品コードを持たない（NULL）ため、一意性は商品コードのある行だけに適用します。
+    """
+    columns = {row[1] for row in cursor.execute('PRAGMA table_info(dvds)').fetchall()}
+    if 'product_code' not in columns:
+        cursor.execute('ALTER TABLE dvds ADD COLUMN product_code TEXT')
+    cursor.execute('''
+    CREATE UNIQUE INDEX IF NOT EXISTS idx_dvds_product_code
+    ON dvds (product_code) WHERE product_code IS NOT NULL
+    ''')
+
+# (バージョン, 説明, 関数) のリスト。関数はカーソルを受け取り、同じトランザクション内で実行されます
+MIGRATIONS = [
+    (1, 'dvds_fts full-text index and triggers', create_dvds_fts),
+    (2, 'rentals indexes (active, rental_date, dvd_id, user_id)', add_rental_indexes),
+    (3, 'dashboard counters maintained by triggers', create_dashboard_stats),
+    (4, 'listing and typeahead indexes (dvds.genre_id, dvds.title, users.name)', add_listing_indexes),
+    (5, 'users phone digits expression index', add_phone_digits_index),
+    (6, 'embedding_jobs outbox filled by dvds triggers', create_embedding_jobs),
+    (7, 'embedding_jobs delete trigger', add_embedding_delete_trigger),
+    (8, 'rentals.due_date with loan periods per DVD and genre', add_rental_due_dates),
+    (9, 'data_generation counter bumped by triggers', create_data_generation),
+    (10, 'dvds.product_code natural key for catalog imports', add_dvd_product_code),
+]
+
+def current_version(conn):
+    """
+    適用済みのマイグレーションのバージョン（PRAGMA user_version）を返します。
+    """
+    return conn.execute('PRAGMA user_version').fetchone()[0]
+
+def migrate(conn, target=None):
+    """
+    未適用のマイグレーションを順番に適用します。
+    各マイグレーションとバージョンの更新は同じトランザクションで行うため、途中で失敗しても中途半端な状態は残りません。
+    :param conn: 対象データベースへの接続
+    :param target: このバージョンまで適用します（省略時は最新まで）
+    :return: 適用したマイグレーションのバージョンのリスト
+    """
+    applied = []
+    version = current_version(conn)
+    for number, description, func in MIGRATIONS:
+        if number <= version or (target is not None and number > target):
+            continue
+        print(f"Applying migration {number}: {description}")
+        # sqlite3 モジュールの暗黙のトランザクションを使わず、明示的に開始・確定します
+        conn.commit()
+        cursor = conn.cursor()
+        try:
+            cursor.execute('BEGIN IMMEDIATE')
+            func(cursor)
+            # PRAGMA user_version もトランザクションの一部として確定・ロールバックされます
+            cursor.execute(f'PRAGMA user_version = {int(number)}')
+            cursor.execute('COMMIT')
+        except Exception:
+            cursor.execute('ROLLBACK')
+            raise
+        applied.append(number)
+    return applied
+
+if __name__ == '__main__':
+    db_path = sys.argv[1] if len(sys.argv) > 1 else os.path.join(os.path.dirname(__file__), 'dvd_rental.db')
+    conn = sqlite3.connect(db_path)
+    before = current_version(conn)
+    applied = migrate(conn)
+    print(f"Schema version: {before} -> {current_version(conn)} ({len(applied)} migrations applied)")
+    conn.close()
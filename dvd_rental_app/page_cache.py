@@ -0,0 +1,108 @@
+import hashlib
+import threading
+from collections import OrderedDict
+
+# 一覧画面のキャッシュと条件付きGET（ETag / 304 Not Modified）
+# ダッシュボード・DVD一覧・ジャンル・ユーザー・貸出画面は、データが変わらない限り同じクエリと同じテンプレートの
+# 描画を繰り返しています。データの世代番号（migrations.py の create_data_generation。書き込みのたびにトリガーで進みます）と
+# ルート・クエリパラメータから ETag を作り、
+# - ブラウザ・nginx が同じ ETag を If-None-Match で送ってきた場合は、描画せずに 304 を返します
+# - それ以外で同じ ETag の描画結果を持っている場合は、クエリもテンプレートの描画もせずにそれを返します
+# ETag は世代番号とキーだけから決まるため、どのワーカーが描画しても同じ値になります。
+# キャッシュ本体はワーカー（プロセス）ごとに持ちます。
+
+DEFAULT_MAX_ENTRIES = 256
+# これより大きい描画結果は保存しません（ETag / 304 は使えます）
+MAX_BODY_BYTES = 1024 * 1024
+
+def page_key(path, args):
+    """
+    ルートとクエリパラメータからキャッシュのキーを作ります（パラメータの順序は区別しません）。
+    :param path: request.path
+    :param args: request.args（MultiDict）
+    """
+    return path, tuple(sorted(args.items(multi=True)))
+
+def make_etag(key, version):
+    """
+    キーとデータの版（世代番号など）から ETag の値を作ります。
+    :param version: 内容を決める値のタプル（例: (data_generation, ベクトルDBのversion)）
+    """
+    return hashlib.sha1(repr((key, version)).encode('utf-8')).hexdigest()[:24]
+
+class PageCache:
+    """
+    描画済みの画面を ETag ごとに保持するLRUキャッシュ。
+    同じキーの古い版は、新しい版を保存したときに置き換えます。
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, max_body_bytes=MAX_BODY_BYTES):
+        """
+        コンストラクタ。
+        :param max_entries: 保持する最大件数（0の場合はキャッシュせず、ETag / 304 だけを使います）
+        :param max_body_bytes: 保存する描画結果の最大サイズ（バイト）
+        """
+        self.max_entries = max_entries
+        self.max_body_bytes = max_body_bytes
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # ヒット率の確認用のカウンタ
+        self.hits = 0
+        self.not_modified = 0
+        self.misses = 0
+        self.bypassed = 0
+
+    def get(self, key, etag):
+        """
+        キーに対応する描画結果が指定した ETag のものであれば返します。
+        :return: (body, mimetype)。ない場合や版が古い場合はNone
+        """
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is None or entry[0] != etag:
+                self.misses += 1
+                return None
+            self._entries.move_to_end(key)
+            self.hits += 1
+            return entry[1], entry[2]
+
+    def put(self, key, etag, body, mimetype):
+        """
+        描画結果を保存します。上限を超えた場合は最も古く使われたものから破棄します。
+        """
+        if self.max_entries <= 0 or len(body) > self.max_body_bytes:
+            return
+        with self._lock:
+            self._entries[key] = (etag, body, mimetype)
+            self._entries.move_to_end(key)
+            while len(self._entries) > self.max_entries:
+                self._entries.popitem(last=False)
+
+    def record_not_modified(self):
+        with self._lock:
+            self.not_modified += 1
+
+    def record_bypass(self):
+        with self._lock:
+            self.bypassed += 1
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+    def stats(self):
+        """
+        キャッシュのヒット・ミス回数などを返します。
+        hit_rate は描画せずに応答できた割合（キャッシュからの応答と 304 の合計）です。
+        """
+        with self._lock:
+            lookups = self.hits + self.not_modified + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'bytes': sum(len(entry[1]) for entry in self._entries.values()),
+                'hits': self.hits,
+                'not_modified': self.not_modified,
+                'misses': self.misses,
+                'bypassed': self.bypassed,
+                'hit_rate': (self.hits + self.not_modified) / lookups if lookups else 0.0,
+            }
@@ -0,0 +1,152 @@
+import os
+import json
+import base64
+
+# 一覧表示のページ分割（キーセット方式）
+# OFFSET によるページ分割は、後ろのページほど読み飛ばす行が増えて遅くなります。
+# キーセット方式では「前のページの最後の行の並べ替えキー」をカーソルとして受け取り、
+# WHERE (キー) < (カーソル) ORDER BY キー LIMIT n としてインデックスの途中から読み始めるため、
+# 何ページ目でも一定の時間で表示できます。並べ替えキーには必ず一意な列（主キー）を含めます。
+
+# 1ページの件数
+PER_PAGE = int(os.environ.get('LIST_PER_PAGE', 50))
+# 1ページの最大件数（URLで指定された場合の上限）
+MAX_PER_PAGE = 200
+
+def encode_cursor(values):
+    """
+    並べ替えキーの値をURLに載せられる文字列にします。
+    :param values: 並べ替えキーの値のリスト（例: [rental_date, rental_id]）
+    """
+    data = json.dumps(list(values), ensure_ascii=False, separators=(',', ':')).encode('utf-8')
+    return base64.urlsafe_b64encode(data).decode('ascii').rstrip('=')
+
+def decode_cursor(token, size):
+    """
+    encode_cursor() で作ったカーソルを並べ替えキーの値のリストに戻します。
+    :param token: カーソル文字列（空の場合は先頭ページ）
+    :param size: 並べ替えキーの列数
+    :return: 値のリスト。先頭ページの場合はNone
+    :raises ValueError: カーソルが不正な場合
+    """
+    if not token:
+        return None
+    try:
+        values = json.loads(base64.urlsafe_b64decode(token + '=' * (-len(token) % 4)).decode('utf-8'))
+    except (ValueError, TypeError) as e:
+        raise ValueError('ページの指定が正しくありません。') from e
+    if not isinstance(values, list) or len(values) != size:
+        raise ValueError('ページの指定が正しくありません。')
+    return values
+
+def page_size(value, default=PER_PAGE):
+    """
+    URLで指定された1ページの件数を 1〜MAX_PER_PAGE の範囲に収めます。
+    """
+    try:
+        return min(max(1, int(value)), MAX_PER_PAGE)
+    except (TypeError, ValueError):
+        return default
+
+def keyset_page(rows, limit, key):
+    """
+    limit + 1 件取得した結果を1ページ分に切り詰め、次のページのカーソルを作ります。
+    :param rows: limit + 1 件まで取得した行
+    :param limit: 1ページの件数
+    :param key: 行から並べ替えキーの値のリストを返す関数
+    :return: {'items': 行のリスト, 'next_cursor': 次のページのカーソル（最後のページの場合はNone）}
+    """
+    items = rows[:limit]
+    has_next = len(rows) > limit
+    return {
+        'items': items,
+        'next_cursor': encode_cursor(key(items[-1])) if has_next and items else None,
+    }
+
+def list_users(conn, cursor=None, limit=PER_PAGE):
+    """
+    ユーザーを登録の新しい順に1ページ分取得します。
+    user_id（AUTOINCREMENT）は登録順に増えるため、主キーの降順で並べれば追加のインデックスは不要です。
+    :param conn: dvd_rental.db への接続
+    :param cursor: 前のページの next_cursor（先頭ページの場合はNone）
+    :param limit: 1ページの件数
+    """
+    after = decode_cursor(cursor, 1)
+    sql = 'SELECT * FROM users'
+    params = []
+    if after:
+        sql += ' WHERE user_id < ?'
+        params.append(after[0])
+    sql += ' ORDER BY user_id DESC LIMIT ?'
+    params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+    return keyset_page(rows, limit, lambda row: [row['user_id']])
+
+def list_active_rentals(conn, cursor=None, limit=PER_PAGE):
+    """
+    貸出中（未返却）のレンタルを貸出日の新しい順に1ページ分取得します。
+    部分インデックス idx_rentals_active_date (rental_date) WHERE return_date IS NULL は
+    各行の rental_id も保持しているため、(rental_date, rental_id) の降順でそのまま読み出せます。
+    :param conn: dvd_rental.db への接続
+    :param cursor: 前のページの next_cursor（先頭ページの場合はNone）
+    :param limit: 1ページの件数
+    """
+    after = decode_cursor(cursor, 2)
+    sql = '''
+        SELECT r.*, u.name as user_name, d.title as dvd_title, r.due_date < datetime('now') as overdue
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        WHERE r.return_date IS NULL
+    '''
+    params = []
+    if after:
+        sql += ' AND (r.rental_date, r.rental_id) < (?, ?)'
+        params.extend(after)
+    sql += ' ORDER BY r.rental_date DESC, r.rental_id DESC LIMIT ?'
+    params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+    return keyset_page(rows, limit, lambda row: [row['rental_date'], row['rental_id']])
+
+def list_overdue_rentals(conn, cursor=None, limit=PER_PAGE):
+    """
+    期限（due_date）を過ぎた未返却のレンタルを、期限の古い順に1ページ分取得します（延滞レポート用）。
+    部分インデックス idx_rentals_active_due (due_date) WHERE return_date IS NULL を
+    先頭から現在時刻まで範囲検索するため、返却済みの履歴や期限前の貸出は読みません。
+    :param conn: dvd_rental.db への接続
+    :param cursor: 前のページの next_cursor（先頭ページの場合はNone）
+    :param limit: 1ページの件数
+    """
+    after = decode_cursor(cursor, 2)
+    sql = '''
+        SELECT r.rental_id, r.user_id, r.dvd_id, r.rental_date, r.due_date,
+               CAST(julianday('now') - julianday(r.due_date) AS INTEGER) as days_overdue,
+               u.name as user_name, u.phone as user_phone, d.title as dvd_title
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        WHERE r.return_date IS NULL AND r.due_date < datetime('now')
+    '''
+    params = []
+    if after:
+        sql += ' AND (r.due_date, r.rental_id) > (?, ?)'
+        params.extend(after)
+    sql += ' ORDER BY r.due_date, r.rental_id LIMIT ?'
+    params.append(limit + 1)
+    rows = conn.execute(sql, params).fetchall()
+    return keyset_page(rows, limit, lambda row: [row['due_date'], row['rental_id']])
+
+def prefix_range(prefix):
+    """
+    前方一致検索を、インデックスを使える範囲条件（col >= low AND col < high）に変換します。
+    LIKE 'abc%' は大文字・小文字を区別しない比較のため、通常のインデックスでは使われません。
+    :param prefix: 前方一致させる文字列（空でないこと）
+    :return: (low, high)。high は prefix の最後の文字のコードポイントを1つ進めた文字列です
+    """
+    code = ord(prefix[-1]) + 1
+    if code > 0x10FFFF:
+        return prefix, prefix + '\U0010FFFF'
+    if 0xD800 <= code <= 0xDFFF:
+        # サロゲートはUTF-8で保存できないため、その次の文字にします
+        code = 0xE000
+    return prefix, prefix[:-1] + chr(code)
@@ -0,0 +1,139 @@
+import os
+import sys
+import time
+import sqlite3
+import argparse
+from vector_search import VectorSearch, enriched_text, text_hash
+from embedding_server import EmbeddingClient
+from db import connect
+
+# dvds（dvd_rental.db）と dvd_embeddings（dvd_vector.db）の整合性チェックと修復
+# 通常はトリガーと embed_worker.py で同期されますが、ワーカーの停止中にジョブが失敗した場合や、
+# 同期の仕組みを入れる前のデータ、DBファイルの復元などで食い違いが残ることがあります。
+# このスクリプトは両方を突き合わせ、次の差分を検出・修復します。
+# - orphaned: dvds に存在しない（または説明文が空の）DVDのベクトル → 削除
+# - stale:    ベクトル化した元テキストのハッシュ（text_hash）が現在の内容と違う、または未登録 → 再ベクトル化
+# - attributes: 絞り込み用の属性（genre_id, in_stock）が違う → 属性だけ更新
+# ベクトル本体（BLOB）は読まず、dvd_id・text_hash・属性だけを比較するため、件数が多くても短時間で終わります。
+# --compact では、VECTOR_STORAGE を切り替えた後に保存済みのベクトルを新しい形式（float16 / int8）に変換することもできます。
+# 使い方: python reconcile.py [--dry-run] [--compact]
+
+BASE_DIR = os.path.dirname(os.path.abspath(__file__))
+SQLITE_DB_PATH = os.path.join(BASE_DIR, 'dvd_rental.db')
+VECTOR_DB_PATH = os.path.join(BASE_DIR, 'dvd_vector.db')
+
+# 一度に読み込む・ベクトル化するDVDの件数
+CHUNK_SIZE = 256
+BATCH_SIZE = 64
+
+def iter_dvds(conn, chunk_size=CHUNK_SIZE):
+    """
+    ベクトル化の対象になるDVDを dvd_id 順にチャンク単位で読み込みます（キーセット方式）。
+    """
+    after_id = 0
+    while True:
+        rows = conn.execute('''
+            SELECT d.dvd_id, d.title, d.description, d.genre_id, d.stock_count, g.name as genre_name
+            FROM dvds d
+            LEFT JOIN genres g ON d.genre_id = g.genre_id
+            WHERE d.dvd_id > ?
+            ORDER BY d.dvd_id
+            LIMIT ?
+        ''', (after_id, chunk_size)).fetchall()
+        if not rows:
+            return
+        yield rows
+        after_id = rows[-1]['dvd_id']
+
+def diff(conn, vector_search, chunk_size=CHUNK_SIZE):
+    """
+    dvds と dvd_embeddings の差分を計算します。
+    :param conn: dvd_rental.db への接続（row_factory = sqlite3.Row）
+    :param vector_search: VectorSearch のインスタンス
+    :return: {'orphaned': [dvd_id], 'stale': [(dvd_id, text)], 'attributes': {dvd_id: (genre_id, in_stock)},
+              'stale_attributes': {dvd_id: (genre_id, in_stock)}, 'checked': 比較したDVDの件数}
+    """
+    stored = vector_search.stored_state()
+    expected = set()
+    stale = []
+    stale_attributes = {}
+    attributes = {}
+    checked = 0
+    for rows in iter_dvds(conn, chunk_size):
+        for dvd in rows:
+            checked += 1
+            if not dvd['description']:
+                continue
+            dvd_id = dvd['dvd_id']
+            expected.add(dvd_id)
+            text = enriched_text(dvd['title'], dvd['genre_name'], dvd['description'])
+            attrs = (dvd['genre_id'], (dvd['stock_count'] or 0) > 0)
+            state = stored.get(dvd_id)
+            if state is None or state[0] != text_hash(text):
+                stale.append((dvd_id, text))
+                stale_attributes[dvd_id] = attrs
+            elif (state[1], state[2]) != attrs:
+                attributes[dvd_id] = attrs
+    return {
+        'orphaned': sorted(set(stored) - expected),
+        'stale': stale,
+        'stale_attributes': stale_attributes,
+        'attributes': attributes,
+        'checked': checked,
+    }
+
+def reconcile(conn, vector_search, dry_run=False, compact=False, chunk_size=CHUNK_SIZE, batch_size=BATCH_SIZE):
+    """
+    差分を計算し、orphaned の削除・stale の再ベクトル化・属性の更新を行います。
+    :param dry_run: Trueの場合は差分を表示するだけで修復しません
+    :param compact: Trueの場合は修復後に保存形式を VECTOR_STORAGE にそろえ（VectorSearch.convert_storage）、
+                    dvd_vector.db を VACUUM し、IVFインデックスがあれば学習し直します
+    :return: diff() の結果
+    """
+    start = time.perf_counter()
+    result = diff(conn, vector_search, chunk_size)
+    print(f"Checked {result['checked']} DVDs in {time.perf_counter() - start:.2f}s: "
+          f"{len(result['orphaned'])} orphaned, {len(result['stale'])} stale, "
+          f"{len(result['attributes'])} attribute mismatches")
+    if dry_run:
+        return result
+
+    if result['orphaned']:
+        removed = vector_search.remove_many(result['orphaned'])
+        print(f"Removed {removed} orphaned vectors.")
+    stale = result['stale']
+    for i in range(0, len(stale), chunk_size):
+        chunk = stale[i:i + chunk_size]
+        written = vector_search.add_many(chunk, batch_size=batch_size,
+                                         attributes={dvd_id: result['stale_attributes'][dvd_id] for dvd_id, _ in chunk})
+        print(f"Re-embedded {written}/{len(chunk)} stale vectors ({i + len(chunk)}/{len(stale)}).")
+    if result['attributes']:
+        vector_search.set_attributes(result['attributes'])
+        print(f"Updated attributes of {len(result['attributes'])} vectors.")
+
+    if compact:
+        start = time.perf_counter()
+        converted = vector_search.convert_storage()
+        if converted:
+            print(f"Converted {converted} vectors to {vector_search.storage}.")
+        vector_search.vacuum()
+        if os.path.exists(vector_search.index_path):
+            vector_search.rebuild_index()
+        print(f"Compacted the vector store in {time.perf_counter() - start:.2f}s.")
+    return result
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='dvds と dvd_embeddings の差分を検出して修復します。')
+    parser.add_argument('--dry-run', action='store_true', help='差分を表示するだけで修復しない')
+    parser.add_argument('--compact', action='store_true', help='修復後に保存形式の変換、VACUUM、IVFインデックスの再学習を行う')
+    parser.add_argument('--chunk-size', type=int, default=CHUNK_SIZE, help='1回に読み込む・保存する件数')
+    parser.add_argument('--batch-size', type=int, default=BATCH_SIZE, help='model.encode のバッチサイズ')
+    args = parser.parse_args(sys.argv[1:])
+
+    server = os.environ.get('EMBEDDING_SERVER')
+    vs = VectorSearch(VECTOR_DB_PATH, encoder=EmbeddingClient(server) if server else None)
+    conn = connect(SQLITE_DB_PATH, row_factory=sqlite3.Row)
+    try:
+        reconcile(conn, vs, args.dry_run, args.compact, args.chunk_size, args.batch_size)
+    finally:
+        conn.close()
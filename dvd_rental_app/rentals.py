@@ -0,0 +1,241 @@
+import sqlite3
+from db import run_write
+
+# 貸出・返却の書き込み処理 (#4 Transaction)
+# 複数のワーカーから同時に貸出されても在庫が負にならないよう、次の方針で処理します。
+# - BEGIN IMMEDIATE で最初に書き込みロックを取得します。BEGIN（DEFERRED）で読み取りから始めると、
+#   書き込みへの昇格時にロックを取れずに失敗する（busy_timeout で待てない）場合があるためです。
+# - 在庫の確認と減算は、条件付きの1つの UPDATE（WHERE stock_count > 0）で行い、更新件数で成否を判定します。
+# - ロックの取得に失敗した場合（SQLITE_BUSY）は、待ち時間を増やしながら再試行します（db.py の run_write）。
+
+# 貸出日数の既定値。DVD（dvds.loan_days）、ジャンル（genres.loan_days）の順に設定があればそちらを使います
+DEFAULT_LOAN_DAYS = 7
+# 貸出期限（rentals.due_date）の計算式。d は dvds、g は genres の別名で、パラメータに DEFAULT_LOAN_DAYS を渡します
+# rental_date の既定値（CURRENT_TIMESTAMP）と同じUTCの 'YYYY-MM-DD HH:MM:SS' 形式になるため、文字列のまま比較できます
+DUE_DATE_SQL = "datetime('now', '+' || COALESCE(d.loan_days, g.loan_days, ?) || ' days')"
+
+class RentalError(Exception):
+    """
+    在庫切れ・重複貸出・返却済みなど、利用者に伝えるべき業務上のエラー。メッセージはそのまま画面に表示します。
+    """
+
+def _checkout(conn, user_id, dvd_id):
+    # 重複貸出チェック（同じ人が同じものを現在借りていないか）
+    existing = conn.execute('''
+        SELECT 1 FROM rentals
+        WHERE user_id = ? AND dvd_id = ? AND return_date IS NULL
+    ''', (user_id, dvd_id)).fetchone()
+    if existing:
+        raise RentalError('このユーザーは既にこのDVDをレンタル中です。')
+
+    # 在庫がある場合だけ1つ減らします（確認と更新を1つの文で行うため、同時に貸し出しても負になりません）
+    cursor = conn.execute('UPDATE dvds SET stock_count = stock_count - 1 WHERE dvd_id = ? AND stock_count > 0',
+                          (dvd_id,))
+    if cursor.rowcount == 0:
+        raise RentalError('在庫がありません。')
+
+    # rentalsテーブルに履歴を挿入（貸出期限はDVD・ジャンルの貸出日数から計算して保存します）
+    rental_id = conn.execute(f'''
+        INSERT INTO rentals (user_id, dvd_id, due_date)
+        SELECT ?, d.dvd_id, {DUE_DATE_SQL}
+        FROM dvds d
+        LEFT JOIN genres g ON d.genre_id = g.genre_id
+        WHERE d.dvd_id = ?
+    ''', (user_id, DEFAULT_LOAN_DAYS, dvd_id)).lastrowid
+    stock_count = conn.execute('SELECT stock_count FROM dvds WHERE dvd_id = ?', (dvd_id,)).fetchone()[0]
+    return rental_id, stock_count
+
+def checkout(conn, user_id, dvd_id):
+    """
+    DVDを貸し出します。
+    :return: (rental_id, 貸出後の在庫数)
+    :raises RentalError: 在庫切れ、または同じDVDを貸出中の場合
+    """
+    return run_write(conn, lambda c: _checkout(c, user_id, dvd_id))
+
+def _return_rental(conn, rental_id):
+    # 未返却の場合だけ返却済みにします（同じ返却を二重に処理して在庫が増えすぎないように）
+    cursor = conn.execute('''
+        UPDATE rentals SET return_date = CURRENT_TIMESTAMP, status = 'returned'
+        WHERE rental_id = ? AND return_date IS NULL
+    ''', (rental_id,))
+    if cursor.rowcount == 0:
+        if conn.execute('SELECT 1 FROM rentals WHERE rental_id = ?', (rental_id,)).fetchone():
+            raise RentalError('このレンタルは既に返却済みです。')
+        raise RentalError('レンタル情報が見つかりません。')
+
+    # DVDの在庫数を1つ戻す
+    dvd_id = conn.execute('SELECT dvd_id FROM rentals WHERE rental_id = ?', (rental_id,)).fetchone()[0]
+    conn.execute('UPDATE dvds SET stock_count = stock_count + 1 WHERE dvd_id = ?', (dvd_id,))
+    stock_count = conn.execute('SELECT stock_count FROM dvds WHERE dvd_id = ?', (dvd_id,)).fetchone()[0]
+    return dvd_id, stock_count
+
+def return_rental(conn, rental_id):
+    """
+    DVDを返却します。
+    :return: (dvd_id, 返却後の在庫数)
+    :raises RentalError: 該当するレンタルがない、または返却済みの場合
+    """
+    return run_write(conn, lambda c: _return_rental(c, rental_id))
+
+# 一括処理で1回に扱える最大件数
+MAX_BULK_ITEMS = 100
+
+def _placeholders(values):
+    return ','.join('?' * len(values))
+
+def _unique(values):
+    """
+    重複を除いた値のリスト（最初の出現順）と、2回目以降に出現した値のリストを返します。
+    """
+    seen = set()
+    unique, repeated = [], []
+    for value in values:
+        if value in seen:
+            repeated.append(value)
+        else:
+            seen.add(value)
+            unique.append(value)
+    return unique, repeated
+
+def _checkout_many(conn, user_id, dvd_ids):
+    if not conn.execute('SELECT 1 FROM users WHERE user_id = ?', (user_id,)).fetchone():
+        raise RentalError('ユーザーが見つかりません。')
+    unique_ids, repeated = _unique(dvd_ids)
+    placeholders = _placeholders(unique_ids)
+
+    # 在庫と貸出中のDVDを、1件ずつではなくまとめて（集合として）確認します
+    dvds = {row[0]: (row[1], row[2]) for row in conn.execute(
+        f'SELECT dvd_id, title, stock_count FROM dvds WHERE dvd_id IN ({placeholders})', unique_ids)}
+    renting = {row[0] for row in conn.execute(f'''
+        SELECT dvd_id FROM rentals
+        WHERE user_id = ? AND return_date IS NULL AND dvd_id IN ({placeholders})
+    ''', [user_id] + unique_ids)}
+
+    results = {}
+    accepted = []
+    for dvd_id in unique_ids:
+        title, stock_count = dvds.get(dvd_id, (None, None))
+        result = {'dvd_id': dvd_id, 'title': title, 'ok': False, 'rental_id': None, 'due_date': None,
+                  'stock_count': stock_count}
+        if title is None:
+            result['error'] = 'DVDが見つかりません。'
+        elif dvd_id in renting:
+            result['error'] = 'このユーザーは既にこのDVDをレンタル中です。'
+        elif (stock_count or 0) <= 0:
+            result['error'] = '在庫がありません。'
+        else:
+            accepted.append(dvd_id)
+        results[dvd_id] = result
+
+    if accepted:
+        # 書き込みロックを保持しているため確認結果は変わりませんが、念のため条件付きで減算し、件数を検証します
+        cursor = conn.executemany('UPDATE dvds SET stock_count = stock_count - 1 WHERE dvd_id = ? AND stock_count > 0',
+                                  [(dvd_id,) for dvd_id in accepted])
+        if cursor.rowcount != len(accepted):
+            raise sqlite3.IntegrityError('在庫数が確認時から変わりました。')
+        conn.executemany(f'''
+            INSERT INTO rentals (user_id, dvd_id, due_date)
+            SELECT ?, d.dvd_id, {DUE_DATE_SQL}
+            FROM dvds d
+            LEFT JOIN genres g ON d.genre_id = g.genre_id
+            WHERE d.dvd_id = ?
+        ''', [(user_id, DEFAULT_LOAN_DAYS, dvd_id) for dvd_id in accepted])
+
+        # 追加したレンタルのID・貸出期限と貸出後の在庫数をまとめて取得します
+        placeholders = _placeholders(accepted)
+        for rental_id, dvd_id, due_date in conn.execute(f'''
+            SELECT rental_id, dvd_id, due_date FROM rentals
+            WHERE user_id = ? AND return_date IS NULL AND dvd_id IN ({placeholders})
+        ''', [user_id] + accepted):
+            results[dvd_id].update(rental_id=rental_id, due_date=due_date)
+        for dvd_id, stock_count in conn.execute(
+                f'SELECT dvd_id, stock_count FROM dvds WHERE dvd_id IN ({placeholders})', accepted):
+            results[dvd_id].update(ok=True, stock_count=stock_count, error=None)
+
+    ordered = [results[dvd_id] for dvd_id in unique_ids]
+    for dvd_id in repeated:
+        ordered.append({'dvd_id': dvd_id, 'title': results[dvd_id]['title'], 'ok': False, 'rental_id': None,
+                        'due_date': None, 'stock_count': results[dvd_id]['stock_count'], 'error': '同じDVDが複数回指定されています。'})
+    return ordered
+
+def checkout_many(conn, user_id, dvd_ids):
+    """
+    1人のユーザーに複数のDVDをまとめて貸し出します（1つのトランザクション）。
+    在庫切れ・重複などで貸し出せないDVDはスキップし、それ以外は貸し出します。
+    :param user_id: 会員のuser_id
+    :param dvd_ids: 貸し出すDVDのdvd_idのリスト
+    :return: DVDごとの結果 {'dvd_id', 'title', 'ok', 'rental_id', 'due_date', 'stock_count', 'error'} のリスト（指定順）
+    :raises RentalError: ユーザーが指定されていない・存在しない、DVDが指定されていない、または件数が多すぎる場合
+    """
+    if user_id in (None, ''):
+        raise RentalError('ユーザーが選択されていません。')
+    dvd_ids = [int(dvd_id) for dvd_id in dvd_ids]
+    if not dvd_ids:
+        raise RentalError('DVDが選択されていません。')
+    if len(dvd_ids) > MAX_BULK_ITEMS:
+        raise RentalError(f'一度に貸し出せるのは{MAX_BULK_ITEMS}件までです。')
+    return run_write(conn, lambda c: _checkout_many(c, int(user_id), dvd_ids))
+
+def _return_many(conn, rental_ids, user_id):
+    unique_ids, repeated = _unique(rental_ids)
+    rentals = {row[0]: row[1:] for row in conn.execute(f'''
+        SELECT r.rental_id, r.user_id, r.dvd_id, r.return_date, d.title
+        FROM rentals r
+        LEFT JOIN dvds d ON r.dvd_id = d.dvd_id
+        WHERE r.rental_id IN ({_placeholders(unique_ids)})
+    ''', unique_ids)}
+
+    results = {}
+    accepted = []
+    for rental_id in unique_ids:
+        owner, dvd_id, return_date, title = rentals.get(rental_id, (None, None, None, None))
+        result = {'rental_id': rental_id, 'dvd_id': dvd_id, 'title': title, 'ok': False, 'stock_count': None}
+        if owner is None:
+            result['error'] = 'レンタル情報が見つかりません。'
+        elif user_id is not None and owner != user_id:
+            result['error'] = '別のユーザーのレンタルです。'
+        elif return_date is not None:
+            result['error'] = 'このレンタルは既に返却済みです。'
+        else:
+            accepted.append(rental_id)
+        results[rental_id] = result
+
+    if accepted:
+        conn.executemany('''
+            UPDATE rentals SET return_date = CURRENT_TIMESTAMP, status = 'returned'
+            WHERE rental_id = ? AND return_date IS NULL
+        ''', [(rental_id,) for rental_id in accepted])
+        # 同じDVDの返却はまとめて在庫に戻します
+        returned = {}
+        for rental_id in accepted:
+            dvd_id = results[rental_id]['dvd_id']
+            returned[dvd_id] = returned.get(dvd_id, 0) + 1
+        conn.executemany('UPDATE dvds SET stock_count = stock_count + ? WHERE dvd_id = ?',
+                         [(count, dvd_id) for dvd_id, count in returned.items()])
+        stock = dict(conn.execute(f'SELECT dvd_id, stock_count FROM dvds WHERE dvd_id IN ({_placeholders(returned)})',
+                                  list(returned)))
+        for rental_id in accepted:
+            results[rental_id].update(ok=True, stock_count=stock.get(results[rental_id]['dvd_id']), error=None)
+
+    ordered = [results[rental_id] for rental_id in unique_ids]
+    for rental_id in repeated:
+        ordered.append(dict(results[rental_id], ok=False, error='同じレンタルが複数回指定されています。'))
+    return ordered
+
+def return_many(conn, rental_ids, user_id=None):
+    """
+    複数のレンタルをまとめて返却します（1つのトランザクション）。
+    返却済み・存在しないレンタルはスキップし、それ以外は返却します。
+    :param rental_ids: 返却するレンタルのrental_idのリスト
+    :param user_id: 指定した場合、このユーザーのレンタル以外は返却しません
+    :return: レンタルごとの結果 {'rental_id', 'dvd_id', 'title', 'ok', 'stock_count', 'error'} のリスト（指定順）
+    :raises RentalError: レンタルが指定されていない、または件数が多すぎる場合
+    """
+    rental_ids = [int(rental_id) for rental_id in rental_ids]
+    if not rental_ids:
+        raise RentalError('返却するレンタルが選択されていません。')
+    if len(rental_ids) > MAX_BULK_ITEMS:
+        raise RentalError(f'一度に返却できるのは{MAX_BULK_ITEMS}件までです。')
+    user_id = int(user_id) if user_id not in (None, '') else None
+    return run_write(conn, lambda c: _return_many(c, rental_ids, user_id))
@@ -0,0 +1,107 @@
+import time
+import datetime
+import threading
+
+# ダッシュボードの統計情報
+# 件数や日ごとの貸出数は、トリガーで更新される集計テーブル（stats_counters, daily_rentals, genre_stats。
+# migrations.py の create_dashboard_stats を参照）から読み取るため、履歴の件数に関係なく一定の時間で取得できます。
+# さらに結果を短時間（既定5秒）メモリに保持し、アクセスが集中してもDBへの問い合わせを増やしません。
+
+DEFAULT_TTL = 5.0
+RECENT_LIMIT = 5
+
+def read_dashboard_stats(conn, today=None):
+    """
+    集計テーブルからダッシュボードの統計情報を読み取ります。
+    :param conn: dvd_rental.db への接続（row_factory = sqlite3.Row）
+    :param today: 本日の日付（省略時は datetime.date.today()）
+    :return: index.html に渡す値の辞書
+    """
+    today = today or datetime.date.today()
+    counters = dict(conn.execute('SELECT name, value FROM stats_counters').fetchall())
+    row = conn.execute('SELECT count FROM daily_rentals WHERE day = ?', (today.strftime('%Y-%m-%d'),)).fetchone()
+
+    # 延滞件数は時間の経過で変わるため集計テーブルでは持たず、貸出時に保存した期限（due_date）で数えます
+    # 部分インデックス idx_rentals_active_due の範囲検索で、期限を過ぎた未返却の行だけを読みます
+    overdue_rentals = conn.execute('''
+        SELECT COUNT(*) FROM rentals
+        WHERE return_date IS NULL
+        AND due_date < datetime('now')
+    ''').fetchone()[0]
+
+    # ジャンルごとの在庫統計（集計済みの値をジャンル名と結合するだけ）
+    genre_stats = conn.execute('''
+        SELECT g.name, COALESCE(s.dvd_count, 0) as count, s.stock_total as total_stock
+        FROM genres g
+        LEFT JOIN genre_stats s ON g.genre_id = s.genre_id
+        ORDER BY g.genre_id
+    ''').fetchall()
+
+    # 最近のレンタル情報（rental_date のインデックスを新しい順に読むため、先頭の数件だけを取得します）
+    recent_rentals = conn.execute('''
+        SELECT r.*, u.name as user_name, d.title as dvd_title,
+               r.return_date IS NULL AND r.due_date < datetime('now') as overdue
+        FROM rentals r
+        JOIN users u ON r.user_id = u.user_id
+        JOIN dvds d ON r.dvd_id = d.dvd_id
+        ORDER BY r.rental_date DESC LIMIT ?
+    ''', (RECENT_LIMIT,)).fetchall()
+
+    return {
+        'user_count': counters.get('users', 0),
+        'dvd_count': counters.get('dvds', 0),
+        'active_rentals': counters.get('active_rentals', 0),
+        'today_rentals': row[0] if row else 0,
+        'overdue_rentals': overdue_rentals,
+        'genre_stats': genre_stats,
+        'recent_rentals': recent_rentals,
+    }
+
+class DashboardStats:
+    """
+    ダッシュボードの統計情報を短時間キャッシュするクラス。
+    キャッシュはプロセス（gunicornのワーカー）ごとに持ちます。自分のワーカーで貸出・返却した場合は
+    invalidate() ですぐに反映し、他のワーカーでの変更は最大でTTL秒遅れて反映されます
+    （get() にデータの世代番号を渡した場合は、他のワーカーでの変更もすぐに反映します）。
+    """
+    def __init__(self, ttl=DEFAULT_TTL):
+        """
+        :param ttl: キャッシュの有効期間（秒）。0の場合は毎回集計テーブルを読みます
+        """
+        self.ttl = ttl
+        self._lock = threading.Lock()
+        self._value = None
+        self._version = None
+        self._expires = 0.0
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, connect, version=None):
+        """
+        統計情報を返します。キャッシュが有効な場合はDBに接続しません。
+        :param connect: DB接続を返す関数（キャッシュが切れたときだけ呼び出します）
+        :param version: データの世代番号（分かっている場合）。キャッシュしたときと違えば、TTL内でも読み直します
+        """
+        with self._lock:
+            if (self._value is not None and time.monotonic() < self._expires
+                    and (version is None or version == self._version)):
+                self.hits += 1
+                return self._value
+        conn = connect()
+        try:
+            value = read_dashboard_stats(conn)
+        finally:
+            conn.close()
+        with self._lock:
+            self.misses += 1
+            self._value = value
+            self._version = version
+            self._expires = time.monotonic() + self.ttl
+        return value
+
+    def invalidate(self):
+        """
+        キャッシュを破棄し、次回の get() で読み直します。
+        """
+        with self._lock:
+            self._value = None
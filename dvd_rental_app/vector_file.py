@@ -0,0 +1,182 @@
+import os
+import json
+import uuid
+import glob
+import numpy as np
+
+# メモリマップで共有するベクトル行列のファイル
+# dvd_embeddings（SQLite）から行ごとにBLOBを読み込むと、gunicornのワーカーごとに行列のコピーができます。
+# 行列を1つの連続したファイル（行優先の生データ）に書き出しておけば、各ワーカーは np.memmap で開くだけで
+# OSのページキャッシュ上の同じページを共有でき、読み込みの時間もかかりません。
+# ファイルは次の3つで構成します。
+# - データファイル（dvd_vector.vectors-<token>.bin）: (行数, 次元) の行列。追加の書き込みは末尾に追記します
+# - サイドカー（dvd_vector.ids-<token>.npz）: 行ごとのdvd_id（削除・上書きされた行は DEAD_ID）と int8 の倍率
+# - マニフェスト（dvd_vector.vectors.json）: 公開中のデータファイル・サイドカー・行数と、対応するベクトルDBの世代番号
+# 書き込みは新しいサイドカー（とデータファイルへの追記）を書いてから、マニフェストを一時ファイル経由で
+# os.replace して公開します。読み込み側はマニフェストの行数までしか参照しないため、追記中の行を読むことはなく、
+# マニフェストの世代番号が dvd_vector.db の version と一致する場合だけファイルを使います。
+
+# 削除・上書きされた行のdvd_id
+DEAD_ID = -1
+# 削除・上書きされた行の割合がこれを超えたら、生きている行だけの新しいデータファイルに書き直します
+COMPACT_RATIO = 0.25
+# 書き直しの際に一度にコピーする行数
+COPY_CHUNK_ROWS = 65536
+
+def vector_file_base(db_path):
+    """
+    ベクトルDB (dvd_vector.db) の隣に置く行列ファイルのパスの接頭辞を返します。
+    """
+    return os.path.splitext(db_path)[0]
+
+class VectorFile:
+    """
+    マニフェストで公開する、追記可能なメモリマップ行列ファイル。
+    書き込み（write / append / publish）は、呼び出し側がベクトルDBの書き込みトランザクション
+    （BEGIN IMMEDIATE）を保持した状態で行い、複数プロセスの書き込みが重ならないようにします。
+    """
+    def __init__(self, base):
+        """
+        コンストラクタ。
+        :param base: ファイルパスの接頭辞（vector_file_base() の値）
+        """
+        self.base = base
+        self.dir = os.path.dirname(base) or '.'
+        self.manifest_path = base + '.vectors.json'
+
+    def read_manifest(self):
+        """
+        公開中のマニフェストを返します。ファイルがない場合や壊れている場合はNoneを返します。
+        """
+        try:
+            with open(self.manifest_path, encoding='utf-8') as f:
+                return json.load(f)
+        except (OSError, ValueError):
+            return None
+
+    def open(self, manifest):
+        """
+        マニフェストの行列をメモリマップで開きます（読み取り専用・コピーなし）。
+        :return: (ids, matrix, scales)。scales は int8 以外ではNone
+        :raises OSError, ValueError: ファイルがない、または大きさがマニフェストと合わない場合
+        """
+        rows, dim = manifest['rows'], manifest['dim']
+        with np.load(os.path.join(self.dir, manifest['sidecar'])) as data:
+            ids = data['ids']
+            scales = data['scales'] if manifest['dtype'] == 'int8' else None
+        if len(ids) != rows:
+            raise ValueError('sidecar does not match the manifest')
+        if rows == 0:
+            # 空のファイルはメモリマップできません
+            return ids, np.empty((0, dim), dtype=manifest['dtype']), scales
+        matrix = np.memmap(os.path.join(self.dir, manifest['data']), dtype=manifest['dtype'], mode='r',
+                           shape=(rows, dim))
+        return ids, matrix, scales
+
+    def load(self, version, dtype):
+        """
+        マニフェストが指定した世代番号・保存形式のものであれば、行列を開いて返します。
+        :return: (manifest, (ids, matrix, scales))。使えるファイルがない場合はNone
+        """
+        manifest = self.read_manifest()
+        if manifest is None or manifest.get('version') != version or manifest.get('dtype') != dtype:
+            return None
+        try:
+            return manifest, self.open(manifest)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Vector file is not usable, loading from the database: {e}")
+            return None
+
+    def write(self, ids, matrix, scales, version, dtype):
+        """
+        行列全体を新しいデータファイルとサイドカーに書き出し、公開前のマニフェストを返します。
+        :param matrix: (N, dim) の行列（np.memmap の一部の行でも構いません）
+        """
+        token = self._token(version)
+        data_name = f'{os.path.basename(self.base)}.vectors-{token}.bin'
+        with open(os.path.join(self.dir, data_name), 'wb') as f:
+            for start in range(0, len(matrix), COPY_CHUNK_ROWS):
+                f.write(np.ascontiguousarray(matrix[start:start + COPY_CHUNK_ROWS], dtype=dtype).tobytes())
+        manifest = {'data': data_name, 'rows': len(ids), 'dim': int(matrix.shape[1]), 'dtype': dtype,
+                    'dead': 0, 'version': version}
+        return self._write_sidecar(manifest, token, ids, scales)
+
+    def append(self, manifest, upsert_ids, data, scales, remove_ids, version):
+        """
+        公開中のマニフェストに、ベクトルの追加・上書き・削除を反映したマニフェストを作ります。
+        上書き・削除した行は DEAD_ID にして残し、新しい行はデータファイルの末尾に追記します。
+        DEAD_ID の行が COMPACT_RATIO を超えた場合は、生きている行だけのデータファイルに書き直します。
+        :param upsert_ids: 追加・上書きするdvd_idの配列（data の行と同じ並び）
+        :param data: 保存形式に変換済みのベクトル (len(upsert_ids), dim)
+        :param scales: int8 の倍率（それ以外はNone）
+        :param remove_ids: 削除するdvd_idのリスト
+        :return: (新しいマニフェスト, compacted)。compacted がTrueの場合は行番号が変わっています
+        """
+        ids, _, old_scales = self.open(manifest)
+        touched = np.concatenate([np.asarray(upsert_ids, dtype=np.int64), np.asarray(remove_ids, dtype=np.int64)])
+        ids = ids.copy()
+        dead = np.isin(ids, touched)
+        ids[dead] = DEAD_ID
+        new_ids = np.concatenate([ids, np.asarray(upsert_ids, dtype=np.int64)])
+        new_scales = np.concatenate([old_scales, scales]) if old_scales is not None else None
+        dead_count = manifest['dead'] + int(dead.sum())
+
+        if dead_count > COMPACT_RATIO * len(new_ids):
+            _, matrix, _ = self.open(manifest)
+            live = new_ids[:len(ids)] != DEAD_ID
+            rows = np.flatnonzero(live)
+            compacted = np.concatenate([matrix[rows[start:start + COPY_CHUNK_ROWS]]
+                                        for start in range(0, len(rows), COPY_CHUNK_ROWS)] + [data])
+            keep = np.concatenate([live, np.ones(len(data), dtype=bool)])
+            return self.write(new_ids[keep], compacted, new_scales[keep] if new_scales is not None else None,
+                              version, manifest['dtype']), True
+
+        row_bytes = manifest['dim'] * np.dtype(manifest['dtype']).itemsize
+        with open(os.path.join(self.dir, manifest['data']), 'r+b') as f:
+            # 公開済みの行数の直後から書き込みます（以前に公開されなかった追記があれば上書きされます）
+            f.seek(manifest['rows'] * row_bytes)
+            f.write(np.ascontiguousarray(data, dtype=manifest['dtype']).tobytes())
+            f.truncate()
+        updated = dict(manifest, rows=len(new_ids), dead=dead_count, version=version)
+        return self._write_sidecar(updated, self._token(version), new_ids, new_scales), False
+
+    def publish(self, manifest):
+        """
+        マニフェストを一時ファイルに書き出してから置き換え、読み込み側に公開します。
+        公開中・1つ前のマニフェストが参照していないファイルは削除します
+        （既にメモリマップで開いているワーカーは、削除後もそのまま読めます）。
+        """
+        previous = self.read_manifest()
+        tmp_path = self.manifest_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(manifest, f)
+        os.replace(tmp_path, self.manifest_path)
+
+        referenced = {manifest['data'], manifest['sidecar']}
+        if previous is not None:
+            referenced.update((previous.get('data'), previous.get('sidecar')))
+        prefix = os.path.basename(self.base)
+        for pattern in (f'{prefix}.vectors-*.bin', f'{prefix}.ids-*.npz'):
+            for path in glob.glob(os.path.join(glob.escape(self.dir), pattern)):
+                if os.path.basename(path) not in referenced:
+                    try:
+                        os.remove(path)
+                    except OSError:
+                        pass
+
+    def _write_sidecar(self, manifest, token, ids, scales):
+        """
+        サイドカー（dvd_idと倍率）を新しいファイル名で書き出し、それを参照するマニフェストを返します。
+        """
+        sidecar_name = f'{os.path.basename(self.base)}.ids-{token}.npz'
+        with open(os.path.join(self.dir, sidecar_name), 'wb') as f:
+            np.savez(f, ids=np.asarray(ids, dtype=np.int64),
+                     scales=np.asarray(scales if scales is not None else [], dtype=np.float32))
+        return dict(manifest, sidecar=sidecar_name)
+
+    @staticmethod
+    def _token(version):
+        """
+        ファイル名に使う、プロセス間で重ならない文字列を返します。
+        """
+        return f'{version}-{uuid.uuid4().hex[:12]}'
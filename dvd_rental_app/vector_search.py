@@ -1,13 +1,48 @@
-import sqlite3
+import hashlib
 import numpy as np
 import os
-from sentence_transformers import SentenceTransformer
+import re
+import threading
+import time
+import unicodedata
+from collections import OrderedDict, namedtuple
+from ivf_index import IVFIndex, index_path_for
+from vector_file import VectorFile, DEAD_ID, vector_file_base
+from db import ConnectionPool
+import metrics
 
 # モデルをグローバル変数としてキャッシュし、再ロードを防ぎます
 # 多言語対応モデルを使用し、日本語のクエリでも英語や日本語の説明文を検索できるようにします
 MODEL_NAME = 'paraphrase-multilingual-MiniLM-L12-v2'
 _model = None
 
+# クエリのディスクキャッシュで、上限を超えた古いエントリを削除する間隔（プロセスごとの保存回数）
+DISK_EVICT_INTERVAL = 64
+
+# IVFインデックスを使い始める最小件数（これ未満は全件走査の方が速い）
+IVF_MIN_VECTORS = 2000
+
+# ベクトルの保存形式。float16 はメモリとディスクが半分、int8（ベクトルごとの倍率つき）は約1/4になります
+# 量子化した形式では正規化済みのベクトルを保存し、常駐行列も同じ形式で持ちます
+STORAGE_TYPES = ('float32', 'float16', 'int8')
+DEFAULT_STORAGE = os.environ.get('VECTOR_STORAGE', 'float32')
+# 量子化した行列で選んだ上位候補のうち、float32 のベクトルでスコアを計算し直す件数（0の場合は計算し直しません）
+# 1以上の場合は、float32 のベクトルを dvd_embeddings_exact に別に保存します（常駐行列には読み込みません）
+DEFAULT_RERANK = int(os.environ.get('VECTOR_RERANK', 0))
+# float16 / int8 の行列をこの行数ずつ float32 に戻してスコア計算します（一時メモリの上限）
+SCORE_CHUNK_ROWS = 4096
+# 1の場合は、常駐行列を dvd_vector.db の隣のファイルに書き出してメモリマップで共有します（vector_file.py）
+DEFAULT_MMAP = os.environ.get('VECTOR_MMAP', '0') == '1'
+
+# 検索時に使う常駐データのスナップショット
+# ids / matrix / scales: dvd_id配列と正規化済みの行列、int8の場合の行ごとの倍率（それ以外はNone）、
+# ivf / list_rows: IVFインデックスとクラスタごとの行番号、
+# genres / in_stock: 絞り込み用の属性配列、filters: 絞り込み条件ごとの (マスク, 行番号) のキャッシュ、
+# dead: メモリマップしたファイルで削除・上書きされた行（ids が DEAD_ID）の行番号（ない場合はNone）
+_Snapshot = namedtuple('_Snapshot', 'ids matrix scales ivf list_rows genres in_stock filters dead')
+# genre_idが未設定のDVDを表す値
+NO_GENRE = -1
+
 def get_model():
     """
     Embeddingモデルをロードして返します。
@@ -15,90 +50,1237 @@ def get_model():
     """
     global _model
     if _model is None:
+        # sentence_transformers（PyTorch）のimportは数秒かかるため、実際にモデルが必要になるまで遅延させます
+        from sentence_transformers import SentenceTransformer
         print(f"Loading embedding model: {MODEL_NAME}...")
         _model = SentenceTransformer(MODEL_NAME)
     return _model
 
+class QueryEmbeddingCache:
+    """
+    検索クエリのベクトルをキャッシュするクラス。
+    プロセス内のLRUキャッシュ（上限件数あり）と、gunicornの全ワーカーで共有できる
+    SQLiteファイルのキャッシュ（任意）の2段構成です。同じクエリはモデルを通さずに検索できます。
+    """
+    def __init__(self, max_entries=1024, db_path=None, max_disk_entries=100000):
+        """
+        コンストラクタ。
+        :param max_entries: プロセス内に保持する最大件数（超えた場合は最も古く使われたものから破棄）
+        :param db_path: ディスクキャッシュ用のSQLiteファイルのパス（Noneの場合はメモリのみ）
+        :param max_disk_entries: ディスクキャッシュに保持する最大件数
+        """
+        self.max_entries = max_entries
+        self.db_path = db_path
+        self.max_disk_entries = max_disk_entries
+        self._pool = ConnectionPool(db_path) if db_path else None
+        self._entries = OrderedDict()
+        self._lock = threading.Lock()
+        # 前回の古いエントリの削除から、ディスクキャッシュに保存した回数
+        self._puts_since_evict = 0
+        # キャッシュサイズ調整用のカウンタ
+        self.memory_hits = 0
+        self.disk_hits = 0
+        self.misses = 0
+        if db_path:
+            self._init_db()
+
+    def _init_db(self):
+        """
+        ディスクキャッシュのテーブルを作成します。モデルが変わった場合に備え、モデル名もキーに含めます。
+        """
+        conn = self._pool.connect()
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS query_embeddings (
+                model TEXT NOT NULL,
+                query TEXT NOT NULL,
+                embedding BLOB NOT NULL,
+                created_at DATETIME DEFAULT CURRENT_TIMESTAMP,
+                PRIMARY KEY (model, query)
+            )
+        ''')
+        # 上限を超えた古いエントリの削除で、全件を並べ替えないためのインデックス
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_query_embeddings_created_at ON query_embeddings(created_at)')
+        conn.commit()
+        conn.close()
+
+    @staticmethod
+    def normalize(query_text):
+        """
+        キャッシュのキーにするため、クエリを正規化します。
+        全角・半角の統一（NFKC）、大文字・小文字の統一、前後と連続する空白の整理を行います。
+        """
+        text = unicodedata.normalize('NFKC', query_text).lower()
+        return re.sub(r'\s+', ' ', text).strip()
+
+    def get(self, query_text):
+        """
+        キャッシュされたクエリのベクトルを返します。見つからない場合はNoneを返します。
+        """
+        key = self.normalize(query_text)
+        with self._lock:
+            embedding = self._entries.get(key)
+            if embedding is not None:
+                self._entries.move_to_end(key)
+                self.memory_hits += 1
+                return embedding
+
+        if self.db_path:
+            conn = self._pool.connect()
+            try:
+                row = conn.execute('SELECT embedding FROM query_embeddings WHERE model = ? AND query = ?',
+                                   (MODEL_NAME, key)).fetchone()
+            finally:
+                conn.close()
+            if row:
+                embedding = np.frombuffer(row[0], dtype=np.float32)
+                with self._lock:
+                    self.disk_hits += 1
+                    self._remember(key, embedding)
+                return embedding
+
+        with self._lock:
+            self.misses += 1
+        return None
+
+    def put(self, query_text, embedding):
+        """
+        クエリのベクトルをキャッシュに保存します。
+        """
+        key = self.normalize(query_text)
+        embedding = np.asarray(embedding, dtype=np.float32)
+        with self._lock:
+            self._remember(key, embedding)
+            self._puts_since_evict += 1
+            evict = self._puts_since_evict >= DISK_EVICT_INTERVAL
+            if evict:
+                self._puts_since_evict = 0
+
+        if self.db_path:
+            conn = self._pool.connect()
+            try:
+                conn.execute('INSERT OR REPLACE INTO query_embeddings (model, query, embedding) VALUES (?, ?, ?)',
+                             (MODEL_NAME, key, embedding.tobytes()))
+                if evict:
+                    # 上限を超えた分は古いものから削除します（created_at のインデックスを新しい順にたどります）。
+                    # 保存のたびではなく DISK_EVICT_INTERVAL 回に1回なので、一時的に上限を少し超えることがあります
+                    conn.execute('''
+                        DELETE FROM query_embeddings WHERE rowid IN (
+                            SELECT rowid FROM query_embeddings ORDER BY created_at DESC LIMIT -1 OFFSET ?
+                        )
+                    ''', (self.max_disk_entries,))
+                conn.commit()
+            finally:
+                conn.close()
+
+    def _remember(self, key, embedding):
+        """
+        プロセス内のLRUに追加し、上限を超えた場合は最も古く使われたものを破棄します。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        self._entries[key] = embedding
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_entries:
+            self._entries.popitem(last=False)
+
+    def stats(self):
+        """
+        キャッシュのヒット・ミス回数などを返します。
+        """
+        with self._lock:
+            lookups = self.memory_hits + self.disk_hits + self.misses
+            return {
+                'entries': len(self._entries),
+                'max_entries': self.max_entries,
+                'memory_hits': self.memory_hits,
+                'disk_hits': self.disk_hits,
+                'misses': self.misses,
+                'hit_rate': (self.memory_hits + self.disk_hits) / lookups if lookups else 0.0,
+            }
+
 class VectorSearch:
     """
     ベクトル検索機能を提供するクラス。
     SQLiteを使用してベクトルデータ（Embedding）を管理します。
+    検索時は、正規化済みのベクトルをメモリ上に常駐させた行列（float32）と
+    それに対応するdvd_idの配列を使い、1回の行列ベクトル積でスコアを計算します。
+    index='ivf' を指定すると、IVF近似最近傍インデックスで走査対象を絞り込みます。
+    storage='float16' / 'int8' を指定すると、ベクトルを量子化して保存・常駐させます。
+    mmap=True を指定すると、行列をファイルに書き出してメモリマップで開き、全ワーカーで共有します。
     """
-    def __init__(self, db_path):
+    def __init__(self, db_path, index=None, nlist=None, nprobe=None, query_cache=None, encoder=None,
+                 storage=None, rerank=None, mmap=None):
         """
         コンストラクタ。
         :param db_path: ベクトルデータを保存するSQLiteデータベースのパス
+        :param index: None（全件走査）または 'ivf'（近似最近傍インデックス）
+        :param nlist: IVFのクラスタ数（省略時は件数から自動決定）
+        :param nprobe: IVFで検索時に走査するクラスタ数。大きいほど再現率が上がり、遅くなります
+                       （省略時はクラスタ数から決めます。ivf_index.default_nprobe を参照）
+        :param query_cache: クエリのベクトルをキャッシュする QueryEmbeddingCache（Noneの場合は毎回ベクトル化）
+        :param encoder: encode() を持つエンコーダー（EmbeddingClient など）。Noneの場合はプロセス内のモデルを使います
+        :param storage: ベクトルの保存形式 'float32' / 'float16' / 'int8'（省略時は環境変数 VECTOR_STORAGE）
+        :param rerank: 量子化した形式で、float32 のベクトルでスコアを計算し直す上位候補の件数
+                       （省略時は環境変数 VECTOR_RERANK。同じDBを使うプロセスでは同じ値にします）
+        :param mmap: Trueの場合は行列をメモリマップしたファイルで共有します（省略時は環境変数 VECTOR_MMAP=1）。
+                     書き込むプロセス（embed_worker.py など）でも同じ値にすると、書き込みのたびにファイルへ追記します
         """
+        if index not in (None, 'ivf'):
+            raise ValueError(f"Unknown index type: {index}")
+        storage = storage or DEFAULT_STORAGE
+        if storage not in STORAGE_TYPES:
+            raise ValueError(f"Unknown storage type: {storage}")
         self.db_path = db_path
+        # 接続はWALモードで開き、検索・登録のたびに接続し直さないようプールで再利用します
+        self._pool = ConnectionPool(db_path)
+        self.index = index
+        self.nlist = nlist
+        self.nprobe = nprobe
+        self.index_path = index_path_for(db_path)
+        self.query_cache = query_cache
+        self.encoder = encoder
+        self.storage = storage
+        self.rerank = DEFAULT_RERANK if rerank is None else rerank
+        # メモリ常駐のベクトル行列（行ごとにL2正規化済み、storage の形式）と、対応するdvd_idの配列
+        # int8 の場合は行ごとの倍率（値 ≒ int8 * scale）を _scales に持ちます
+        self._matrix = None
+        self._scales = None
+        self._ids = None
+        # メモリマップで共有する行列ファイルと、その中で削除・上書きされた行の行番号
+        self._file = VectorFile(vector_file_base(db_path)) if (DEFAULT_MMAP if mmap is None else mmap) else None
+        self._dead = None
+        # メモリ上の行列がどのマニフェストのファイルを開いたものか（テーブルから読み込んだ場合はNone）
+        self._mapped_sidecar = None
+        # dvd_id -> 行番号 の対応表（add_dvdでの上書き用）
+        self._positions = {}
+        # IVFインデックスと、クラスタごとの行番号配列
+        self._ivf = None
+        self._list_rows = None
+        # 絞り込み用の属性（行列の行と同じ並び）と、絞り込み条件ごとのマスクのキャッシュ
+        self._genres = None
+        self._in_stock = None
+        self._filters = {}
+        # 読み込み時点のデータ世代。他のワーカーが書き込んだ場合に再読み込みを判定します
+        # version はベクトルの変更、attr_version は属性（ジャンル・在庫）だけの変更で増えます
+        self._loaded_version = None
+        self._loaded_attr_version = None
+        self._lock = threading.Lock()
         self._init_db()
 
     def _init_db(self):
         """
         データベーステーブルを初期化します。
-        dvd_id（主キー）とembedding（BLOB形式のベクトルデータ）を持つテーブルを作成します。
+        dvd_id（主キー）とembedding（BLOB形式のベクトルデータ）、ベクトル化した元テキストの
+        ハッシュ値（text_hash）、検索時の絞り込みに使う属性（genre_id, in_stock）を持つテーブルを作成します。
+        embedding の形式は dtype 列（NULLは float32、'float16'、'int8'）で表し、int8 の倍率は scale 列に保存します。
+        dvd_embeddings_exactテーブルには、量子化した形式で re-rank に使う float32 のベクトルを保存します。
+        vector_metaテーブルには、書き込みのたびに増える世代番号（version, attr_version）などを保存します。
         """
-        conn = sqlite3.connect(self.db_path)
+        conn = self._pool.connect()
         conn.execute('''
             CREATE TABLE IF NOT EXISTS dvd_embeddings (
+                dvd_id INTEGER PRIMARY KEY,
+                embedding BLOB,
+                text_hash TEXT,
+                genre_id INTEGER,
+                in_stock INTEGER DEFAULT 1
+            )
+        ''')
+        # 後から追加した列がない古いテーブルには列を追加します
+        columns = [row[1] for row in conn.execute('PRAGMA table_info(dvd_embeddings)')]
+        if 'text_hash' not in columns:
+            conn.execute('ALTER TABLE dvd_embeddings ADD COLUMN text_hash TEXT')
+        if 'genre_id' not in columns:
+            conn.execute('ALTER TABLE dvd_embeddings ADD COLUMN genre_id INTEGER')
+        if 'in_stock' not in columns:
+            conn.execute('ALTER TABLE dvd_embeddings ADD COLUMN in_stock INTEGER DEFAULT 1')
+        if 'dtype' not in columns:
+            conn.execute('ALTER TABLE dvd_embeddings ADD COLUMN dtype TEXT')
+        if 'scale' not in columns:
+            conn.execute('ALTER TABLE dvd_embeddings ADD COLUMN scale REAL')
+        # 検索時に読み込む dvd_embeddings を小さく保つため、float32 のベクトルは別テーブルに置きます
+        # 属性だけを読み込むとき（_read_attributes）に、ベクトル本体のページを読まずに済むようにします
+        conn.execute('CREATE INDEX IF NOT EXISTS idx_dvd_embeddings_attrs ON dvd_embeddings (genre_id, in_stock)')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS dvd_embeddings_exact (
                 dvd_id INTEGER PRIMARY KEY,
                 embedding BLOB
             )
         ''')
+        conn.execute('''
+            CREATE TABLE IF NOT EXISTS vector_meta (
+                key TEXT PRIMARY KEY,
+                value INTEGER
+            )
+        ''')
+        conn.execute("INSERT OR IGNORE INTO vector_meta (key, value) VALUES ('version', 0)")
+        conn.execute("INSERT OR IGNORE INTO vector_meta (key, value) VALUES ('attr_version', 0)")
         conn.commit()
         conn.close()
 
-    def add_dvd(self, dvd_id, text):
+    def _read_version(self, conn):
+        """
+        ベクトルDBのデータ世代番号を取得します。
+        """
+        row = conn.execute("SELECT value FROM vector_meta WHERE key = 'version'").fetchone()
+        return row[0] if row else 0
+
+    def _read_versions(self, conn):
+        """
+        ベクトルの世代番号と属性の世代番号を1回のSELECTで取得します。
+        """
+        values = dict(conn.execute("SELECT key, value FROM vector_meta WHERE key IN ('version', 'attr_version')"))
+        return values.get('version', 0), values.get('attr_version', 0)
+
+    def _load(self, conn):
+        """
+        dvd_embeddingsテーブル全体を読み込み、正規化済みの行列を構築します。
+        メモリマップを使う場合、同じ世代番号の行列ファイルが公開されていれば、テーブルを読まずにファイルを開きます。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        version, attr_version = self._read_versions(conn)
+        mapped = self._file.load(version, self.storage) if self._file is not None else None
+        if mapped is not None:
+            self._set_matrix(*mapped[1], manifest=mapped[0])
+            self._genres, self._in_stock = self._read_attributes(conn)
+        else:
+            rows = conn.execute('SELECT dvd_id, embedding, dtype, scale, genre_id, in_stock '
+                                'FROM dvd_embeddings ORDER BY dvd_id').fetchall()
+            if rows:
+                ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+                matrix, scales = _decode_rows(rows, self.storage)
+            else:
+                ids = np.empty(0, dtype=np.int64)
+                matrix, scales = None, None
+            if self._file is not None and rows:
+                # 次に読み込むワーカーがテーブルを読まずに済むよう、行列ファイルを書き出して公開します
+                mapped = self._publish_loaded(conn, ids, matrix, scales, version)
+            if mapped is not None:
+                self._set_matrix(*mapped[1], manifest=mapped[0])
+            else:
+                self._set_matrix(ids, matrix, scales)
+            self._genres, self._in_stock = _attribute_arrays(rows, 4)
+        self._filters = {}
+        self._loaded_version = version
+        self._loaded_attr_version = attr_version
+        if self.index == 'ivf':
+            self._attach_index()
+
+    def _set_matrix(self, ids, matrix, scales, manifest=None):
+        """
+        常駐行列とdvd_idの配列を差し替え、dvd_id -> 行番号 の対応表を作り直します。
+        呼び出し側で self._lock を保持していることを前提とします。
+        :param manifest: 行列ファイルを開いた場合は、そのマニフェスト
+        """
+        self._mapped_sidecar = manifest['sidecar'] if manifest is not None else None
+        self._ids = ids
+        self._matrix = matrix if len(ids) else None
+        self._scales = scales if len(ids) else None
+        dead = np.flatnonzero(ids == DEAD_ID)
+        self._dead = dead if len(dead) else None
+        self._positions = {dvd_id: i for i, dvd_id in enumerate(ids.tolist()) if dvd_id != DEAD_ID}
+
+    def _publish_loaded(self, conn, ids, matrix, scales, version):
+        """
+        テーブルから読み込んだ行列をファイルに書き出し、読み込んだ世代が最新のままであれば公開します。
+        書き出しは書き込みロックの外で行い、公開（マニフェストの置き換え）だけをロック中に行います。
+        :return: 公開したファイルの (manifest, (ids, matrix, scales))。公開しなかった場合はNone
+        """
+        manifest = self._file.write(ids, matrix, scales, version, self.storage)
+        conn.execute('BEGIN IMMEDIATE')
+        try:
+            if self._read_version(conn) != version:
+                # 書き出している間に他のプロセスが書き込んだ場合は、古い行列を公開しません
+                return None
+            self._file.publish(manifest)
+        finally:
+            conn.commit()
+        return manifest, self._file.open(manifest)
+
+    def _load_attributes(self, conn):
+        """
+        絞り込み用の属性（genre_id, in_stock）だけを読み込み直します。
+        在庫の増減など属性だけが変わった場合は、ベクトル本体（BLOB）を読み直す必要はありません。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        _, attr_version = self._read_versions(conn)
+        self._genres, self._in_stock = self._read_attributes(conn)
+        self._filters = {}
+        self._loaded_attr_version = attr_version
+
+    def _read_attributes(self, conn):
+        """
+        属性を読み込み、常駐行列の行と同じ並びの (genres, in_stock) を返します。
+        idx_dvd_embeddings_attrs だけを読むため、ベクトル本体のページは読みません。
+        """
+        rows = conn.execute('SELECT dvd_id, genre_id, in_stock FROM dvd_embeddings').fetchall()
+        genres = np.full(len(self._ids), NO_GENRE, dtype=np.int64)
+        in_stock = np.ones(len(self._ids), dtype=bool)
+        if not rows or not len(self._ids):
+            return genres, in_stock
+        # dvd_id から行番号への対応は、Pythonのループではなく二分探索でまとめて求めます
+        dvd_ids = np.fromiter((r[0] for r in rows), dtype=np.int64, count=len(rows))
+        row_genres, row_in_stock = _attribute_arrays(rows, 1)
+        sorter = np.argsort(self._ids, kind='stable')
+        loc = np.minimum(np.searchsorted(self._ids, dvd_ids, sorter=sorter), len(self._ids) - 1)
+        pos = sorter[loc]
+        found = self._ids[pos] == dvd_ids
+        genres[pos[found]] = row_genres[found]
+        in_stock[pos[found]] = row_in_stock[found]
+        return genres, in_stock
+
+    def _attach_index(self):
+        """
+        保存済みのIVFインデックスを読み込み、常駐行列と突き合わせます。
+        ファイルがない場合は学習して保存し、インデックスに未登録のベクトルがあれば割り当てます。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        self._ivf = None
+        self._list_rows = None
+        if self._matrix is None or len(self._positions) < IVF_MIN_VECTORS:
+            # 件数が少ないうちは全件走査の方が速いため、インデックスを使いません
+            return
+
+        ivf = IVFIndex.load(self.index_path)
+        if ivf is None or ivf.centroids.shape[1] != self._matrix.shape[1]:
+            print(f"Training IVF index for {len(self._positions)} vectors...")
+            ivf = IVFIndex.train(*self._live_rows(), self.nlist)
+            ivf.version = self._loaded_version
+            ivf.save(self.index_path)
+        elif ivf.version != self._loaded_version:
+            # 他プロセスの書き込みで漏れたベクトルを割り当て、削除済みのものを取り除きます
+            keep = np.isin(ivf.ids, self._ids)
+            ivf.ids, ivf.lists = ivf.ids[keep], ivf.lists[keep]
+            missing = np.flatnonzero(~np.isin(self._ids, ivf.ids) & (self._ids != DEAD_ID))
+            if len(missing):
+                ivf.ids = np.concatenate([ivf.ids, self._ids[missing]])
+                ivf.lists = np.concatenate([ivf.lists, ivf.assign(self._matrix[missing])])
+
+        self._ivf = ivf
+        self._build_list_rows()
+
+    def _live_rows(self):
+        """
+        削除・上書きされた行（DEAD_ID）を除いた (ids, matrix) を返します（IVFの学習用）。
+        """
+        if self._dead is None:
+            return self._ids, self._matrix
+        live = np.flatnonzero(self._ids != DEAD_ID)
+        return self._ids[live], self._matrix[live]
+
+    def _build_list_rows(self):
+        """
+        クラスタ番号ごとに、常駐行列の行番号の配列をまとめます。
+        検索中のスナップショットを壊さないよう、常に新しいリストを作って差し替えます。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        ivf = self._ivf
+        sorter = np.argsort(self._ids)
+        rows = sorter[np.searchsorted(self._ids, ivf.ids, sorter=sorter)]
+        order = np.argsort(ivf.lists, kind='stable')
+        bounds = np.cumsum(np.bincount(ivf.lists, minlength=ivf.nlist))
+        self._list_rows = np.split(rows[order], bounds[:-1])
+
+    def _ensure_loaded(self):
+        """
+        行列が未読み込み、または他プロセスの書き込みで古くなっている場合に読み込み直します。
+        世代番号の確認は1行のSELECTだけなので、通常の検索ではテーブル全体を読みません。
+        :return: _Snapshot。検索中に他スレッドが更新しても影響を受けないスナップショットです
+        """
+        conn = self._pool.connect()
+        try:
+            with self._lock:
+                version, attr_version = self._read_versions(conn)
+                if self._loaded_version is None or version != self._loaded_version:
+                    self._load(conn)
+                elif attr_version != self._loaded_attr_version:
+                    self._load_attributes(conn)
+                return _Snapshot(self._ids, self._matrix, self._scales, self._ivf, self._list_rows,
+                                 self._genres, self._in_stock, self._filters, self._dead)
+        finally:
+            conn.close()
+
+    def _upsert_resident(self, ids, vectors):
+        """
+        メモリ上の行列に複数のベクトルを追加（既存のdvd_idは上書き）します。
+        検索中のスナップショットに影響しないよう、上書きも新しい配列に書き込んでから差し替えます（_remove_resident と同じ）。
+        呼び出し側で self._lock を保持していることを前提とします。
+        :param ids: 重複のないdvd_idのリスト
+        :param vectors: 正規化済みのベクトル (len(ids), dim)
+        """
+        data, scales = _quantize(vectors, self.storage)
+        new_ids, new_rows = [], []
+        positions, rows = [], []
+        for i, dvd_id in enumerate(ids):
+            pos = self._positions.get(dvd_id)
+            if pos is not None:
+                positions.append(pos)
+                rows.append(i)
+            else:
+                new_ids.append(dvd_id)
+                new_rows.append(i)
+        if positions:
+            matrix = self._matrix.copy()
+            matrix[positions] = data[rows]
+            if scales is not None:
+                scales_copy = self._scales.copy()
+                scales_copy[positions] = scales[rows]
+                self._scales = scales_copy
+            self._matrix = matrix
+        if not new_ids:
+            return
+
+        start = len(self._ids)
+        if self._matrix is None:
+            self._matrix = data[new_rows]
+            self._scales = scales[new_rows] if scales is not None else None
+        else:
+            self._matrix = np.vstack([self._matrix, data[new_rows]])
+            if scales is not None:
+                self._scales = np.concatenate([self._scales, scales[new_rows]])
+        self._ids = np.concatenate([self._ids, np.asarray(new_ids, dtype=np.int64)])
+        # 新しい行の属性は未設定（ジャンルなし・在庫あり）で追加し、必要に応じて _apply_attributes で上書きします
+        self._genres = np.concatenate([self._genres, np.full(len(new_ids), NO_GENRE, dtype=np.int64)])
+        self._in_stock = np.concatenate([self._in_stock, np.ones(len(new_ids), dtype=bool)])
+        self._filters = {}
+        for i, dvd_id in enumerate(new_ids):
+            self._positions[dvd_id] = start + i
+
+    def _update_file(self, upsert_ids, vectors, remove_ids, version, in_sync):
+        """
+        公開中の行列ファイルにベクトルの追加・上書き・削除を追記し、新しい世代として公開します。
+        書き込みトランザクションの中で、self._lock を保持した状態で呼び出します。
+        公開中のファイルが1つ前の世代でない場合（ファイルを使わないプロセスが書き込んだ場合など）は追記せず、
+        次に読み込むワーカーがテーブルから作り直します。
+        :param vectors: upsert_ids の正規化済みのベクトル（削除だけの場合はNone）
+        :param in_sync: メモリ上の行列が1つ前の世代のものかどうか
+        :return: メモリ上の行列を新しい世代に差し替えた場合はTrue（IVFインデックスの差分反映に使います）
+        """
+        manifest = self._file.read_manifest()
+        if manifest is None or manifest.get('version') != version - 1 or manifest.get('dtype') != self.storage:
+            return False
+        if vectors is not None:
+            data, scales = _quantize(vectors, self.storage)
+        else:
+            data = np.empty((0, manifest['dim']), dtype=self.storage)
+            scales = np.empty(0, dtype=np.float32) if self.storage == 'int8' else None
+        # メモリ上の行列がこのファイルを開いたものでなければ、行番号が一致しません
+        in_sync = in_sync and self._mapped_sidecar == manifest['sidecar']
+        try:
+            manifest, compacted = self._file.append(manifest, upsert_ids, data, scales, remove_ids, version)
+            self._file.publish(manifest)
+        except (OSError, ValueError, KeyError) as e:
+            print(f"Updating the vector file failed, it will be rebuilt on the next load: {e}")
+            return False
+        if not in_sync or compacted:
+            # 書き直しで行番号が変わった場合は、次回検索時にファイルを開き直します
+            return False
+
+        # 追記では既存の行の行番号は変わらないため、追加した行の分だけ対応表と属性を更新します
+        ids, matrix, scales = self._file.open(manifest)
+        start = len(self._ids)
+        genres = np.concatenate([self._genres, np.full(len(upsert_ids), NO_GENRE, dtype=np.int64)])
+        in_stock = np.concatenate([self._in_stock, np.ones(len(upsert_ids), dtype=bool)])
+        for i, dvd_id in enumerate(upsert_ids):
+            pos = self._positions.get(dvd_id)
+            if pos is not None:
+                # 上書きしたベクトルは、古い行の属性を引き継ぎます
+                genres[start + i] = genres[pos]
+                in_stock[start + i] = in_stock[pos]
+            self._positions[dvd_id] = start + i
+        for dvd_id in remove_ids:
+            self._positions.pop(dvd_id, None)
+        self._ids, self._matrix, self._scales = ids, matrix, scales
+        self._mapped_sidecar = manifest['sidecar']
+        dead = np.flatnonzero(ids == DEAD_ID)
+        self._dead = dead if len(dead) else None
+        self._genres, self._in_stock = genres, in_stock
+        self._filters = {}
+        self._loaded_version = version
+        return True
+
+    def _upsert_index(self, ids, vectors, version, in_sync):
+        """
+        IVFインデックスに複数のベクトルを反映し、ファイルに保存します。
+        書き込みトランザクション中に呼び出すことで、複数ワーカーの保存が競合しないようにします。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        if in_sync and self._ivf is None:
+            # 件数がしきい値を超えた時点でインデックスを使い始めます
+            self._attach_index()
+        elif in_sync:
+            self._ivf.add_many(ids, vectors)
+            self._ivf.version = version
+            self._ivf.save(self.index_path)
+            self._build_list_rows()
+        else:
+            # メモリ上の状態が古い場合は、保存済みのインデックスに直接追加します
+            ivf = IVFIndex.load(self.index_path)
+            if ivf is not None and ivf.centroids.shape[1] == vectors.shape[1]:
+                ivf.add_many(ids, vectors)
+                ivf.version = version
+                ivf.save(self.index_path)
+
+    def warm_up(self):
+        """
+        モデルのロードと試験的なベクトル化、ベクトル行列の読み込みを事前に行います。
+        gunicornの preload_app で fork 前に呼び出すと、全ワーカーがモデルと行列を
+        コピーオンライトで共有し、最初の検索が待たされなくなります。
+        """
+        self.get_encoder().encode('ウォームアップ')
+        self._ensure_loaded()
+
+    def get_encoder(self):
+        """
+        ベクトル化に使うエンコーダーを返します。
+        共有Embeddingサーバーのクライアントが指定されていればそれを、なければプロセス内のモデルを使います。
+        """
+        return self.encoder if self.encoder is not None else get_model()
+
+    def add_dvd(self, dvd_id, text, genre_id=None, in_stock=True):
         """
         DVDのテキスト情報をベクトル化してデータベースに保存します。
+        読み込み済みのメモリ上の行列（とIVFインデックス）にも同じベクトルを反映します。
+        テキストが前回保存時から変わっていない場合はベクトル化を省略します。
         :param dvd_id: DVDの一意なID
         :param text: ベクトル化する対象のテキスト（タイトル、説明文など）
+        :param genre_id: 検索時の絞り込みに使うジャンルID
+        :param in_stock: 在庫があるかどうか（検索時の絞り込み用）
         """
-        model = get_model()
-        # テキストをベクトル（数値の配列）に変換
-        embedding = model.encode(text)
-        # NumPy配列をバイト列（BLOB）に変換して保存用にシリアライズ
-        blob = embedding.astype(np.float32).tobytes()
-        
-        conn = sqlite3.connect(self.db_path)
-        # 既に存在する場合は上書き（REPLACE）
-        conn.execute('INSERT OR REPLACE INTO dvd_embeddings (dvd_id, embedding) VALUES (?, ?)', 
-                     (dvd_id, blob))
-        conn.commit()
-        conn.close()
+        self.add_many([(dvd_id, text)], attributes={dvd_id: (genre_id, in_stock)})
+
+    def add_many(self, items, batch_size=32, meta=None, attributes=None):
+        """
+        複数のDVDをまとめてベクトル化し、1つのトランザクションで保存します。
+        text_hashが保存済みの値と一致するDVD（内容が変わっていないもの）はベクトル化しません。
+        :param items: (dvd_id, text) のリスト。同じdvd_idが複数ある場合は最後のものを使います
+        :param batch_size: model.encode に渡すバッチサイズ
+        :param meta: 同じトランザクションで vector_meta に保存する {key: value}（再開用のチェックポイントなど）
+        :param attributes: 同じトランザクションで保存する絞り込み用の属性 {dvd_id: (genre_id, in_stock)}
+        :return: 実際にベクトル化して保存した件数
+        """
+        texts = {}
+        for dvd_id, text in items:
+            texts[int(dvd_id)] = text
+        hashes = {dvd_id: text_hash(text) for dvd_id, text in texts.items()}
+
+        conn = self._pool.connect()
+        try:
+            # 保存済みのハッシュ値と比較して、変更のあったDVDだけを対象にします
+            stored = {}
+            ids = list(texts)
+            for start in range(0, len(ids), 500):
+                chunk = ids[start:start + 500]
+                placeholders = ','.join('?' * len(chunk))
+                stored.update(conn.execute(
+                    f'SELECT dvd_id, text_hash FROM dvd_embeddings WHERE dvd_id IN ({placeholders})', chunk))
+            changed = [dvd_id for dvd_id in ids if stored.get(dvd_id) != hashes[dvd_id]]
+
+            if changed:
+                # テキストをまとめてベクトル化（1件ずつ呼ぶより大幅に速い）
+                start = time.perf_counter()
+                embeddings = self.get_encoder().encode([texts[i] for i in changed], batch_size=batch_size)
+                embeddings = np.asarray(embeddings, dtype=np.float32).reshape(len(changed), -1)
+                metrics.observe('dvd_vector_add_encode_seconds', time.perf_counter() - start)
+
+            with self._lock:
+                # 世代番号の確認と書き込みを同じ書き込みトランザクション内で行います
+                conn.execute('BEGIN IMMEDIATE')
+                if changed:
+                    in_sync = self._loaded_version is not None and self._read_version(conn) == self._loaded_version
+                    vectors = _normalize_rows(embeddings)
+                    # 既に存在する場合はベクトルだけを上書きします（絞り込み用の属性は残します）
+                    conn.executemany(
+                        'INSERT INTO dvd_embeddings (dvd_id, embedding, dtype, scale, text_hash) VALUES (?, ?, ?, ?, ?) '
+                        'ON CONFLICT(dvd_id) DO UPDATE SET embedding = excluded.embedding, dtype = excluded.dtype, '
+                        'scale = excluded.scale, text_hash = excluded.text_hash',
+                        [(dvd_id,) + blob + (hashes[dvd_id],)
+                         for dvd_id, blob in zip(changed, self._encode_blobs(embeddings, vectors))])
+                    self._write_exact(conn, changed, embeddings)
+                    conn.execute("UPDATE vector_meta SET value = value + 1 WHERE key = 'version'")
+                    version = self._read_version(conn)
+
+                    # 自分が最新の状態を持っている場合のみ差分反映し、そうでなければ次回検索時に再読み込み
+                    if self._file is not None:
+                        in_sync = self._update_file(changed, vectors, [], version, in_sync)
+                    elif in_sync:
+                        self._upsert_resident(changed, vectors)
+                        self._loaded_version = version
+                    if self.index == 'ivf':
+                        self._upsert_index(changed, vectors, version, in_sync)
+                if attributes:
+                    self._write_attributes(conn, attributes)
+                for key, value in (meta or {}).items():
+                    conn.execute('INSERT OR REPLACE INTO vector_meta (key, value) VALUES (?, ?)', (key, value))
+                conn.commit()
+            if changed:
+                metrics.inc('dvd_vector_added_total', value=len(changed))
+            return len(changed)
+        finally:
+            conn.close()
 
-    def search(self, query_text, limit=5):
+    def _encode_blobs(self, embeddings, vectors):
+        """
+        dvd_embeddings に保存する (embedding, dtype, scale) を行ごとに作ります。
+        float32 はモデルの出力をそのまま、float16 / int8 は正規化済みのベクトルを量子化して保存します。
+        :param embeddings: モデルの出力 (N, dim)
+        :param vectors: embeddings を正規化したもの
+        """
+        if self.storage == 'float32':
+            return [(vec.tobytes(), None, None) for vec in embeddings]
+        data, scales = _quantize(vectors, self.storage)
+        return [(data[i].tobytes(), self.storage, float(scales[i]) if scales is not None else None)
+                for i in range(len(data))]
+
+    def _write_exact(self, conn, ids, embeddings):
+        """
+        re-rank に使う float32 のベクトルを dvd_embeddings_exact に保存します。
+        re-rank しない設定の場合は、古いベクトルが使われないよう削除します。
+        書き込みトランザクションの中で呼び出します。
+        """
+        if self.storage != 'float32' and self.rerank > 0:
+            conn.executemany('INSERT OR REPLACE INTO dvd_embeddings_exact (dvd_id, embedding) VALUES (?, ?)',
+                             [(dvd_id, embeddings[i].tobytes()) for i, dvd_id in enumerate(ids)])
+        else:
+            conn.executemany('DELETE FROM dvd_embeddings_exact WHERE dvd_id = ?', [(dvd_id,) for dvd_id in ids])
+
+    def remove_many(self, dvd_ids):
+        """
+        DVDのベクトルを削除します（DVDの削除時や、説明文が空になった場合）。
+        読み込み済みのメモリ上の行列とIVFインデックスからも取り除くため、削除したDVDが上位k件の枠を使うことはありません。
+        :param dvd_ids: 削除するdvd_idのリスト（未登録のものは無視します）
+        :return: 実際に削除した件数
+        """
+        ids = sorted({int(dvd_id) for dvd_id in dvd_ids})
+        if not ids:
+            return 0
+        conn = self._pool.connect()
+        try:
+            with self._lock:
+                conn.execute('BEGIN IMMEDIATE')
+                in_sync = self._loaded_version is not None and self._read_version(conn) == self._loaded_version
+                removed = 0
+                for start in range(0, len(ids), 500):
+                    chunk = ids[start:start + 500]
+                    placeholders = ','.join('?' * len(chunk))
+                    removed += conn.execute(f'DELETE FROM dvd_embeddings WHERE dvd_id IN ({placeholders})',
+                                            chunk).rowcount
+                    conn.execute(f'DELETE FROM dvd_embeddings_exact WHERE dvd_id IN ({placeholders})', chunk)
+                if removed:
+                    conn.execute("UPDATE vector_meta SET value = value + 1 WHERE key = 'version'")
+                    version = self._read_version(conn)
+                    if self._file is not None:
+                        in_sync = self._update_file([], None, ids, version, in_sync)
+                    elif in_sync:
+                        self._remove_resident(ids)
+                        self._loaded_version = version
+                    if self.index == 'ivf':
+                        self._remove_from_index(ids, version, in_sync)
+                conn.commit()
+            return removed
+        finally:
+            conn.close()
+
+    def remove_dvd(self, dvd_id):
+        """
+        1件のDVDのベクトルを削除します。
+        """
+        return self.remove_many([dvd_id])
+
+    def _remove_resident(self, ids):
+        """
+        メモリ上の行列と属性から、指定したdvd_idの行を取り除きます。
+        検索中のスナップショットに影響しないよう、新しい配列を作って差し替えます。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        if self._matrix is None:
+            return
+        keep = ~np.isin(self._ids, np.asarray(ids, dtype=np.int64))
+        if keep.all():
+            return
+        self._ids = self._ids[keep]
+        self._matrix = self._matrix[keep] if keep.any() else None
+        if self._scales is not None:
+            self._scales = self._scales[keep] if keep.any() else None
+        self._genres = self._genres[keep]
+        self._in_stock = self._in_stock[keep]
+        self._filters = {}
+        self._positions = {int(dvd_id): i for i, dvd_id in enumerate(self._ids)}
+
+    def _remove_from_index(self, ids, version, in_sync):
+        """
+        IVFインデックスから削除したベクトルを取り除き、ファイルに保存します。
+        呼び出し側で self._lock を保持していることを前提とします。
+        """
+        if in_sync:
+            if self._ivf is None:
+                return
+            if self._matrix is None or len(self._positions) < IVF_MIN_VECTORS:
+                # 件数がしきい値を下回った場合は全件走査に戻します
+                self._ivf = None
+                self._list_rows = None
+                return
+            self._ivf.remove_many(ids)
+            self._ivf.version = version
+            self._ivf.save(self.index_path)
+            self._build_list_rows()
+        else:
+            ivf = IVFIndex.load(self.index_path)
+            if ivf is not None and ivf.remove_many(ids):
+                ivf.version = version
+                ivf.save(self.index_path)
+
+    def stored_state(self):
+        """
+        保存済みのベクトルの状態を、ベクトル本体（BLOB）を読まずに返します（整合性チェック用）。
+        :return: {dvd_id: (text_hash, genre_id, in_stock)}
+        """
+        conn = self._pool.connect()
+        try:
+            return {dvd_id: (hash_value, genre_id, in_stock != 0) for dvd_id, hash_value, genre_id, in_stock in
+                    conn.execute('SELECT dvd_id, text_hash, genre_id, in_stock FROM dvd_embeddings')}
+        finally:
+            conn.close()
+
+    def vacuum(self):
+        """
+        削除で空いた領域を解放し、dvd_vector.db のファイルを小さくします。
+        """
+        conn = self._pool.connect()
+        try:
+            conn.execute('VACUUM')
+        finally:
+            conn.close()
+
+    def convert_storage(self, chunk_size=1000):
+        """
+        保存形式が self.storage と違うベクトルを、self.storage の形式で保存し直します（VECTOR_STORAGE の切り替え後に使います）。
+        変換元には dvd_embeddings_exact の float32 のベクトルがあればそれを、なければ保存済みの値を使います
+        （int8 から float32 に戻す場合など、量子化で失われた精度は戻りません）。
+        他のワーカーは世代番号の変化を見て、次回検索時に読み込み直します。
+        :param chunk_size: 1つのトランザクションで保存し直す件数
+        :return: 保存し直した件数
+        """
+        target = None if self.storage == 'float32' else self.storage
+        converted = 0
+        after_id = 0
+        conn = self._pool.connect()
+        try:
+            while True:
+                rows = conn.execute('''
+                    SELECT e.dvd_id, e.embedding, e.dtype, e.scale, x.embedding
+                    FROM dvd_embeddings e
+                    LEFT JOIN dvd_embeddings_exact x ON e.dvd_id = x.dvd_id
+                    WHERE e.dvd_id > ? AND e.dtype IS NOT ?
+                    ORDER BY e.dvd_id
+                    LIMIT ?
+                ''', (after_id, target, chunk_size)).fetchall()
+                if not rows:
+                    break
+                ids = [r[0] for r in rows]
+                embeddings = np.vstack([np.frombuffer(r[4], dtype=np.float32) if r[4] is not None
+                                        else _decode_blob(r[1], r[2], r[3]) for r in rows])
+                with self._lock:
+                    conn.execute('BEGIN IMMEDIATE')
+                    conn.executemany('UPDATE dvd_embeddings SET embedding = ?, dtype = ?, scale = ? WHERE dvd_id = ?',
+                                     [blob + (dvd_id,) for dvd_id, blob in
+                                      zip(ids, self._encode_blobs(embeddings, _normalize_rows(embeddings)))])
+                    self._write_exact(conn, ids, embeddings)
+                    conn.execute("UPDATE vector_meta SET value = value + 1 WHERE key = 'version'")
+                    conn.commit()
+                converted += len(rows)
+                after_id = ids[-1]
+            return converted
+        finally:
+            conn.close()
+
+    def memory_usage(self):
+        """
+        メモリに常駐させているベクトル行列（int8 の倍率を含む）のバイト数を返します。
+        """
+        snapshot = self._ensure_loaded()
+        if snapshot.matrix is None:
+            return 0
+        return snapshot.matrix.nbytes + (snapshot.scales.nbytes if snapshot.scales is not None else 0)
+
+    def set_attributes(self, attributes):
+        """
+        絞り込み用の属性（ジャンル・在庫の有無）だけを更新します。ベクトルの再計算は行いません。
+        :param attributes: {dvd_id: (genre_id, in_stock)}
+        """
+        if not attributes:
+            return
+        conn = self._pool.connect()
+        try:
+            with self._lock:
+                conn.execute('BEGIN IMMEDIATE')
+                self._write_attributes(conn, attributes)
+                conn.commit()
+        finally:
+            conn.close()
+
+    def set_in_stock(self, dvd_id, in_stock):
+        """
+        在庫の有無だけを更新します（貸出・返却で在庫が0をまたいだときに呼び出します）。
+        ジャンルは保存済みの値をそのまま使います。
+        """
+        conn = self._pool.connect()
+        try:
+            with self._lock:
+                conn.execute('BEGIN IMMEDIATE')
+                row = conn.execute('SELECT genre_id FROM dvd_embeddings WHERE dvd_id = ?', (dvd_id,)).fetchone()
+                if row is not None:
+                    self._write_attributes(conn, {dvd_id: (row[0], in_stock)})
+                conn.commit()
+        finally:
+            conn.close()
+
+    def _write_attributes(self, conn, attributes):
+        """
+        属性を書き込み、attr_version を進めます。メモリ上の属性が最新の場合は差分だけ反映します。
+        書き込みトランザクションの中で、self._lock を保持した状態で呼び出します。
+        ベクトルが未登録のDVD（説明文がないものなど）は対象外です。
+        """
+        rows = [(genre_id, 1 if in_stock else 0, int(dvd_id)) for dvd_id, (genre_id, in_stock) in attributes.items()]
+        version, attr_version = self._read_versions(conn)
+        in_sync = version == self._loaded_version and attr_version == self._loaded_attr_version
+        conn.executemany('UPDATE dvd_embeddings SET genre_id = ?, in_stock = ? WHERE dvd_id = ?', rows)
+        conn.execute("UPDATE vector_meta SET value = value + 1 WHERE key = 'attr_version'")
+        if not in_sync:
+            # 古い状態を持っている場合は、次回検索時に読み込み直します
+            return
+        # 検索中のスナップショットに影響しないよう、コピーを更新してから差し替えます
+        genres = self._genres.copy()
+        in_stock = self._in_stock.copy()
+        for genre_id, stock, dvd_id in rows:
+            pos = self._positions.get(dvd_id)
+            if pos is not None:
+                genres[pos] = NO_GENRE if genre_id is None else genre_id
+                in_stock[pos] = stock != 0
+        self._genres, self._in_stock = genres, in_stock
+        self._filters = {}
+        self._loaded_attr_version = attr_version + 1
+
+    def get_meta(self, key, default=None):
+        """
+        vector_meta に保存された値を取得します。
+        """
+        conn = self._pool.connect()
+        try:
+            row = conn.execute('SELECT value FROM vector_meta WHERE key = ?', (key,)).fetchone()
+            return row[0] if row else default
+        finally:
+            conn.close()
+
+    def delete_meta(self, key):
+        """
+        vector_meta から値を削除します。
+        """
+        conn = self._pool.connect()
+        try:
+            conn.execute('DELETE FROM vector_meta WHERE key = ?', (key,))
+            conn.commit()
+        finally:
+            conn.close()
+
+    def rebuild_index(self, nlist=None):
+        """
+        現在の全ベクトルでIVFインデックスを学習し直して保存します。
+        件数が大きく増えてクラスタ数が合わなくなった場合などに使います。
+        """
+        if nlist is not None:
+            self.nlist = nlist
+        self._ensure_loaded()
+        with self._lock:
+            if self._matrix is None:
+                return
+            ivf = IVFIndex.train(*self._live_rows(), self.nlist)
+            ivf.version = self._loaded_version
+            ivf.save(self.index_path)
+            if self.index == 'ivf':
+                self._attach_index()
+
+    def search(self, query_text, limit=5, nprobe=None, candidate_ids=None, genre_id=None, in_stock=None):
         """
         入力されたクエリテキストに意味的に近いDVDを検索します。
         :param query_text: 検索キーワードや文章
         :param limit: 取得する最大件数
+        :param nprobe: IVFで走査するクラスタ数（省略時はコンストラクタの値）
+        :param candidate_ids: 検索対象とするdvd_idの集合（Noneの場合は全件）
+        :param genre_id: 指定したジャンルのDVDだけを検索します
+        :param in_stock: Trueの場合は在庫のあるDVDだけ、Falseの場合は在庫のないDVDだけを検索します
         :return: {'dvd_id': int, 'score': float} のリスト（スコア降順）
         """
-        model = get_model()
+        query_embedding = self.encode_query(query_text)
+        return self.search_by_vector(query_embedding, limit, nprobe=nprobe, candidate_ids=candidate_ids,
+                                     genre_id=genre_id, in_stock=in_stock)
+
+    def encode_query(self, query_text):
+        """
+        クエリをベクトル化します。キャッシュにある場合はモデルを使わずに返します。
+        かかった時間は、キャッシュとモデルのどちらから返したかを付けて計測します（metrics.py）。
+        """
+        start = time.perf_counter()
+        if self.query_cache is not None:
+            query_embedding = self.query_cache.get(query_text)
+            if query_embedding is not None:
+                metrics.observe('dvd_vector_encode_seconds', time.perf_counter() - start, {'source': 'cache'})
+                return query_embedding
+
         # クエリをベクトル化
-        query_embedding = model.encode(query_text)
-        
-        conn = sqlite3.connect(self.db_path)
-        cursor = conn.execute('SELECT dvd_id, embedding FROM dvd_embeddings')
-        rows = cursor.fetchall()
-        conn.close()
-        
-        # すべてのDVDベクトルとの類似度（スコア）を計算
-        results = []
-        for dvd_id, blob in rows:
-            # BLOBからNumPy配列に復元
-            doc_embedding = np.frombuffer(blob, dtype=np.float32)
-            
-            # コサイン類似度の計算: (A . B) / (||A|| * ||B||)
-            norm_q = np.linalg.norm(query_embedding)
-            norm_d = np.linalg.norm(doc_embedding)
-            
-            if norm_q == 0 or norm_d == 0:
-                score = 0
-            else:
-                score = np.dot(query_embedding, doc_embedding) / (norm_q * norm_d)
-                
-            results.append({'dvd_id': dvd_id, 'score': float(score)})
-            
-        # スコアが高い順にソートして上位を返す
-        results.sort(key=lambda x: x['score'], reverse=True)
+        query_embedding = self.get_encoder().encode(query_text)
+        if self.query_cache is not None:
+            self.query_cache.put(query_text, query_embedding)
+        metrics.observe('dvd_vector_encode_seconds', time.perf_counter() - start, {'source': 'model'})
+        return query_embedding
+
+    def search_by_vector(self, query_embedding, limit=5, nprobe=None, exact=False, candidate_ids=None,
+                         genre_id=None, in_stock=None):
+        """
+        ベクトル化済みのクエリで検索します（モデルを介さない検索処理の本体）。
+        絞り込み条件（candidate_ids, genre_id, in_stock）は上位k件を選ぶ前に適用するため、結果が減りません。
+        :param query_embedding: クエリのベクトル
+        :param limit: 取得する最大件数
+        :param nprobe: IVFで走査するクラスタ数（省略時はコンストラクタの値）
+        :param exact: Trueの場合はインデックスを使わず全件走査します
+        :param candidate_ids: 検索対象とするdvd_idの集合
+        :param genre_id: 指定したジャンルのDVDだけを検索します
+        :param in_stock: Trueの場合は在庫のあるDVDだけ、Falseの場合は在庫のないDVDだけを検索します
+        :return: {'dvd_id': int, 'score': float} のリスト（スコア降順）
+        """
+        snapshot = self._ensure_loaded()
+        ids, matrix, scales = snapshot.ids, snapshot.matrix, snapshot.scales
+        ivf, list_rows = snapshot.ivf, snapshot.list_rows
+        if matrix is None or limit <= 0:
+            return []
+
+        query = np.asarray(query_embedding, dtype=np.float32)
+        norm_q = np.linalg.norm(query)
+        if norm_q == 0:
+            return []
+        query = query / norm_q
+
+        # 走査の時間と、スコアを計算した行数を計測します（mode: ivf / filtered / full）
+        start = time.perf_counter()
+        allowed, allowed_rows = _filter_rows(snapshot, genre_id, in_stock)
+        if candidate_ids is not None:
+            candidates = np.isin(ids, np.fromiter(candidate_ids, dtype=np.int64))
+            allowed = candidates if allowed is None else allowed & candidates
+            allowed_rows = None
+
+        # 量子化した行列では上位 rerank 件まで候補を選び、float32 のベクトルで並べ替えてから limit 件に絞ります
+        rerank = self.storage != 'float32' and self.rerank > 0
+        depth = max(limit, self.rerank) if rerank else limit
+        results = None
+        if ivf is not None and not exact:
+            # 近いクラスタに属する行だけを走査します
+            probed = ivf.probe(query, nprobe or self.nprobe)
+            rows = np.concatenate([list_rows[i] for i in probed])
+            if allowed is not None:
+                rows = rows[allowed[rows]]
+            if len(rows) >= limit:
+                results = self._score_rows(ids, matrix, scales, rows, query, depth)
+                mode, scored = 'ivf', len(rows)
+            # 候補がlimitに満たない場合は全件走査に切り替えます
+
+        if results is None and allowed is not None:
+            # 絞り込み後の行（ジャンルごとの区画）だけをスコア計算します
+            if allowed_rows is None:
+                allowed_rows = np.flatnonzero(allowed)
+            results = self._score_rows(ids, matrix, scales, allowed_rows, query, depth)
+            mode, scored = 'filtered', len(allowed_rows)
+
+        if results is None:
+            # 行列は正規化済みなので、内積がそのままコサイン類似度になります
+            scores = _dot(matrix, scales, query)
+            if snapshot.dead is not None:
+                # メモリマップしたファイルで削除・上書きされた行は選ばれないようにします
+                scores[snapshot.dead] = -np.inf
+            top = _top_k(scores, depth)
+            results = [{'dvd_id': int(ids[i]), 'score': float(scores[i])} for i in top if scores[i] > -np.inf]
+            mode, scored = 'full', len(ids)
+        if rerank:
+            results = self._rerank(results, query, limit)
+        metrics.observe('dvd_vector_scan_seconds', time.perf_counter() - start, {'mode': mode})
+        metrics.observe('dvd_vector_candidates_scored', scored)
+        return results
+
+    def _score_rows(self, ids, matrix, scales, rows, query, limit):
+        """
+        指定した行だけをスコア計算し、上位limit件を返します。
+        """
+        if len(rows) == 0:
+            return []
+        scores = _dot(matrix, scales, query, rows)
+        top = _top_k(scores, limit)
+        return [{'dvd_id': int(ids[rows[i]]), 'score': float(scores[i])} for i in top]
+
+    def _rerank(self, results, query, limit):
+        """
+        量子化した行列で選んだ候補を、保存済みの float32 のベクトルでスコアを計算し直して並べ替えます。
+        候補の件数分だけ主キーで読むため、テーブル全体は読みません。
+        float32 のベクトルがない候補（re-rank しない設定で保存されたもの）は、量子化したスコアのまま使います。
+        :param query: 正規化済みのクエリ
+        """
+        if not results:
+            return results
+        ids = [r['dvd_id'] for r in results]
+        placeholders = ','.join('?' * len(ids))
+        conn = self._pool.connect()
+        try:
+            # float32 で保存された行は embedding そのものが float32 のベクトルです
+            exact = dict(conn.execute(f'''
+                SELECT e.dvd_id, CASE WHEN e.dtype IS NULL THEN e.embedding ELSE x.embedding END
+                FROM dvd_embeddings e
+                LEFT JOIN dvd_embeddings_exact x ON e.dvd_id = x.dvd_id
+                WHERE e.dvd_id IN ({placeholders})
+            ''', ids))
+        finally:
+            conn.close()
+        for r in results:
+            blob = exact.get(r['dvd_id'])
+            if blob is not None:
+                vec = np.frombuffer(blob, dtype=np.float32)
+                norm = np.linalg.norm(vec)
+                r['score'] = float(vec @ query / norm) if norm else 0.0
+        results.sort(key=lambda r: -r['score'])
         return results[:limit]
+
+def _attribute_arrays(rows, offset):
+    """
+    SELECT結果の行から、genre_id と in_stock の配列を作ります。
+    :param rows: 行のリスト（offset番目が genre_id、offset+1番目が in_stock）
+    :return: (genres, in_stock)。genre_idがNULLの場合は NO_GENRE、in_stockがNULLの場合は在庫ありとして扱います
+    """
+    genres = np.fromiter((NO_GENRE if r[offset] is None else r[offset] for r in rows),
+                         dtype=np.int64, count=len(rows))
+    in_stock = np.fromiter((r[offset + 1] != 0 for r in rows), dtype=bool, count=len(rows))
+    return genres, in_stock
+
+
+def _filter_rows(snapshot, genre_id, in_stock):
+    """
+    絞り込み条件に合う行のマスクと行番号を返します。
+    同じ条件の結果はスナップショットごとにキャッシュし、ジャンルごとの区画として再利用します。
+    :return: (mask, rows)。条件がない場合は (None, None)
+    """
+    if genre_id is None and in_stock is None:
+        return None, None
+    key = (genre_id, in_stock)
+    cached = snapshot.filters.get(key)
+    if cached is not None:
+        return cached
+    mask = np.ones(len(snapshot.ids), dtype=bool)
+    if snapshot.dead is not None:
+        mask[snapshot.dead] = False
+    if genre_id is not None:
+        mask &= snapshot.genres == int(genre_id)
+    if in_stock is not None:
+        mask &= snapshot.in_stock == bool(in_stock)
+    cached = (mask, np.flatnonzero(mask))
+    snapshot.filters[key] = cached
+    return cached
+
+
+def text_hash(text):
+    """
+    ベクトル化する元テキストのハッシュ値を返します（変更検知用）。
+    """
+    return hashlib.sha1(text.encode('utf-8')).hexdigest()
+
+
+def enriched_text(title, genre_name, description):
+    """
+    検索精度向上のため、タイトル・ジャンル・説明文を自然言語形式で結合したテキストを返します。
+    アプリからの登録と一括登録で同じ形式にすることで、text_hashによる変更検知が正しく働きます。
+    """
+    return f"{title}。ジャンルは{genre_name or ''}。{description}"
+
+
+def _normalize_rows(matrix):
+    """
+    各行をL2ノルムで割って正規化した float32 の行列を返します。
+    ノルムが0の行はゼロベクトルのまま残します（スコアは常に0になります）。
+    """
+    matrix = np.asarray(matrix, dtype=np.float32)
+    norms = np.linalg.norm(matrix, axis=1, keepdims=True)
+    norms[norms == 0] = 1.0
+    return matrix / norms
+
+
+def _quantize(vectors, storage):
+    """
+    正規化済みの float32 のベクトルを保存形式に変換します。
+    int8 はベクトルごとに最大絶対値が127になる倍率（scale）を決め、値 ≒ int8 * scale とします。
+    :return: (変換後の行列, scales)。scales は int8 の場合だけ (N,) の float32 配列で、それ以外はNone
+    """
+    vectors = np.asarray(vectors, dtype=np.float32)
+    if storage == 'float16':
+        return vectors.astype(np.float16), None
+    if storage == 'int8':
+        scales = (np.abs(vectors).max(axis=1) / 127.0).astype(np.float32)
+        safe = np.where(scales == 0, 1.0, scales).astype(np.float32)
+        data = np.clip(np.rint(vectors / safe[:, None]), -127, 127).astype(np.int8)
+        return data, scales
+    return vectors, None
+
+
+def _decode_blob(blob, dtype, scale):
+    """
+    dvd_embeddings の1行の embedding を float32 のベクトルに戻します。
+    """
+    vec = np.frombuffer(blob, dtype=dtype or 'float32').astype(np.float32)
+    if dtype == 'int8':
+        vec *= scale
+    return vec
+
+
+def _decode_rows(rows, storage):
+    """
+    SELECT結果の (dvd_id, embedding, dtype, scale, ...) の行から、保存形式 storage の常駐行列を作ります。
+    すべての行が storage の形式で保存されていれば、BLOBを連結して一度に (N, dim) の行列へ復元します。
+    形式が混在する場合（VECTOR_STORAGE の切り替え直後など）は、float32 に戻して正規化してから変換します。
+    :return: (matrix, scales)
+    """
+    stored = {r[2] or 'float32' for r in rows}
+    if stored == {storage}:
+        # bytearray に連結すると、書き込み可能な行列をコピーなしで作れます（_upsert_resident で上書きするため）
+        matrix = np.frombuffer(bytearray().join(r[1] for r in rows), dtype=storage).reshape(len(rows), -1)
+        if storage == 'float32':
+            # float32 はモデルの出力をそのまま保存しているため、ここで正規化します
+            return _normalize_rows(matrix), None
+        scales = np.fromiter((r[3] for r in rows), dtype=np.float32, count=len(rows)) if storage == 'int8' else None
+        return matrix, scales
+    vectors = _normalize_rows(np.vstack([_decode_blob(r[1], r[2], r[3]) for r in rows]))
+    return _quantize(vectors, storage)
+
+
+def _dot(matrix, scales, query, rows=None):
+    """
+    常駐行列（の指定した行）とクエリの内積を返します。
+    float16 / int8 の行列は SCORE_CHUNK_ROWS 行ずつ float32 に戻して計算するため、一時メモリは行数によらず一定です。
+    int8 の場合は最後に行ごとの倍率を掛けます。
+    """
+    if matrix.dtype == np.float32:
+        return matrix @ query if rows is None else matrix[rows] @ query
+    n = len(matrix) if rows is None else len(rows)
+    scores = np.empty(n, dtype=np.float32)
+    for start in range(0, n, SCORE_CHUNK_ROWS):
+        end = min(start + SCORE_CHUNK_ROWS, n)
+        block = matrix[start:end] if rows is None else matrix[rows[start:end]]
+        scores[start:end] = block.astype(np.float32) @ query
+    if scales is not None:
+        scores *= scales if rows is None else scales[rows]
+    return scores
+
+def _top_k(scores, k):
+    """
+    スコア配列から上位k件のインデックスをスコア降順で返します。
+    全件ソートせず、argpartitionで上位候補だけを選んでから並べ替えます。
+    """
+    n = len(scores)
+    k = min(k, n)
+    if k == n:
+        candidates = np.arange(n)
+    else:
+        candidates = np.argpartition(-scores, k - 1)[:k]
+    return candidates[np.argsort(-scores[candidates], kind='stable')]